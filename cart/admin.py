@@ -1,7 +1,15 @@
 from django.contrib import admin
-from .models import Order, OrderItem
+from .models import Order, OrderItem, SavedCart
 # Register your models here.
 
 
 admin.site.register(OrderItem)
-admin.site.register(Order)
\ No newline at end of file
+admin.site.register(Order)
+
+
+@admin.register(SavedCart)
+class SavedCartAdmin(admin.ModelAdmin):
+    list_display = ('user', 'version', 'updated_at')
+    list_select_related = ('user',)
+    search_fields = ('user__email',)
+    raw_id_fields = ('user',)
@@ -1,18 +1,138 @@
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
 from store.models import Product
-from users.models import Profile
 from django.contrib import messages
 
+from .models import SavedCart
+
+
+def set_cart_count(request, count):
+    """Remember the new badge count; CartMiddleware stores it in the count cookie."""
+    request._cart_count = count
+
+
+def cart_count(request):
+    """Number of lines for the navbar badge, read without loading the session when possible.
+
+    Visitors without a session cookie have an empty cart, and everyone else
+    carries the count in the ``CART_COUNT_COOKIE`` cookie set whenever the cart
+    changes. Only a missing or mangled count cookie falls back to the session.
+    """
+    if hasattr(request, '_cart_count'):
+        return request._cart_count
+    if settings.SESSION_COOKIE_NAME not in request.COOKIES:
+        return 0
+    cached = request.COOKIES.get(settings.CART_COUNT_COOKIE, '')
+    if cached.isdigit():
+        # The page now depends on the cookie, CartMiddleware adds Vary: Cookie.
+        request._cart_count_from_cookie = True
+        return int(cached)
+    return len(Cart(request))
+
+
+# Operations accepted by Cart.apply, and how many one batch may hold
+CART_OPERATIONS = ('add', 'set', 'remove')
+MAX_BATCH_OPERATIONS = 100
+
+
+def parse_operations(operations):
+    """Check a batch of {"op", "product_id", "quantity"} dicts and return (op, product id, quantity) tuples.
+
+    Raises ValueError naming the first bad entry, so a malformed batch changes nothing.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a non-empty list")
+    if len(operations) > MAX_BATCH_OPERATIONS:
+        raise ValueError(f"at most {MAX_BATCH_OPERATIONS} operations per batch")
+    parsed = []
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in CART_OPERATIONS:
+            raise ValueError(f"operation {index}: op must be one of {', '.join(CART_OPERATIONS)}")
+        op, product_id, quantity = operation['op'], operation.get('product_id'), operation.get('quantity', 1)
+        if type(product_id) is not int or product_id < 1:
+            raise ValueError(f"operation {index}: product_id must be a positive integer")
+        if op != 'remove' and (type(quantity) is not int or quantity < (1 if op == 'add' else 0)):
+            raise ValueError(f"operation {index}: invalid quantity")
+        parsed.append((op, product_id, quantity))
+    return parsed
+
+
+class CartSnapshot:
+    """The cart priced against the current products, read with a single query.
+
+    ``lines`` are the cart's products in cart order, each with ``quantity``,
+    ``unit_price`` (sale price when on sale), ``total_price``, ``enough_stock``
+    and ``purchasable`` (listed and in stock). Products that no longer exist are
+    listed in ``missing`` by id.
+    """
+
+    def __init__(self, quantities, products=None):
+        self.quantities = dict(quantities)
+        if products is None:
+            products = Product.objects.in_bulk([int(product_id) for product_id in self.quantities])
+        self.lines = []
+        self.missing = []
+        for product_id, quantity in self.quantities.items():
+            product = products.get(int(product_id))
+            if product is None:
+                self.missing.append(product_id)
+                continue
+            product.quantity = quantity
+            product.unit_price = product.sale_price if product.is_sale and product.sale_price is not None else product.price
+            product.total_price = product.unit_price * quantity
+            product.enough_stock = product.stock_quantity >= quantity
+            product.purchasable = product.is_listed and product.enough_stock
+            self.lines.append(product)
+        self.total = sum(line.total_price for line in self.lines)
+        self.total_quantity = sum(line.quantity for line in self.lines)
+
+    @property
+    def has_problems(self):
+        """True when a product is gone, unlisted or short of stock."""
+        return bool(self.missing) or not all(line.purchasable for line in self.lines)
+
+    def as_dict(self):
+        """JSON-ready form, prices as strings."""
+        return {
+            'lines': [
+                {
+                    'product_id': line.pk,
+                    'name': line.name,
+                    'quantity': line.quantity,
+                    'unit_price': str(line.unit_price),
+                    'total_price': str(line.total_price),
+                    'purchasable': line.purchasable,
+                }
+                for line in self.lines
+            ],
+            'missing': self.missing,
+            'total': str(self.total),
+            'total_quantity': self.total_quantity,
+        }
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+
 class Cart():
     def __init__(self, request):
         self.session = request.session
         self.request = request
-        cart = self.session.get('session_key')
-        # Check if you have a session, if not create one
-        if 'session_key' not in request.session:
-            cart = request.session['session_key'] = {}
-        self.cart = cart
-        
+        # Reading an empty cart must not create a session, it is stored on the first change.
+        self.cart = self.session.get('session_key', {})
+        if not hasattr(request, '_cart_initial'):
+            # What the request started with; persist_cart only writes when this changed.
+            request._cart_initial = dict(self.cart)
+
+    def _changed(self):
+        self.session['session_key'] = self.cart
+        set_cart_count(self.request, len(self.cart))
+
     # Add product to session
     def add(self, request, product, quantity):
         product_id = str(product.id)
@@ -33,16 +153,7 @@ class Cart():
                 self.cart[product_id] = quantity
                 messages.success(request, ('Product added to cart'))
             
-        self.session.modified = True
-        
-        #Logged in user
-        if self.request.user.is_authenticated:
-            #Get current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            #convert '' to ""
-            cart_dict = str(self.cart)
-            cart_dict = cart_dict.replace("\'", "\"")
-            current_user.update(old_cart=str(cart_dict))
+        self._changed()
         
         
     def update(self, request, product, quantity):
@@ -59,17 +170,7 @@ class Cart():
             self.cart[product_id] = quantity
             messages.success(request, 'Cart updated successfully')
 
-        self.session.modified = True
-    
-        #Logged in user
-        if self.request.user.is_authenticated:
-            #Get current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            
-            #convert '' to ""
-            cart_dict = str(self.cart)
-            cart_dict = cart_dict.replace("\'", "\"")
-            current_user.update(old_cart=str(cart_dict))
+        self._changed()
             
         # Return the updated cart
         return self.cart
@@ -83,19 +184,18 @@ class Cart():
     #     return sum(self.cart.values())
     
     
+    def snapshot(self):
+        """Priced cart lines, computed once per request for the current cart contents."""
+        key = tuple(self.cart.items())
+        snapshot = getattr(self.request, '_cart_snapshot', None)
+        if snapshot is None or snapshot.key != key:
+            snapshot = CartSnapshot(self.cart)
+            snapshot.key = key
+            self.request._cart_snapshot = snapshot
+        return snapshot
+
     def get_prods(self):
-        product_ids = self.cart.keys()
-        products = Product.objects.filter(id__in=product_ids)
-        
-        # Add total price for each product based on quantity
-        for product in products:
-            product.quantity = self.cart[str(product.id)]  # Add quantity to product object
-            if product.is_sale:  # Check if product is on sale
-                product.total_price = product.sale_price * product.quantity  # Use sale price
-            else:
-                product.total_price = product.price * product.quantity  # Use regular price
-        
-        return products
+        return self.snapshot().lines
 
     
     def get_quants(self):
@@ -108,40 +208,85 @@ class Cart():
         if product_id in self.cart:
             del self.cart[product_id]
             
-        self.session.modified = True
-        #Logged in user
-        if self.request.user.is_authenticated:
-            #Get current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            #convert '' to ""
-            cart_dict = str(self.cart)
-            cart_dict = cart_dict.replace("\'", "\"")
-            current_user.update(old_cart=str(cart_dict))
-            
-            
-    # def delete(self, product):
-    #     product_id = str(product)
-    #     if product_id in self.cart:
-    #         del self.cart[product_id]
-            
-    #     self.session.modified = True
-
-    #     if self.request.user.is_authenticated:
-    #         current_user = Profile.objects.get(user=self.request.user)
-    #         cart_dict = str(self.cart).replace("\'", "\"")
-    #         current_user.old_cart = cart_dict
-    #         current_user.save()
+        self._changed()
     
     
-    def order_total(self):
-        total = 0
-        for product_id, quantity in self.cart.items():
-            product = Product.objects.get(id=product_id)
-            if product.is_sale:
-                total += product.sale_price * quantity
+    def merge(self, saved):
+        """Combine the session cart with the ``saved`` cart of the user who just logged in.
+
+        Quantities already in the session win over saved ones. Every product is
+        checked with one query: unlisted or vanished products are dropped and
+        quantities are cut back to the stock. CartMiddleware then stores the
+        result with a single write, or none when it equals ``saved``. Returns
+        the number of lines that were dropped or cut back.
+        """
+        merged = {**{str(product_id): quantity for product_id, quantity in saved.items()}, **self.cart}
+        # The saved cart is what is stored now, so an unchanged merge is not written again.
+        self.request._cart_initial = dict(saved)
+        if not merged:
+            return 0
+        ids = [int(product_id) for product_id in merged if product_id.isdigit()]
+        stock = dict(Product.objects.filter(pk__in=ids, is_listed=True).values_list('pk', 'stock_quantity'))
+
+        cart, adjusted = {}, 0
+        for product_id, quantity in merged.items():
+            available = stock.get(int(product_id), 0) if product_id.isdigit() else 0
+            kept = min(int(quantity), available)
+            if kept > 0:
+                cart[product_id] = kept
+            if kept != quantity:
+                adjusted += 1
+        self.cart = cart
+        self._changed()
+        return adjusted
+
+    def apply(self, operations):
+        """Apply a batch of parsed operations (see ``parse_operations``) as one change.
+
+        ``add`` raises a quantity, ``set`` replaces it (0 removes the line) and
+        ``remove`` drops the line. The products of the batch and of the cart are
+        loaded with one query, which also prices the resulting snapshot, and the
+        session is written once. Adding or setting a product that is gone or
+        unlisted skips that operation, quantities are cut back to the stock.
+        Returns notes on the skipped and limited operations.
+        """
+        ids = {product_id for _, product_id, _ in operations} | {int(product_id) for product_id in self.cart}
+        products = Product.objects.in_bulk(ids)
+        cart = dict(self.cart)
+        notes = []
+        for index, (op, product_id, quantity) in enumerate(operations):
+            key = str(product_id)
+            if op == 'remove':
+                cart.pop(key, None)
+                continue
+            product = products.get(product_id)
+            if product is None or not product.is_listed:
+                notes.append({'index': index, 'product_id': product_id, 'note': 'unavailable'})
+                continue
+            wanted = cart.get(key, 0) + quantity if op == 'add' else quantity
+            if wanted > product.stock_quantity:
+                wanted = product.stock_quantity
+                notes.append({'index': index, 'product_id': product_id, 'note': 'limited to stock', 'quantity': wanted})
+            if wanted > 0:
+                cart[key] = wanted
             else:
-                total += product.price * quantity
-        return total
+                cart.pop(key, None)
+
+        if cart != self.cart:
+            self.cart = cart
+            self._changed()
+        snapshot = CartSnapshot(self.cart, products)
+        snapshot.key = tuple(self.cart.items())
+        self.request._cart_snapshot = snapshot
+        return notes
+
+    def clear(self):
+        self.cart = {}
+        self.session.pop('session_key', None)
+        set_cart_count(self.request, 0)
+
+    def order_total(self):
+        return self.snapshot().total
     
     
     # Add product to session
@@ -154,21 +299,39 @@ class Cart():
         else:
             self.cart[product_id] = int(product_qty)
             
-        self.session.modified = True
-        #Logged in user
-        if self.request.user.is_authenticated:
-            #Get current user profile
-            current_user = Profile.objects.filter(user__id=self.request.user.id)
-            #convert '' to ""
-            cart_dict = str(self.cart)
-            cart_dict = cart_dict.replace("\'", "\"")
-            current_user.update(old_cart=str(cart_dict))
-            
+        self._changed()
 
 
-    
-    
+def load_saved_cart(user):
+    """The stored cart of ``user`` as {product id: quantity}; read only when asked for."""
+    return SavedCart.objects.filter(user=user).values_list('items', flat=True).first() or {}
 
 
-    
-        
\ No newline at end of file
+def save_cart(user, items):
+    """Store ``items`` as the cart of ``user`` with a single write, bumping its version."""
+    changes = {'items': items, 'version': F('version') + 1, 'updated_at': timezone.now()}
+    if SavedCart.objects.filter(user=user).update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            SavedCart.objects.create(user=user, items=items, version=1)
+    except IntegrityError:
+        # Another request of the same user created it first.
+        SavedCart.objects.filter(user=user).update(**changes)
+
+
+def persist_cart(request):
+    """Save a logged-in user's cart once, at the end of the request, if the request changed it.
+
+    Called by CartMiddleware; returns True when a write happened.
+    """
+    initial = getattr(request, '_cart_initial', None)
+    user = getattr(request, 'user', None)
+    if initial is None or user is None or not user.is_authenticated:
+        return False
+    items = request.session.get('session_key', {})
+    if items == initial:
+        return False
+    save_cart(user, items)
+    request._cart_initial = dict(items)
+    return True
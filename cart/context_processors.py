@@ -1,5 +1,11 @@
-from .cart import Cart
+from django.utils.functional import SimpleLazyObject
 
-# Make the cart session available in all pages
+from .cart import Cart, cart_count
+
+# Make the cart session available in all pages. Both values are lazy, a page
+# that never shows them never reads (or creates) the session.
 def cart(request):
-    return {'cart': Cart(request)}
\ No newline at end of file
+    return {
+        'cart': SimpleLazyObject(lambda: Cart(request)),
+        'cart_count': SimpleLazyObject(lambda: cart_count(request)),
+    }
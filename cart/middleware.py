@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from .cart import persist_cart
+
+
+class CartMiddleware:
+    """Finishes the cart work of a request once the view has run.
+
+    A logged-in user's cart is saved with at most one write, and only when the
+    request changed it (see ``persist_cart``). The ``CART_COUNT_COOKIE`` badge
+    count is written only on responses to requests that changed the cart, so
+    catalog pages of visitors without a cart stay free of session access and
+    can be served from a shared cache.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        persist_cart(request)
+        count = getattr(request, '_cart_count', None)
+        if count:
+            response.set_cookie(
+                settings.CART_COUNT_COOKIE, str(count), max_age=settings.SESSION_COOKIE_AGE,
+                samesite='Lax', secure=settings.SESSION_COOKIE_SECURE,
+            )
+        elif count == 0 and settings.CART_COUNT_COOKIE in request.COOKIES:
+            response.delete_cookie(settings.CART_COUNT_COOKIE, samesite='Lax')
+        if getattr(request, '_cart_count_from_cookie', False):
+            patch_vary_headers(response, ('Cookie',))
+        return response
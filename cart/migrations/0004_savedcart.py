@@ -0,0 +1,43 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:01
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_old_carts(apps, schema_editor):
+    """Move the carts kept as strings in Profile.old_cart into SavedCart."""
+    Profile = apps.get_model('users', 'Profile')
+    SavedCart = apps.get_model('cart', 'SavedCart')
+    saved = []
+    for user_id, old_cart in Profile.objects.exclude(old_cart='').values_list('user_id', 'old_cart').iterator():
+        try:
+            items = {str(product_id): int(quantity) for product_id, quantity in json.loads(old_cart).items()}
+        except (ValueError, TypeError, AttributeError):
+            continue  # truncated at 255 characters, nothing to recover
+        if items:
+            saved.append(SavedCart(user_id=user_id, items=items, version=1))
+    SavedCart.objects.bulk_create(saved, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0013_customuser_token_version'),
+        ('cart', '0003_alter_order_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SavedCart',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='saved_cart', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('items', models.JSONField(blank=True, default=dict)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(copy_old_carts, migrations.RunPython.noop),
+    ]
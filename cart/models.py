@@ -24,4 +24,18 @@ class OrderItem(models.Model):
     price = models.DecimalField(max_digits=12, decimal_places=2)
 
     def __str__(self):
-        return f"OrderItem {self.id} for Order {self.order.id}"
\ No newline at end of file
+        return f"OrderItem {self.id} for Order {self.order.id}"
+
+class SavedCart(models.Model):
+    """The cart of a logged-in user, kept across sessions and devices.
+
+    ``items`` maps product ids (as strings) to quantities, like the session cart.
+    ``version`` goes up on every write.
+    """
+    user = models.OneToOneField(CustomUser, on_delete=models.CASCADE, primary_key=True, related_name='saved_cart')
+    items = models.JSONField(default=dict, blank=True)
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Saved cart of {self.user_id} (v{self.version})"
@@ -1,3 +1,183 @@
-from django.test import TestCase
+from decimal import Decimal
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from store.models import Product
+from users.models import CustomUser
+from .context_processors import cart as cart_context
+from .models import SavedCart
+
+
+def make_products(**stock):
+    """Create one product per keyword, named after it, with that stock; return {name: product}."""
+    Product.objects.bulk_create([
+        Product(name=name, slug=name, price=Decimal('10.00'), stock_quantity=quantity)
+        for name, quantity in stock.items()
+    ])
+    return {product.name: product for product in Product.objects.all()}
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CartMergeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.user = CustomUser.objects.create_user('member@example.com', 'pw')
+        cls.products = make_products(kept=10, limited=3, unlisted=5, both=10)
+        Product.objects.filter(name='unlisted').update(is_listed=False)
+
+    def ids(self, *names):
+        return [str(self.products[name].pk) for name in names]
+
+    def log_in(self):
+        return self.client.post(reverse('signin'), {'username': 'member@example.com', 'password': 'pw'}, follow=True)
+
+    def session_cart(self):
+        return self.client.session.get('session_key', {})
+
+    def test_saved_cart_is_merged_into_the_session_cart(self):
+        kept, limited, unlisted, both = self.ids('kept', 'limited', 'unlisted', 'both')
+        SavedCart.objects.create(user=self.user, items={kept: 2, limited: 9, unlisted: 1, both: 1, '999999': 1})
+        session = self.client.session
+        session['session_key'] = {both: 4}
+        session.save()
+
+        response = self.log_in()
+
+        # Session quantities win, unlisted and vanished products go, the rest is cut back to stock.
+        self.assertEqual(self.session_cart(), {kept: 2, limited: 3, both: 4})
+        self.assertEqual(SavedCart.objects.get(user=self.user).items, {kept: 2, limited: 3, both: 4})
+        self.assertContains(response, 'no longer available in that quantity')
+
+    def test_unchanged_saved_cart_is_not_written_again(self):
+        kept = self.ids('kept')[0]
+        SavedCart.objects.create(user=self.user, items={kept: 2})
+        self.log_in()
+        saved = SavedCart.objects.get(user=self.user)
+        self.assertEqual(self.session_cart(), {kept: 2})
+        self.assertEqual(saved.version, 0)
+
+
+class CartBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_products(kit=10, refill=2, retired=5)
+        Product.objects.filter(name='retired').update(is_listed=False)
+        cls.url = reverse('cart_batch')
+
+    def batch(self, operations):
+        return self.client.post(self.url, {'operations': operations}, content_type='application/json')
+
+    def test_operations_are_applied_together(self):
+        kit, refill, retired = (self.products[name].pk for name in ('kit', 'refill', 'retired'))
+        self.batch([{'op': 'add', 'product_id': kit, 'quantity': 1}])
+        # Session read, one product query for the batch and the priced cart, session write (in a savepoint).
+        with self.assertNumQueries(5):
+            response = self.batch([
+                {'op': 'add', 'product_id': kit, 'quantity': 2},
+                {'op': 'set', 'product_id': refill, 'quantity': 5},
+                {'op': 'add', 'product_id': retired},
+            ])
+        data = response.json()
+        self.assertEqual(data['qty'], 2)
+        self.assertEqual(
+            [(line['product_id'], line['quantity']) for line in data['cart']['lines']],
+            [(kit, 3), (refill, 2)],
+        )
+        self.assertEqual(data['cart']['total'], '50.00')
+        self.assertEqual([note['note'] for note in data['notes']], ['limited to stock', 'unavailable'])
+
+        data = self.batch([{'op': 'remove', 'product_id': kit}, {'op': 'set', 'product_id': refill, 'quantity': 0}]).json()
+        self.assertEqual((data['qty'], data['cart']['lines']), (0, []))
+
+    def test_malformed_batch_changes_nothing(self):
+        kit = self.products['kit'].pk
+        response = self.batch([{'op': 'add', 'product_id': kit}, {'op': 'explode', 'product_id': kit}])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('operation 1', response.json()['error'])
+        self.assertEqual(self.client.session.get('session_key', {}), {})
+        self.assertEqual(self.batch([]).status_code, 400)
+        self.assertEqual(self.client.get(self.url).status_code, 405)
+
+
+class LazyCartContextTests(TestCase):
+    def request(self, **cookies):
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies)
+        request.session = SessionStore()
+        request.session['session_key'] = {'1': 2, '2': 1}
+        request.session.accessed = False
+        return request
+
+    def test_context_reads_the_session_only_when_used(self):
+        request = self.request()
+        context = cart_context(request)
+        self.assertFalse(request.session.accessed)
+        self.assertEqual(len(context['cart']), 2)
+        self.assertTrue(request.session.accessed)
+
+    def test_badge_count_comes_from_the_cookie(self):
+        request = self.request(**{settings.SESSION_COOKIE_NAME: 'key', settings.CART_COUNT_COOKIE: '7'})
+        self.assertEqual(str(cart_context(request)['cart_count']), '7')
+        self.assertFalse(request.session.accessed)
+
+        # A mangled count falls back to the session, visitors without a session have nothing
+        mangled = self.request(**{settings.SESSION_COOKIE_NAME: 'key', settings.CART_COUNT_COOKIE: 'x'})
+        self.assertEqual(str(cart_context(mangled)['cart_count']), '2')
+        anonymous = self.request()
+        self.assertEqual(str(cart_context(anonymous)['cart_count']), '0')
+        self.assertFalse(anonymous.session.accessed)
+
+    def test_count_cookie_follows_cart_changes(self):
+        kit = make_products(kit=10)['kit'].pk
+        url = reverse('cart_batch')
+        response = self.client.post(url, {'operations': [{'op': 'add', 'product_id': kit}]}, content_type='application/json')
+        self.assertEqual(response.cookies[settings.CART_COUNT_COOKIE].value, '1')
+        response = self.client.post(url, {'operations': [{'op': 'remove', 'product_id': kit}]}, content_type='application/json')
+        self.assertEqual(response.cookies[settings.CART_COUNT_COOKIE]['max-age'], 0)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SavedCartPersistenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.user = CustomUser.objects.create_user('member@example.com', 'pw')
+        cls.products = make_products(kit=10, refill=10)
+
+    def batch(self, *operations):
+        return self.client.post(reverse('cart_batch'), {'operations': list(operations)}, content_type='application/json')
+
+    def saved(self):
+        return SavedCart.objects.filter(user=self.user).values_list('items', 'version').first()
+
+    def test_changes_of_a_request_are_written_once(self):
+        kit, refill = self.products['kit'].pk, self.products['refill'].pk
+        self.client.force_login(self.user)
+        with CaptureQueriesContext(connection) as queries:
+            self.batch({'op': 'add', 'product_id': kit, 'quantity': 2}, {'op': 'add', 'product_id': refill},
+                       {'op': 'set', 'product_id': refill, 'quantity': 3})
+        # One save for three changes: an UPDATE that finds no row yet, then the INSERT
+        self.assertEqual(sum('cart_savedcart' in query['sql'] for query in queries), 2)
+        self.assertEqual(self.saved(), ({str(kit): 2, str(refill): 3}, 1))
+
+        # Reading the cart, or changes that cancel out, write nothing
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('cart'))
+            self.batch({'op': 'add', 'product_id': kit}, {'op': 'set', 'product_id': kit, 'quantity': 2})
+        self.assertFalse(any('cart_savedcart' in query['sql'] for query in queries))
+        self.assertEqual(self.saved(), ({str(kit): 2, str(refill): 3}, 1))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.batch({'op': 'remove', 'product_id': refill})
+        self.assertEqual(sum('cart_savedcart' in query['sql'] for query in queries), 1)
+        self.assertEqual(self.saved(), ({str(kit): 2}, 2))
+
+    def test_anonymous_cart_is_not_stored(self):
+        self.batch({'op': 'add', 'product_id': self.products['kit'].pk})
+        self.assertFalse(SavedCart.objects.exists())
@@ -6,5 +6,6 @@ urlpatterns = [
     path('add/', views.cart_add, name='cart_add'),
     path('delete', views.cart_delete, name='cart_delete'),
     path('update', views.cart_update, name='cart_update'),
+    path('batch/', views.cart_batch, name='cart_batch'),
     path('checkout/', views.checkout, name='checkout'),
 ]
\ No newline at end of file
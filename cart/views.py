@@ -1,6 +1,9 @@
+import json
+
 from django.shortcuts import redirect, render, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from .cart import Cart
+from django.views.decorators.http import require_POST
+from .cart import Cart, parse_operations
 from store.models import Product
 from django.contrib import messages
 from django.http import JsonResponse
@@ -10,16 +13,14 @@ from users.models import ShippingAddress
 
 def cart(request):
     cart_instance = Cart(request)  
-    cart_items = cart_instance.get_prods() 
-    cart_quantities = cart_instance.get_quants()
-    total_quantity = sum(cart_quantities.values())
-    order_total = cart_instance.order_total()
+    snapshot = cart_instance.snapshot()  # one product query for the whole page
 
     context = {
-        'cart_items': cart_items,
-        'cart_quantities': cart_quantities,
-        'total_quantity': total_quantity,
-        'order_total': order_total
+        'cart_items': snapshot.lines,
+        'cart_quantities': cart_instance.get_quants(),
+        'total_quantity': snapshot.total_quantity,
+        'order_total': snapshot.total,
+        'cart_snapshot': snapshot,
     }
     return render(request, 'cart/cart.html', context)
 
@@ -61,13 +62,28 @@ def cart_delete(request):
         messages.info(request, f'{product.name} removed from cart')
         return response
 
+@require_POST
+def cart_batch(request):
+    """Apply several cart changes at once (reorder, bundles).
+
+    The JSON body is {"operations": [{"op": "add" | "set" | "remove", "product_id": 1, "quantity": 2}, ...]}.
+    A malformed batch is rejected as a whole with a 400. The response carries
+    the cart count, the priced cart and notes on skipped or limited operations.
+    """
+    try:
+        payload = json.loads(request.body or b'{}')
+        operations = parse_operations(payload.get('operations') if isinstance(payload, dict) else None)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+
+    cart = Cart(request)
+    notes = cart.apply(operations)
+    return JsonResponse({'qty': len(cart), 'cart': cart.snapshot().as_dict(), 'notes': notes})
+
 @login_required
 def checkout(request):
     cart_instance = Cart(request)  
-    cart_items = cart_instance.get_prods() 
-    cart_quantities = cart_instance.get_quants()
-    total_quantity = sum(cart_quantities.values())
-    order_total = cart_instance.order_total()
+    snapshot = cart_instance.snapshot()
     products = Product.objects.all()
 
     try:
@@ -93,10 +109,11 @@ def checkout(request):
     user_profile = request.user.profile  # Assuming the profile is related to CustomUser as a OneToOneField
 
     context = {
-        'cart_items': cart_items,
-        'cart_quantities': cart_quantities,
-        'total_quantity': total_quantity,
-        'order_total': order_total,
+        'cart_items': snapshot.lines,
+        'cart_quantities': cart_instance.get_quants(),
+        'total_quantity': snapshot.total_quantity,
+        'order_total': snapshot.total,
+        'cart_snapshot': snapshot,
         'products': products,
         'form': form,
         'user_profile': user_profile,
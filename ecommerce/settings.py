@@ -73,7 +73,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    
+    'cart.middleware.CartMiddleware',
 ]
 
 
@@ -179,7 +179,8 @@ AUTH_USER_MODEL = "users.CustomUser"
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # JWTAuthentication that takes the user from the token claims (users.authentication)
+        'users.authentication.ClaimsJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',  
     ],
 }
@@ -195,6 +196,8 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
     'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
     'TOKEN_USER_CLASS': 'users.CustomUser',
+    'TOKEN_OBTAIN_SERIALIZER': 'users.authentication.ClaimsTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'users.authentication.ClaimsTokenRefreshSerializer',
 }
 
 
@@ -246,9 +249,53 @@ CORS_ALLOW_HEADERS = [
 ]
 
 
+# Shared cache (tree layout, version counters). Point it at Redis/Memcached when
+# running several workers, the in-process default is per worker.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
 
 
 CART_SESSION_ID = 'cart'
+# Cookie carrying the navbar cart count, so the badge does not need the session
+CART_COUNT_COOKIE = 'cart_count'
+
+# MLM tree storage: 'nested_set' (MPTT lft/rght) or 'path' (append-only materialized path).
+# Run `manage.py rebuild_mlmtree` after switching.
+MLMTREE_STORAGE = os.environ.get('MLMTREE_STORAGE', 'nested_set')
+
+# How new members are placed under their sponsor: 'breadth_first' (spillover),
+# 'weakest_leg', 'round_robin', or a dotted path to a users.placement.PlacementStrategy.
+MLM_PLACEMENT_STRATEGY = 'breadth_first'
+
+# Rank rules, lowest first; a member holds the highest rank whose every threshold is met.
+# group_volume is in rupees and includes the member's own sales.
+MLM_RANKS = [
+    {'name': 'Bronze', 'direct_recruits': 2, 'active_legs': 1, 'group_volume': 10000},
+    {'name': 'Silver', 'direct_recruits': 4, 'active_legs': 2, 'group_volume': 50000},
+    {'name': 'Gold', 'direct_recruits': 6, 'active_legs': 3, 'group_volume': 200000},
+    {'name': 'Diamond', 'direct_recruits': 10, 'active_legs': 5, 'group_volume': 1000000},
+]
+# Personal sales (rupees) that make a member active; a leg with an active member is an active leg
+MLM_ACTIVE_VOLUME = 1000
+
+# Where snapshot_genealogy writes the frozen period-end trees
+MLM_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+
+# Commission paid to each placement upline level on an order, in basis points (1000 = 10%).
+MLM_COMMISSION_RATES = [1000, 500, 300, 200, 100]
+
+# Member ids: numbers are handed out in blocks of UNIQUE_ID_BLOCK_SIZE per process and
+# shuffled with UNIQUE_ID_KEY. Never change the key once ids exist, it defines the shuffle.
+UNIQUE_ID_KEY = 'vgs-ss'
+UNIQUE_ID_BLOCK_SIZE = 100
+
+# Sponsors resolved from referral codes, kept per process (see users.referrals)
+REFERRAL_CACHE_SIZE = 1000
+REFERRAL_CACHE_TTL = 300
 
 
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -3,11 +3,41 @@ from django.urls import path
 from django.shortcuts import render
 from django.utils.html import format_html
 from mptt.admin import MPTTModelAdmin
-from .models import MLMTree
+from users.admin_filters import AutocompleteFilter, autocomplete_media
+from .models import Commission, CommissionRun, MLMTree
+from .storage import tree_ordering, uses_path_storage
 
 class MLMTreeAdmin(MPTTModelAdmin):
     mptt_level_indent = 20
     list_display = ("user", "get_parent", "get_sponsor", "view_tree_link")  # ✅ Added get_sponsor
+    list_filter = (("user__parent_sponsor", AutocompleteFilter), ("parent", AutocompleteFilter))
+    search_fields = ("user__email", "user__first_name", "user__last_name", "user__unique_id")
+    show_full_result_count = False
+    raw_id_fields = ("user", "parent")
+
+    @property
+    def media(self):
+        return super().media + autocomplete_media()
+
+    def get_queryset(self, request):
+        # Placement parent and sponsor are shown per row, __str__ shows the member (also in autocomplete results).
+        # The changelist skips list_select_related once the queryset has joins, so they are all listed here.
+        return super().get_queryset(request).select_related("user__parent_sponsor", "parent__user")
+
+    def get_ordering(self, request):
+        """Tree order for the active storage mode (lft or materialized path)."""
+        return tree_ordering()
+
+    def get_actions(self, request):
+        if uses_path_storage():
+            # MPTT's delete action renumbers lft/rght afterwards, which path storage does not keep.
+            return admin.ModelAdmin.get_actions(self, request)
+        return super().get_actions(request)
+
+    def delete_queryset(self, request, queryset):
+        """Delete node by node, so every detached subtree gets its paths rewritten."""
+        for obj in queryset:
+            obj.delete()
 
     def get_parent(self, obj):
         """Returns the parent placement (who the user is placed under in the tree)."""
@@ -21,7 +51,21 @@ class MLMTreeAdmin(MPTTModelAdmin):
 
     def view_tree_link(self, obj):
         """Provides a clickable link to view the MLM tree."""
-        return format_html('<a href="/mlmtree/tree-view/" target="_blank">🔍 View MLM Tree</a>')
+        return format_html('<a href="/mlmtree/tree-view/?root={}" target="_blank">🔍 View MLM Tree</a>', obj.user_id)
     view_tree_link.short_description = "MLM Tree"
 
 admin.site.register(MLMTree, MLMTreeAdmin)
+
+
+@admin.register(CommissionRun)
+class CommissionRunAdmin(admin.ModelAdmin):
+    list_display = ("period", "status", "orders_processed", "total_paid", "started_at", "finished_at")
+    readonly_fields = ("last_order_id", "orders_processed", "total_paid", "started_at", "finished_at")
+
+
+@admin.register(Commission)
+class CommissionAdmin(admin.ModelAdmin):
+    list_display = ("order", "beneficiary", "source_user", "level", "amount", "run")
+    list_filter = ("run", "level")
+    list_select_related = ("beneficiary", "source_user", "run")
+    raw_id_fields = ("order", "beneficiary", "source_user")
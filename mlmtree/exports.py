@@ -0,0 +1,82 @@
+"""Streaming genealogy export (CSV, opens directly in spreadsheet software).
+
+Rows come from one ordered query over MLMTree in tree order (``lft``, or
+``path`` in path storage), read with a chunked cursor and written as they
+arrive, so memory stays constant however large the downline is. The first
+column is the member's user id; passing the last exported id as ``after``
+resumes the export right behind that member, even if the tree was renumbered
+in between.
+"""
+import csv
+
+from django.db.models import Q
+
+from .models import MLMTree
+from .storage import subtree_filter, tree_ordering, uses_path_storage
+
+EXPORT_COLUMNS = (
+    'member_id', 'member', 'email', 'unique_id', 'sponsor', 'placement_parent',
+    'level', 'date_joined', 'personal_volume',
+)
+
+# Rows fetched from the database cursor at a time
+EXPORT_CHUNK_SIZE = 2000
+
+# Spreadsheets treat cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def after_filter(node):
+    """Q matching every node that comes after ``node`` in tree order."""
+    if uses_path_storage():
+        return Q(path__gt=node.path)
+    return Q(tree_id__gt=node.tree_id) | Q(tree_id=node.tree_id, lft__gt=node.lft)
+
+
+def export_rows(root=None, after=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield one tuple per member (see EXPORT_COLUMNS) of ``root``'s subtree or of the whole network.
+
+    ``after`` is an MLMTree node; the export starts right behind it.
+    """
+    nodes = MLMTree.objects.all()
+    if root is not None:
+        nodes = nodes.filter(subtree_filter(root))
+    if after is not None:
+        nodes = nodes.filter(after_filter(after))
+    rows = nodes.order_by(*tree_ordering()).values_list(
+        'user_id', 'user__first_name', 'user__last_name', 'user__email', 'user__unique_id',
+        'user__parent_sponsor__unique_id', 'parent__user__unique_id', 'level',
+        'user__date_joined', 'user__rank__personal_volume',
+    )
+    for (user_id, first_name, last_name, email, unique_id, sponsor, parent,
+         level, date_joined, volume) in rows.iterator(chunk_size=chunk_size):
+        yield (
+            user_id, f"{first_name} {last_name}".strip(), email, unique_id or '', sponsor or '',
+            parent or '', level, date_joined.date().isoformat(), f"{volume or 0:.2f}",
+        )
+
+
+def _safe(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+class _Echo:
+    """File-like object whose ``write`` hands the line back instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows, header=True):
+    """Yield CSV text for ``rows``, one chunk per EXPORT_CHUNK_SIZE rows."""
+    writer = csv.writer(_Echo())
+    # The byte order mark makes Excel read the file as UTF-8.
+    lines = ['\ufeff' + writer.writerow(EXPORT_COLUMNS)] if header else []
+    for count, row in enumerate(rows, start=1):
+        lines.append(writer.writerow([_safe(value) for value in row]))
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
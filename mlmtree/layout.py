@@ -0,0 +1,123 @@
+"""Server-side layout of the MLM tree for the admin viewer.
+
+The layout is a tidy layered tree: leaves take consecutive x slots in tree
+order and every parent is centred over its first and last child; y is the
+depth. It is computed with NumPy, one pass per level, and cached under the
+current tree version, which every insert, move and delete bumps.
+
+Binary payload, little endian:
+
+    b"MLT1"  uint32 count  uint32 names_bytes  uint32 flags (1 = truncated)
+    int32 ids[count]  float32 x[count]  float32 y[count]  int32 parent[count]
+    names: UTF-8, newline separated, in node order
+
+``ids`` are user ids and ``parent`` is an index into the same arrays (-1 for roots).
+"""
+import struct
+
+import numpy as np
+from django.core.cache import cache
+
+from .models import MLMTree
+from .storage import subtree_filter, tree_ordering
+
+MAGIC = b'MLT1'
+FLAG_TRUNCATED = 1
+VERSION_KEY = 'mlmtree:tree_version'
+LAYOUT_TIMEOUT = 24 * 60 * 60
+
+
+def tree_version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def bump_tree_version():
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, timeout=None)
+
+
+def compute_layout(parent, depth):
+    """Return (x, y) for nodes given in tree order as parent indices and depths."""
+    size = len(parent)
+    x = np.zeros(size, dtype=np.float64)
+    if not size:
+        return x.astype(np.float32), x.astype(np.float32)
+    has_parent = parent >= 0
+    is_leaf = np.bincount(parent[has_parent], minlength=size) == 0
+    x[is_leaf] = np.arange(is_leaf.sum())
+
+    low = np.full(size, np.inf)
+    high = np.full(size, -np.inf)
+    order = np.argsort(-depth, kind='stable')
+    bounds = np.flatnonzero(np.diff(depth[order])) + 1
+    # Deepest level first: centre the level's parents, then hand their x up.
+    for members in np.split(order, bounds):
+        inner = members[~is_leaf[members]]
+        x[inner] = (low[inner] + high[inner]) / 2
+        members = members[has_parent[members]]
+        np.minimum.at(low, parent[members], x[members])
+        np.maximum.at(high, parent[members], x[members])
+    return x.astype(np.float32), depth.astype(np.float32)
+
+
+def build_layout(root=None, max_depth=None, max_nodes=200000):
+    """Lay out ``root``'s subtree (or the whole forest) and return the binary payload."""
+    nodes = MLMTree.objects.all()
+    base_level = 0
+    if root is not None:
+        nodes = nodes.filter(subtree_filter(root))
+        base_level = root.level
+    if max_depth is not None:
+        nodes = nodes.filter(level__lte=base_level + max_depth)
+    rows = list(
+        nodes.order_by(*tree_ordering())
+        .values_list('id', 'parent_id', 'level', 'user_id', 'user__first_name', 'user__last_name')[:max_nodes + 1]
+    )
+    flags = 0
+    if len(rows) > max_nodes:
+        # A prefix in tree order is still a valid tree: parents always come first.
+        rows, flags = rows[:max_nodes], FLAG_TRUNCATED
+
+    position = {node_id: index for index, (node_id, *_) in enumerate(rows)}
+    parent = np.array([position.get(parent_id, -1) for _, parent_id, *_ in rows], dtype=np.int32)
+    depth = np.array([level - base_level for _, _, level, *_ in rows], dtype=np.int64)
+    user_ids = np.array([row[3] for row in rows], dtype=np.int32)
+    x, y = compute_layout(parent, depth)
+    names = '\n'.join(f"{first} {last}".replace('\n', ' ') for *_, first, last in rows).encode()
+
+    header = MAGIC + struct.pack('<III', len(rows), len(names), flags)
+    return b''.join([
+        header,
+        user_ids.astype('<i4').tobytes(), x.astype('<f4').tobytes(),
+        y.astype('<f4').tobytes(), parent.astype('<i4').tobytes(), names,
+    ])
+
+
+def decode_layout(payload):
+    """Columnar dict of a binary payload (the ``format=json`` variant of the API)."""
+    count, names_bytes, flags = struct.unpack_from('<III', payload, len(MAGIC))
+    offset = len(MAGIC) + 12
+    columns = {}
+    for key, dtype in (('ids', '<i4'), ('x', '<f4'), ('y', '<f4'), ('parent', '<i4')):
+        columns[key] = np.frombuffer(payload, dtype=dtype, count=count, offset=offset).tolist()
+        offset += 4 * count
+    names = payload[offset:offset + names_bytes].decode()
+    columns['names'] = names.split('\n') if count else []
+    columns['truncated'] = bool(flags & FLAG_TRUNCATED)
+    return columns
+
+
+def cached_layout(root=None, max_depth=None):
+    """Layout payload for the current tree version, computed at most once per version."""
+    key = f"mlmtree:layout:{tree_version()}:{root.pk if root else 'all'}:{max_depth}"
+    payload = cache.get(key)
+    if payload is None:
+        payload = build_layout(root, max_depth)
+        cache.set(key, payload, LAYOUT_TIMEOUT)
+    return payload
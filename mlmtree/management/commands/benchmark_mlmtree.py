@@ -0,0 +1,97 @@
+import random
+import time
+from collections import defaultdict
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+from django.test.utils import override_settings
+
+from mlmtree.models import MLMTree
+from mlmtree.storage import NESTED_SET, PATH, encode_segment, nested_set_columns
+from users.models import CustomUser
+
+FAN_OUT = 5
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare insert and subtree-query cost of the nested_set and path storage modes on a "
+        "synthetic placement tree. Everything runs in a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, nargs='+', default=[100000, 1000000])
+        parser.add_argument('--inserts', type=int, default=200)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        self.stdout.write(f"{'nodes':>10} {'mode':>11} {'insert ms':>10} {'subtree ms':>11} {'rows/query':>11}")
+        for size in options['nodes']:
+            with transaction.atomic():
+                nodes = self.build_tree(size)
+                for mode in (NESTED_SET, PATH):
+                    random.seed(size)  # same parents and subtrees for both modes
+                    with transaction.atomic(), override_settings(MLMTREE_STORAGE=mode):
+                        insert_ms = self.time_inserts(nodes, options['inserts'])
+                        query_ms, rows = self.time_subtrees(nodes, options['queries'])
+                        transaction.set_rollback(True)
+                    self.stdout.write(f"{size:>10} {mode:>11} {insert_ms:>10.2f} {query_ms:>11.2f} {rows:>11.0f}")
+                transaction.set_rollback(True)
+
+    def create_users(self, count, prefix):
+        password = make_password(None)
+        users = [
+            CustomUser(email=f"{prefix}-{i}@benchmark.invalid", first_name='Bench', password=password)
+            for i in range(count)
+        ]
+        CustomUser.objects.bulk_create(users, batch_size=self.batch_size)
+        return users
+
+    def build_tree(self, size):
+        """Bulk write a complete 5-ary tree of ``size`` nodes with both nested-set and path columns."""
+        users = self.create_users(size, f"tree{size}")
+        children = defaultdict(list)
+        for index in range(1, size):
+            children[(index - 1) // FAN_OUT].append(index)
+        columns = {}
+        nested_set_columns(0, children, columns)
+        tree_id = (MLMTree.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+
+        nodes = [None] * size
+        level_indexes = [0]
+        while level_indexes:
+            batch = []
+            for index in level_indexes:
+                lft, rght, level = columns[index]
+                parent = nodes[(index - 1) // FAN_OUT] if index else None
+                path = (parent.path if parent else '') + encode_segment(users[index].pk)
+                nodes[index] = MLMTree(
+                    user_id=users[index].pk, parent=parent, tree_id=tree_id,
+                    lft=lft, rght=rght, level=level, path=path,
+                )
+                batch.append(nodes[index])
+            MLMTree.objects.bulk_create(batch, batch_size=self.batch_size)
+            level_indexes = [child for index in level_indexes for child in children[index]]
+        return nodes
+
+    def time_inserts(self, nodes, count):
+        users = self.create_users(count, f"insert{len(nodes)}")
+        parents = random.sample(nodes, min(count, len(nodes)))
+        started = time.perf_counter()
+        for user, parent in zip(users, parents):
+            MLMTree(user=user, parent=MLMTree.objects.get(pk=parent.pk)).save()
+        return (time.perf_counter() - started) * 1000 / len(parents)
+
+    def time_subtrees(self, nodes, count):
+        # Roots of subtrees a few levels down, like a typical leader's downline.
+        candidates = nodes[1:1 + FAN_OUT + FAN_OUT ** 2 + FAN_OUT ** 3] or nodes
+        picked = [random.choice(candidates) for _ in range(count)]
+        rows = 0
+        started = time.perf_counter()
+        for node in picked:
+            rows += len(MLMTree.objects.get(pk=node.pk).get_downline().values_list('pk', flat=True))
+        return (time.perf_counter() - started) * 1000 / count, rows / count
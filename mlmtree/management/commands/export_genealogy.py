@@ -0,0 +1,79 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mlmtree.exports import export_rows, stream_csv
+from mlmtree.models import MLMTree
+
+# How much of the output --resume reads at a time, from the end, to find the last row
+RESUME_BLOCK_SIZE = 64 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the genealogy report (member, unique_id, sponsor, placement parent, level, join date, "
+        "personal volume) as CSV, for one downline or the whole network, in constant memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', help="unique_id of the member whose downline is exported (defaults to everyone)")
+        parser.add_argument('--output', help="file to write, defaults to stdout")
+        parser.add_argument(
+            '--resume', action='store_true',
+            help="continue an interrupted export: append to --output behind its last complete row",
+        )
+
+    def _node(self, **lookup):
+        try:
+            return MLMTree.objects.get(**lookup)
+        except MLMTree.DoesNotExist:
+            raise CommandError(f"Member not found: {next(iter(lookup.values()))}")
+
+    def _last_member_id(self, path):
+        """member_id of the last complete row of ``path``; a cut-off last line is dropped.
+
+        Only the end of the file is read, block by block backwards, until the last
+        complete row is in hand, so resuming costs the same whatever was written.
+        """
+        with open(path, 'rb+') as handle:
+            position = handle.seek(0, os.SEEK_END)
+            tail = b''
+            while position and tail.count(b'\n') < 2:
+                step = min(RESUME_BLOCK_SIZE, position)
+                position -= step
+                handle.seek(position)
+                tail = handle.read(step) + tail
+            end = tail.rfind(b'\n')
+            handle.truncate(position + end + 1)
+        start = tail.rfind(b'\n', 0, max(end, 0))
+        if start < 0:
+            # Nothing or only the header is complete
+            return None
+        try:
+            return int(tail[start + 1:end].split(b',', 1)[0])
+        except ValueError:
+            raise CommandError(f"{path} does not end with an export row.")
+
+    def handle(self, *args, **options):
+        root = self._node(user__unique_id=options['root']) if options['root'] else None
+        after = None
+        output = options['output']
+        if options['resume']:
+            if not output:
+                raise CommandError("--resume needs --output.")
+            try:
+                last_id = self._last_member_id(output)
+            except FileNotFoundError:
+                last_id = None
+            after = self._node(user_id=last_id) if last_id else None
+
+        handle = open(output, 'a' if after else 'w', encoding='utf-8', newline='') if output else sys.stdout
+        try:
+            for chunk in stream_csv(export_rows(root, after), header=after is None):
+                handle.write(chunk)
+        finally:
+            if output:
+                handle.close()
+        if output:
+            self.stderr.write(self.style.SUCCESS(f"Wrote {output}."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mlmtree.layout import bump_tree_version
+from mlmtree.models import MLMTree
+from mlmtree.storage import build_paths, storage_mode
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild MLMTree materialized paths and/or MPTT nested-set columns from the parent links. "
+        "Run it after switching MLMTREE_STORAGE."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paths', action='store_true', help="only rebuild the path column")
+        parser.add_argument('--nested-set', action='store_true', help="only rebuild lft/rght/level/tree_id")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        both = not (options['paths'] or options['nested_set'])
+        batch_size = options['batch_size']
+
+        with transaction.atomic():
+            if both or options['paths']:
+                paths = build_paths(MLMTree.objects.values_list('id', 'parent_id', 'user_id').iterator())
+                nodes = [MLMTree(id=node_id, path=path) for node_id, path in paths.items()]
+                MLMTree.objects.bulk_update(nodes, ['path'], batch_size=batch_size)
+                self.stdout.write(f"Rebuilt {len(nodes)} paths.")
+            if both or options['nested_set']:
+                MLMTree.objects.rebuild(batch_size=batch_size)
+                self.stdout.write("Rebuilt nested-set columns.")
+            transaction.on_commit(bump_tree_version)
+
+        self.stdout.write(self.style.SUCCESS(f"MLM tree ready for '{storage_mode()}' storage."))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mlmtree.ranks import recompute_ranks
+from mlmtree.snapshots import load_snapshot
+
+
+class Command(BaseCommand):
+    help = "Requalify every member's rank in one pass, on the live tree or on a period snapshot."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--snapshot', help="name of a snapshot_genealogy snapshot to use instead of the live tree")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        snapshot = None
+        if options['snapshot']:
+            try:
+                snapshot = load_snapshot(options['snapshot'])
+            except FileNotFoundError:
+                raise CommandError(f"Unknown snapshot: {options['snapshot']}")
+        count = recompute_ranks(snapshot, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Updated the rank of {count} members."))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from mlmtree.commissions import run_commissions
+
+
+class Command(BaseCommand):
+    help = "Compute upline commissions for the orders of one period (YYYY-MM). Resumes an interrupted run."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--period', default=timezone.now().strftime('%Y-%m'))
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--rerun', action='store_true', help="Pick up orders added after the period was closed.")
+
+    def handle(self, *args, **options):
+        try:
+            run = run_commissions(options['period'], chunk_size=options['chunk_size'], rerun=options['rerun'])
+        except ValueError:
+            raise CommandError("Period must look like YYYY-MM.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Commission run {run.period}: {run.orders_processed} orders, {run.total_paid} paid."
+        ))
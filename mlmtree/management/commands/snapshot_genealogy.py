@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mlmtree.snapshots import diff_snapshots, list_snapshots, load_snapshot, take_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Freeze the placement and sponsor trees into a memory-mappable snapshot "
+        "(named after the current period by default), list snapshots, or diff two of them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', help="snapshot name, defaults to the current YYYY-MM")
+        parser.add_argument('--dir', help="snapshot directory, defaults to MLM_SNAPSHOT_DIR")
+        parser.add_argument('--list', action='store_true', help="list existing snapshots")
+        parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'), help="compare two snapshots")
+
+    def handle(self, *args, **options):
+        directory = options['dir']
+        if options['list']:
+            for name in list_snapshots(directory):
+                snapshot = load_snapshot(name, directory)
+                self.stdout.write(f"{name}\t{snapshot.meta['nodes']} nodes\t{snapshot.meta['taken_at']}")
+            return
+
+        if options['diff']:
+            try:
+                old, new = (load_snapshot(name, directory) for name in options['diff'])
+            except FileNotFoundError as exc:
+                raise CommandError(f"Unknown snapshot: {exc.filename}")
+            for key, user_ids in diff_snapshots(old, new).items():
+                sample = ', '.join(str(user_id) for user_id in user_ids[:10])
+                self.stdout.write(f"{key}: {len(user_ids)}" + (f" ({sample}{', ...' if len(user_ids) > 10 else ''})" if len(user_ids) else ""))
+            return
+
+        try:
+            path = take_snapshot(options['name'], directory)
+        except FileExistsError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS(f"Snapshot written to {path}"))
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.18 on 2026-10-18 09:35
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+# Frozen copies of mlmtree.storage.encode_segment/build_paths as of this
+# migration, so later changes to the path format cannot change what it writes.
+PATH_STEP = 7
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def encode_segment(user_id):
+    digits = []
+    while user_id:
+        user_id, remainder = divmod(user_id, 36)
+        digits.append(PATH_DIGITS[remainder])
+    return ''.join(reversed(digits)).rjust(PATH_STEP, '0')
+
+
+def build_paths(rows):
+    """Compute {node_id: path} from (node_id, parent_id, user_id) rows in one pass."""
+    children = defaultdict(list)
+    segments = {}
+    roots = []
+    for node_id, parent_id, user_id in rows:
+        segments[node_id] = encode_segment(user_id)
+        if parent_id is None:
+            roots.append(node_id)
+        else:
+            children[parent_id].append(node_id)
+
+    paths = {}
+    stack = [(node_id, '') for node_id in roots]
+    while stack:
+        node_id, prefix = stack.pop()
+        paths[node_id] = prefix + segments[node_id]
+        stack.extend((child_id, paths[node_id]) for child_id in children[node_id])
+    return paths
+
+
+def fill_paths(apps, schema_editor):
+    """Derive the materialized path of every existing node from its parent link."""
+    MLMTree = apps.get_model('mlmtree', 'MLMTree')
+    paths = build_paths(MLMTree.objects.values_list('id', 'parent_id', 'user_id').iterator())
+    nodes = [MLMTree(id=node_id, path=path) for node_id, path in paths.items()]
+    MLMTree.objects.bulk_update(nodes, ['path'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlmtree', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmtree',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.18 on 2026-10-18 09:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from mlmtree.stats import build_stats
+
+
+def fill_stats(apps, schema_editor):
+    """Compute the aggregates of every existing node."""
+    MLMTree = apps.get_model('mlmtree', 'MLMTree')
+    MLMNodeStats = apps.get_model('mlmtree', 'MLMNodeStats')
+    stats = build_stats(MLMTree.objects.values_list('id', 'parent_id').iterator())
+    MLMNodeStats.objects.bulk_create([
+        MLMNodeStats(
+            node_id=row.node_id, downline_size=row.downline_size,
+            direct_children=row.direct_children, level_counts=row.level_counts,
+        )
+        for row in stats
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlmtree', '0002_mlmtree_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MLMNodeStats',
+            fields=[
+                ('node', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='mlmtree.mlmtree')),
+                ('downline_size', models.PositiveIntegerField(default=0)),
+                ('direct_children', models.PositiveIntegerField(default=0)),
+                ('level_counts', models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                'verbose_name_plural': 'MLM node stats',
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
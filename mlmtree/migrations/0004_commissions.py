@@ -0,0 +1,47 @@
+# Generated by Django 4.2.18 on 2026-10-18 09:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cart', '0003_alter_order_email'),
+        ('mlmtree', '0003_mlmnodestats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommissionRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(max_length=7, unique=True)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('done', 'Done')], default='running', max_length=10)),
+                ('last_order_id', models.BigIntegerField(default=0)),
+                ('orders_processed', models.PositiveIntegerField(default=0)),
+                ('total_paid', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Commission',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('beneficiary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commissions', to=settings.AUTH_USER_MODEL)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commissions', to='cart.order')),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='commissions', to='mlmtree.commissionrun')),
+                ('source_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='commission',
+            constraint=models.UniqueConstraint(fields=('order', 'level'), name='unique_commission_per_order_level'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlmtree', '0004_commissions'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mlmtree',
+            index=models.Index(fields=['tree_id', 'lft'], name='mlmtree_tree_lft_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_customuser_search_indexes'),
+        ('mlmtree', '0005_mlmtree_tree_lft_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberRank',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='rank', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('rank', models.CharField(blank=True, max_length=50)),
+                ('personal_volume', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('group_volume', models.DecimalField(decimal_places=2, default=0, max_digits=16)),
+                ('direct_recruits', models.PositiveIntegerField(default=0)),
+                ('active_legs', models.PositiveSmallIntegerField(default=0)),
+                ('active_downline', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_level_counts(apps, schema_editor):
+    """One MLMLevelCount row per entry of the old level_counts lists."""
+    MLMNodeStats = apps.get_model('mlmtree', 'MLMNodeStats')
+    MLMLevelCount = apps.get_model('mlmtree', 'MLMLevelCount')
+    rows = []
+    for node_id, counts in MLMNodeStats.objects.values_list('node_id', 'level_counts').iterator():
+        rows.extend(
+            MLMLevelCount(node_id=node_id, depth=depth, members=members)
+            for depth, members in enumerate(counts or [], start=1) if members
+        )
+        if len(rows) >= 5000:
+            MLMLevelCount.objects.bulk_create(rows)
+            rows = []
+    MLMLevelCount.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mlmtree', '0006_memberrank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MLMLevelCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('members', models.PositiveIntegerField(default=0)),
+                ('node', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='level_counts', to='mlmtree.mlmtree')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='mlmlevelcount',
+            constraint=models.UniqueConstraint(fields=('node', 'depth'), name='mlm_level_count_node_depth'),
+        ),
+        migrations.RunPython(copy_level_counts, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='mlmnodestats',
+            name='level_counts',
+        ),
+    ]
@@ -1,24 +1,249 @@
+import functools
+
 from django.db import models
+from django.db.models import F, Value
+from django.db.models.functions import Concat, Substr
 from mptt.models import MPTTModel, TreeForeignKey
 from django.contrib.auth import get_user_model
 
+from .storage import encode_segment, path_level, path_user_ids, subtree_filter, uses_path_storage
+
 User = get_user_model()  # ✅ Fix: Avoid circular import
 
+
+def _nested_set_only(name):
+    """Wrap the MPTTModel method ``name`` so it refuses to run on stale nested-set columns."""
+    method = getattr(MPTTModel, name)
+
+    @functools.wraps(method)
+    def guarded(self, *args, **kwargs):
+        if uses_path_storage():
+            raise NotImplementedError(
+                f"MLMTree.{name}() reads lft/rght, which MLMTREE_STORAGE='path' does not maintain. "
+                "Run rebuild_mlmtree --nested-set and switch back to 'nested_set' to use it."
+            )
+        return method(self, *args, **kwargs)
+    return guarded
+
+
 class MLMTree(MPTTModel):
-    """Model to store MLM hierarchical structure using MPTT."""
+    """Model to store MLM hierarchical structure using MPTT.
+
+    With ``MLMTREE_STORAGE='path'`` the lft/rght/tree_id columns are not kept up
+    to date. These methods then answer from ``path`` and ``parent`` instead:
+    get_ancestors, get_descendants, get_descendant_count, get_children,
+    get_siblings, get_root, is_leaf_node, is_descendant_of and is_ancestor_of
+    (plus get_downline/get_upline, level and the admin changelist). get_family,
+    get_leafnodes, get_next_sibling, get_previous_sibling and move_to raise
+    NotImplementedError; set ``parent`` and save to move a node. Rebuilding
+    with ``rebuild_mlmtree --nested-set`` restores the columns in either mode.
+    """
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="mlm_tree")
     parent = TreeForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='children')
+    path = models.CharField(max_length=1024, blank=True, default='', db_index=True, editable=False)
 
     class MPTTMeta:
         order_insertion_by = ['user']
 
+    class Meta:
+        indexes = [
+            # Subtree range scans in tree order (downline search, exports)
+            models.Index(fields=['tree_id', 'lft'], name='mlmtree_tree_lft_idx'),
+        ]
+
     def __str__(self):
         return f"{self.user.first_name} {self.user.last_name} ({self.user.unique_id})"
 
+    def save(self, *args, **kwargs):
+        """Keep the materialized path in sync; in path storage mode skip the nested-set renumbering."""
+        old_path = self.path
+        parent_path = self.parent.path if self.parent_id else ''
+        self.path = parent_path + encode_segment(self.user_id)
+        moved = bool(old_path) and old_path != self.path
+        self._previous_path = old_path
+
+        if uses_path_storage():
+            self.level = path_level(self.path)
+            with MLMTree.objects.disable_mptt_updates():
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+
+        if moved:
+            self._rewrite_descendant_paths(old_path, self.path)
+
+    def delete(self, *args, **kwargs):
+        if not uses_path_storage():
+            return super().delete(*args, **kwargs)
+        # Children are detached (SET_NULL) and become roots of their own subtrees.
+        old_path = self.path
+        result = models.Model.delete(self, *args, **kwargs)
+        MLMTree.objects.filter(path__startswith=old_path).update(
+            path=Substr('path', len(old_path) + 1),
+            level=F('level') - (path_level(old_path) + 1),
+        )
+        return result
+
+    def _rewrite_descendant_paths(self, old_path, new_path):
+        descendants = MLMTree.objects.filter(path__startswith=old_path).exclude(pk=self.pk)
+        changes = {'path': Concat(Value(new_path), Substr('path', len(old_path) + 1))}
+        if uses_path_storage():
+            changes['level'] = F('level') + (path_level(new_path) - path_level(old_path))
+        descendants.update(**changes)
+
     def get_downline(self):
         """Returns all users under this user in the hierarchy."""
+        if uses_path_storage():
+            return MLMTree.objects.filter(path__startswith=self.path).exclude(pk=self.pk).order_by('path')
         return self.get_descendants()
 
     def get_upline(self):
         """Returns the chain of sponsors above this user."""
+        if uses_path_storage():
+            return MLMTree.objects.filter(user_id__in=path_user_ids(self.path)[:-1]).order_by('path')
         return self.get_ancestors()
+
+    # MPTT API in path storage mode, see the class docstring.
+
+    def get_ancestors(self, ascending=False, include_self=False):
+        if not uses_path_storage():
+            return super().get_ancestors(ascending=ascending, include_self=include_self)
+        user_ids = path_user_ids(self.path)
+        return MLMTree.objects.filter(user_id__in=user_ids if include_self else user_ids[:-1]).order_by(
+            '-path' if ascending else 'path'
+        )
+
+    def get_descendants(self, include_self=False):
+        if not uses_path_storage():
+            return super().get_descendants(include_self=include_self)
+        return MLMTree.objects.filter(subtree_filter(self, include_self=include_self)).order_by('path')
+
+    def get_descendant_count(self):
+        if not uses_path_storage():
+            return super().get_descendant_count()
+        return self.get_descendants().count()
+
+    def get_children(self):
+        if not uses_path_storage():
+            return super().get_children()
+        return MLMTree.objects.filter(parent=self).order_by('path')
+
+    def get_siblings(self, include_self=False):
+        if not uses_path_storage():
+            return super().get_siblings(include_self=include_self)
+        siblings = MLMTree.objects.filter(parent_id=self.parent_id).order_by('path')
+        return siblings if include_self else siblings.exclude(pk=self.pk)
+
+    def get_root(self):
+        if not uses_path_storage():
+            return super().get_root()
+        if self.parent_id is None:
+            return self
+        return MLMTree.objects.get(user_id=path_user_ids(self.path)[0])
+
+    def is_leaf_node(self):
+        if not uses_path_storage():
+            return super().is_leaf_node()
+        return not MLMTree.objects.filter(parent=self).exists()
+
+    def is_descendant_of(self, other, include_self=False):
+        if not uses_path_storage():
+            return super().is_descendant_of(other, include_self=include_self)
+        if self.pk == other.pk:
+            return include_self
+        return self.path.startswith(other.path)
+
+    def is_ancestor_of(self, other, include_self=False):
+        if not uses_path_storage():
+            return super().is_ancestor_of(other, include_self=include_self)
+        return other.is_descendant_of(self, include_self=include_self)
+
+    get_family = _nested_set_only('get_family')
+    get_leafnodes = _nested_set_only('get_leafnodes')
+    get_next_sibling = _nested_set_only('get_next_sibling')
+    get_previous_sibling = _nested_set_only('get_previous_sibling')
+    move_to = _nested_set_only('move_to')
+
+
+class MLMNodeStats(models.Model):
+    """Downline aggregates of one MLMTree node, maintained on insert, move and delete."""
+    node = models.OneToOneField(MLMTree, on_delete=models.CASCADE, primary_key=True, related_name="stats")
+    downline_size = models.PositiveIntegerField(default=0)
+    direct_children = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "MLM node stats"
+
+    def __str__(self):
+        return f"Stats for {self.node_id}"
+
+
+class MLMLevelCount(models.Model):
+    """Members ``depth`` levels below a node (1 = placed directly under it).
+
+    One row per node and level, so recording a signup is a plain increment on
+    each ancestor's row instead of rewriting a list.
+    """
+    node = models.ForeignKey(MLMTree, on_delete=models.CASCADE, related_name="level_counts")
+    depth = models.PositiveIntegerField()
+    members = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['node', 'depth'], name='mlm_level_count_node_depth')]
+
+    def __str__(self):
+        return f"Level {self.depth} of {self.node_id}: {self.members}"
+
+
+class MemberRank(models.Model):
+    """Rank of a member and the figures it was qualified on (see mlmtree.ranks)."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name="rank")
+    rank = models.CharField(max_length=50, blank=True)
+    personal_volume = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Sales of the member and everyone placed below them
+    group_volume = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+    direct_recruits = models.PositiveIntegerField(default=0)
+    active_legs = models.PositiveSmallIntegerField(default=0)
+    # Active members in the subtree, the member included; lets orders update active_legs incrementally
+    active_downline = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user_id}: {self.rank or 'Unranked'}"
+
+
+class CommissionRun(models.Model):
+    """One commission close per period; ``last_order_id`` is the resume cursor."""
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_CHOICES = [(STATUS_RUNNING, "Running"), (STATUS_DONE, "Done")]
+
+    period = models.CharField(max_length=7, unique=True)  # YYYY-MM
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    last_order_id = models.BigIntegerField(default=0)
+    orders_processed = models.PositiveIntegerField(default=0)
+    total_paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Commission run {self.period} ({self.status})"
+
+
+class Commission(models.Model):
+    """Ledger entry: what one upline member earns from one order."""
+    run = models.ForeignKey(CommissionRun, on_delete=models.CASCADE, related_name="commissions")
+    order = models.ForeignKey("cart.Order", on_delete=models.CASCADE, related_name="commissions")
+    beneficiary = models.ForeignKey(User, on_delete=models.CASCADE, related_name="commissions")
+    source_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="+")
+    level = models.PositiveSmallIntegerField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["order", "level"], name="unique_commission_per_order_level"),
+        ]
+
+    def __str__(self):
+        return f"Commission {self.amount} to {self.beneficiary_id} (order {self.order_id}, level {self.level})"
@@ -0,0 +1,181 @@
+"""Rank qualification over the whole network.
+
+``recompute_ranks`` loads the placement and sponsor trees as arrays (live, or
+from a period snapshot), sums personal sales per member with one GROUP BY on
+OrderItem and derives every figure with vectorized passes:
+
+    group volume     bottom-up roll-up of personal volume over the placement tree
+    active legs      direct placement children whose subtree has an active member
+    direct recruits  members sponsored directly
+
+Only rows whose figures changed are written. ``record_sale`` applies one sale
+to the seller's upline in O(depth), for use between full recomputes; ``queue_sale``
+defers it until the order has committed.
+"""
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from cart.models import OrderItem
+from .models import MemberRank, MLMTree
+from .snapshots import Snapshot
+from .storage import path_user_ids
+
+FIELDS = ('rank', 'personal_volume', 'group_volume', 'direct_recruits', 'active_legs', 'active_downline')
+
+
+def rank_rules():
+    return getattr(settings, 'MLM_RANKS', [])
+
+
+def active_volume_paise():
+    return int(Decimal(getattr(settings, 'MLM_ACTIVE_VOLUME', 0)) * 100)
+
+
+def qualify(direct_recruits, active_legs, group_volume_paise):
+    """Rank name for every member; the arguments are equally long arrays."""
+    names = np.array([''] + [rule['name'] for rule in rank_rules()], dtype=object)
+    ranks = np.zeros(len(direct_recruits), dtype=np.int64)
+    for position, rule in enumerate(rank_rules(), start=1):
+        meets = (
+            (direct_recruits >= rule.get('direct_recruits', 0))
+            & (active_legs >= rule.get('active_legs', 0))
+            & (group_volume_paise >= int(Decimal(rule.get('group_volume', 0)) * 100))
+        )
+        ranks[meets] = position
+    return names[ranks]
+
+
+def personal_volumes(snapshot):
+    """Personal sales of every snapshot member, in paise, up to the moment the snapshot was taken."""
+    items = OrderItem.objects.order_by()
+    if snapshot.taken_at is not None:
+        items = items.filter(order__date_ordered__lte=snapshot.taken_at)
+    totals = (
+        items.values('user_id')
+        .annotate(total=Sum(F('price') * F('quantity')))
+        .values_list('user_id', 'total')
+    )
+    volumes = np.zeros(len(snapshot), dtype=np.int64)
+    rows = [(user_id, int(total * 100)) for user_id, total in totals if total]
+    if rows:
+        user_ids, paise = (np.array(column, dtype=np.int64) for column in zip(*rows))
+        positions = snapshot.index_of(user_ids)
+        known = positions >= 0
+        volumes[positions[known]] = paise[known]
+    return volumes
+
+
+def compute_figures(snapshot, volumes):
+    """All rank inputs and the resulting rank, as arrays aligned with ``snapshot.node_id``."""
+    parent = np.asarray(snapshot.parent)
+    sponsor = np.asarray(snapshot.sponsor)
+    size = len(snapshot)
+
+    group_volume = snapshot.roll_up(volumes)
+    active = (volumes >= active_volume_paise()) & (volumes > 0)
+    active_downline = snapshot.roll_up(active.astype(np.int64))
+    legs = np.flatnonzero((parent >= 0) & (active_downline > 0))
+    active_legs = np.bincount(parent[legs], minlength=size)
+    direct_recruits = np.bincount(sponsor[sponsor >= 0], minlength=size)
+
+    return {
+        'rank': qualify(direct_recruits, active_legs, group_volume),
+        'personal_volume': volumes,
+        'group_volume': group_volume,
+        'direct_recruits': direct_recruits,
+        'active_legs': active_legs,
+        'active_downline': active_downline,
+    }
+
+
+def _paise(value):
+    return int(value * 100)
+
+
+def recompute_ranks(snapshot=None, batch_size=5000):
+    """Recompute and store every member's rank; returns the number of rows written."""
+    snapshot = snapshot or Snapshot.live()
+    figures = compute_figures(snapshot, personal_volumes(snapshot))
+
+    stored = {
+        user_id: (rank, _paise(personal), _paise(group), direct, legs, active)
+        for user_id, rank, personal, group, direct, legs, active in
+        MemberRank.objects.values_list('user_id', *FIELDS).iterator(chunk_size=batch_size)
+    }
+    columns = [figures[field].tolist() for field in FIELDS]
+    changed = []
+    for user_id, *values in zip(np.asarray(snapshot.node_id).tolist(), *columns):
+        if stored.get(user_id) != tuple(values):
+            rank, personal, group, direct, legs, active = values
+            changed.append(MemberRank(
+                user_id=user_id, rank=rank,
+                personal_volume=Decimal(personal) / 100, group_volume=Decimal(group) / 100,
+                direct_recruits=direct, active_legs=legs, active_downline=active,
+            ))
+
+    with transaction.atomic():
+        MemberRank.objects.bulk_create(
+            changed, batch_size=batch_size, update_conflicts=True,
+            unique_fields=['user'], update_fields=[*FIELDS, 'updated_at'],
+        )
+    return len(changed)
+
+
+def record_sale(user_id, amount):
+    """Add one sale of ``amount`` rupees by ``user_id`` and requalify the seller's upline."""
+    path = MLMTree.objects.filter(user_id=user_id).values_list('path', flat=True).first()
+    if not path or not amount:
+        return
+    chain = path_user_ids(path)  # root first, seller last
+    amount = Decimal(amount)
+
+    with transaction.atomic():
+        missing = set(chain) - set(MemberRank.objects.filter(user_id__in=chain).values_list('user_id', flat=True))
+        if missing:
+            MemberRank.objects.bulk_create([MemberRank(user_id=member) for member in missing], ignore_conflicts=True)
+        # Always lock in primary key order, so two sales in overlapping uplines cannot deadlock.
+        locked = MemberRank.objects.select_for_update().filter(user_id__in=chain).order_by('pk')
+        rows = {row.user_id: row for row in locked}
+        members = [rows[member] for member in chain if member in rows]
+
+        seller = rows[chain[-1]]
+        threshold = Decimal(active_volume_paise()) / 100
+        was_active = seller.personal_volume >= threshold and seller.personal_volume > 0
+        seller.personal_volume += amount
+        becomes_active = not was_active and seller.personal_volume >= threshold
+
+        for member in members:
+            member.group_volume += amount
+        if becomes_active:
+            for member in members:
+                member.active_downline += 1
+            # A leg turns active when the first active member appears in it.
+            for upper, lower in zip(members, members[1:]):
+                if lower.active_downline == 1:
+                    upper.active_legs += 1
+
+        ranks = qualify(
+            np.array([member.direct_recruits for member in members]),
+            np.array([member.active_legs for member in members]),
+            np.array([_paise(member.group_volume) for member in members]),
+        )
+        now = timezone.now()
+        for member, rank in zip(members, ranks):
+            member.rank = rank
+            member.updated_at = now
+        MemberRank.objects.bulk_update(members, [*FIELDS, 'updated_at'])
+
+
+def queue_sale(user_id, amount):
+    """Record the sale once the surrounding transaction commits.
+
+    The upline rows are then locked only for the short ``record_sale`` transaction
+    instead of for the rest of the checkout, so sales do not queue behind each
+    other's orders on the top members' rows.
+    """
+    transaction.on_commit(lambda: record_sale(user_id, amount))
@@ -1,18 +1,32 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
+from .layout import bump_tree_version
 from .models import MLMTree
-from users.models import CustomUser
+from .ranks import queue_sale
+from .stats import record_delete, record_insert, record_move
+from cart.models import OrderItem
 
-@receiver(post_save, sender=CustomUser)
-def create_mlm_tree(sender, instance, created, **kwargs):
-    """Automatically create MLMTree node when a user is created."""
-    if created and not MLMTree.objects.filter(user=instance).exists():
-        parent_tree = None
+@receiver(post_save, sender=MLMTree)
+def update_downline_stats(sender, instance, created, **kwargs):
+    """Keep the downline aggregates of the node's upline in step with inserts and moves."""
+    if created:
+        record_insert(instance)
+    elif getattr(instance, '_previous_path', '') and instance._previous_path != instance.path:
+        record_move(instance, instance._previous_path)
 
-        if instance.parent_node:
-            try:
-                parent_tree = MLMTree.objects.get(user=instance.parent_node)
-            except MLMTree.DoesNotExist:
-                pass
+@receiver(pre_delete, sender=MLMTree)
+def remove_downline_stats(sender, instance, **kwargs):
+    """Take the node's subtree out of its upline's aggregates; detached children keep their own."""
+    record_delete(instance)
 
-        MLMTree.objects.create(user=instance, parent=parent_tree)
+@receiver(post_save, sender=MLMTree)
+@receiver(post_delete, sender=MLMTree)
+def invalidate_tree_layout(sender, instance, **kwargs):
+    """Any structural change starts a new tree version, so cached layouts are recomputed."""
+    bump_tree_version()
+
+@receiver(post_save, sender=OrderItem)
+def requalify_upline(sender, instance, created, **kwargs):
+    """Add a new sale to the seller's upline volumes and ranks, after the order commits."""
+    if created:
+        queue_sale(instance.user_id, instance.price * instance.quantity)
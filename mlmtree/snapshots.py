@@ -0,0 +1,192 @@
+"""Point-in-time genealogy snapshots for period closing.
+
+A snapshot is a directory of four parallel NumPy arrays, one entry per member
+and sorted by user id:
+
+    node_id.npy   int64  user id
+    parent.npy    int32  index of the placement parent, -1 for roots
+    sponsor.npy   int32  index of the sponsor, -1 for none
+    level.npy     int32  placement depth
+
+plus ``meta.json``. The arrays are plain ``.npy`` files, so ``load_snapshot``
+memory-maps them and analysis jobs read the frozen tree without touching the
+database. Because every snapshot is sorted by user id, two snapshots can be
+diffed with a merge on ``node_id``.
+"""
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from .models import MLMTree
+
+ARRAYS = ('node_id', 'parent', 'sponsor', 'level')
+
+
+def snapshot_dir():
+    return Path(getattr(settings, 'MLM_SNAPSHOT_DIR', Path(settings.BASE_DIR) / 'snapshots'))
+
+
+def _indices(node_ids, targets):
+    """Positions of ``targets`` in the sorted ``node_ids``, -1 where absent or null."""
+    positions = np.searchsorted(node_ids, targets)
+    positions[positions >= len(node_ids)] = 0
+    found = (targets > 0) & (node_ids[positions] == targets) if len(node_ids) else np.zeros(len(targets), bool)
+    return np.where(found, positions, -1).astype(np.int32)
+
+
+def build_arrays(rows):
+    """Turn (user_id, parent_user_id, sponsor_id, level) rows into the snapshot arrays."""
+    data = np.array(
+        [(user_id, parent or 0, sponsor or 0, level) for user_id, parent, sponsor, level in rows],
+        dtype=np.int64,
+    ).reshape(-1, 4)
+    data = data[np.argsort(data[:, 0], kind='stable')]
+    node_ids = data[:, 0].copy()
+    return {
+        'node_id': node_ids,
+        'parent': _indices(node_ids, data[:, 1]),
+        'sponsor': _indices(node_ids, data[:, 2]),
+        'level': data[:, 3].astype(np.int32),
+    }
+
+
+def _tree_rows():
+    return MLMTree.objects.values_list(
+        'user_id', 'parent__user_id', 'user__parent_sponsor_id', 'level'
+    ).iterator(chunk_size=5000)
+
+
+def take_snapshot(name=None, directory=None):
+    """Freeze placement and sponsor structure into ``<directory>/<name>/``.
+
+    The tree is read by a single query, so the snapshot is consistent even
+    while signups keep changing the live tree.
+    """
+    name = name or timezone.now().strftime('%Y-%m')
+    target = Path(directory or snapshot_dir()) / name
+    if target.exists():
+        raise FileExistsError(f"Snapshot {name} already exists at {target}")
+
+    arrays = build_arrays(_tree_rows())
+
+    # Write next to the final location and rename, so readers never see half a snapshot.
+    partial = target.with_name(f".{name}.partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    partial.mkdir(parents=True)
+    for key in ARRAYS:
+        np.save(partial / f"{key}.npy", arrays[key])
+    meta = {'name': name, 'taken_at': timezone.now().isoformat(), 'nodes': int(len(arrays['node_id']))}
+    (partial / 'meta.json').write_text(json.dumps(meta))
+    os.replace(partial, target)
+    return target
+
+
+class Snapshot:
+    """The four tree arrays, memory-mapped from disk or built from the live tree."""
+
+    def __init__(self, arrays, meta=None, path=None):
+        self.path = path
+        self.meta = meta or {}
+        for key in ARRAYS:
+            setattr(self, key, arrays[key])
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        path = Path(path)
+        arrays = {key: np.load(path / f"{key}.npy", mmap_mode=mmap_mode) for key in ARRAYS}
+        return cls(arrays, json.loads((path / 'meta.json').read_text()), path)
+
+    @classmethod
+    def live(cls):
+        """Build the arrays from the current tree, without writing them anywhere."""
+        return cls(build_arrays(_tree_rows()))
+
+    @property
+    def taken_at(self):
+        """When the snapshot was taken, None for the live tree."""
+        taken_at = self.meta.get('taken_at')
+        return datetime.fromisoformat(taken_at) if taken_at else None
+
+    def __len__(self):
+        return len(self.node_id)
+
+    def index_of(self, user_ids):
+        """Array positions of ``user_ids`` (-1 for members not in the snapshot)."""
+        return _indices(np.asarray(self.node_id), np.asarray(user_ids, dtype=np.int64))
+
+    def depths(self, relation='parent'):
+        """Depth of every node in the placement (stored) or sponsor (computed) tree."""
+        if relation == 'parent':
+            return np.asarray(self.level, dtype=np.int64)
+        return tree_depths(self.sponsor)
+
+    def roll_up(self, values, relation='parent'):
+        """Sum ``values`` over every subtree of the placement or sponsor tree, node included."""
+        links = np.asarray(getattr(self, relation))
+        values = np.asarray(values)
+        totals = values.astype(np.int64 if np.issubdtype(values.dtype, np.integer) else np.float64)
+        depths = self.depths(relation)
+        order = np.argsort(-depths, kind='stable')
+        sorted_depths = -depths[order]
+        bounds = np.flatnonzero(np.diff(sorted_depths)) + 1
+        # Deepest level first, so every level only adds finished subtotals to its parents.
+        for members in np.split(order, bounds):
+            members = members[links[members] >= 0]
+            np.add.at(totals, links[members], totals[members])
+        return totals
+
+    def downline_sizes(self, relation='parent'):
+        """Members below each node, the node itself not counted."""
+        return self.roll_up(np.ones(len(self), dtype=np.int64), relation) - 1
+
+
+def tree_depths(links):
+    """Depth of every node from parent-index links, by pointer jumping (O(log depth) passes)."""
+    links = np.asarray(links)
+    depth = (links >= 0).astype(np.int64)
+    ancestor = links.astype(np.int64)
+    while True:
+        active = np.flatnonzero(ancestor >= 0)
+        if not len(active):
+            return depth
+        targets = ancestor[active]
+        # Both updates read the values of the previous round.
+        depth[active], ancestor[active] = depth[active] + depth[targets], ancestor[targets]
+
+
+def load_snapshot(name, directory=None, mmap_mode='r'):
+    return Snapshot.load(Path(directory or snapshot_dir()) / name, mmap_mode=mmap_mode)
+
+
+def list_snapshots(directory=None):
+    directory = Path(directory or snapshot_dir())
+    if not directory.exists():
+        return []
+    return sorted(path.name for path in directory.iterdir() if (path / 'meta.json').exists())
+
+
+def diff_snapshots(old, new):
+    """Compare two snapshots by user id.
+
+    Returns arrays of user ids: ``added``, ``removed``, ``moved`` (placement parent
+    changed) and ``responsored`` (sponsor changed).
+    """
+    old_ids, new_ids = np.asarray(old.node_id), np.asarray(new.node_id)
+    common, old_pos, new_pos = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+
+    def linked_ids(snapshot, links, positions):
+        links = np.asarray(links)[positions]
+        return np.where(links >= 0, np.asarray(snapshot.node_id)[np.maximum(links, 0)], 0)
+
+    return {
+        'added': np.setdiff1d(new_ids, old_ids, assume_unique=True),
+        'removed': np.setdiff1d(old_ids, new_ids, assume_unique=True),
+        'moved': common[linked_ids(old, old.parent, old_pos) != linked_ids(new, new.parent, new_pos)],
+        'responsored': common[linked_ids(old, old.sponsor, old_pos) != linked_ids(new, new.sponsor, new_pos)],
+    }
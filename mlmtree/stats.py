@@ -0,0 +1,137 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from .models import MLMLevelCount, MLMNodeStats, MLMTree
+from .storage import path_user_ids
+
+
+def level_counts(node_id):
+    """Members per level below the MLMTree node ``node_id``, nearest level first."""
+    return list(
+        MLMLevelCount.objects.filter(node_id=node_id, members__gt=0)
+        .order_by('depth').values_list('members', flat=True)
+    )
+
+
+def _subtree_profile(node):
+    """Return members per relative level of ``node``'s subtree, the node itself first."""
+    return [1] + level_counts(node.pk)
+
+
+def _shifted(field, amount):
+    """``field`` + ``amount`` as an SQL expression, never going below zero."""
+    return F(field) + amount if amount >= 0 else Greatest(F(field) + amount, 0)
+
+
+def _apply(ancestor_user_ids, profile, sign):
+    """Add (or remove) a subtree with the given level profile below a chain of ancestors.
+
+    Every figure is changed by an UPDATE with an F() expression, so nothing is
+    read and locked beforehand and concurrent signups under the same upline
+    do not queue behind a locking read of the whole chain. The subtree's top
+    sits at level ``len(ancestor_user_ids)``, so it is ``that - ancestor level``
+    levels below each ancestor.
+    """
+    if not ancestor_user_ids:
+        return
+    top = len(ancestor_user_ids)
+    ancestors = MLMTree.objects.filter(user_id__in=ancestor_user_ids)
+    with transaction.atomic():
+        MLMNodeStats.objects.filter(node__in=ancestors).update(
+            downline_size=_shifted('downline_size', sign * sum(profile))
+        )
+        MLMNodeStats.objects.filter(node__user_id=ancestor_user_ids[-1]).update(
+            direct_children=_shifted('direct_children', sign)
+        )
+        for offset, members in enumerate(profile):
+            rows = MLMLevelCount.objects.filter(node__in=ancestors, depth=top + offset - F('node__level'))
+            updated = rows.update(members=_shifted('members', sign * members))
+            if sign > 0 and updated < top:
+                # First member this deep below some ancestors: add their rows, then count them.
+                have = set(rows.values_list('node_id', flat=True))
+                new = [
+                    MLMLevelCount(node_id=node_id, depth=top + offset - level)
+                    for node_id, level in ancestors.values_list('id', 'level') if node_id not in have
+                ]
+                MLMLevelCount.objects.bulk_create(new, ignore_conflicts=True)
+                rows.filter(node_id__in=[row.node_id for row in new]).update(members=F('members') + members)
+
+
+def record_insert(node):
+    MLMNodeStats.objects.create(node=node)
+    _apply(path_user_ids(node.path)[:-1], [1], +1)
+
+
+def record_move(node, old_path):
+    profile = _subtree_profile(node)
+    _apply(path_user_ids(old_path)[:-1], profile, -1)
+    _apply(path_user_ids(node.path)[:-1], profile, +1)
+
+
+def record_delete(node):
+    _apply(path_user_ids(node.path)[:-1], _subtree_profile(node), -1)
+
+
+def build_stats(rows):
+    """Compute MLMNodeStats records from (node_id, parent_id) rows in one bottom-up pass.
+
+    Each record carries its members per level as a ``level_counts`` list.
+    """
+    ids = set()
+    children = defaultdict(list)
+    roots = []
+    for node_id, parent_id in rows:
+        ids.add(node_id)
+        if parent_id is None:
+            roots.append(node_id)
+        else:
+            children[parent_id].append(node_id)
+
+    order = []
+    stack = list(roots)
+    while stack:
+        node_id = stack.pop()
+        order.append(node_id)
+        stack.extend(children[node_id])
+
+    counts = {}
+    stats = []
+    for node_id in reversed(order):
+        level_counts = []
+        for child_id in children[node_id]:
+            child_counts = [1] + counts.pop(child_id)
+            if len(level_counts) < len(child_counts):
+                level_counts.extend([0] * (len(child_counts) - len(level_counts)))
+            for depth, members in enumerate(child_counts):
+                level_counts[depth] += members
+        counts[node_id] = level_counts
+        row = MLMNodeStats(
+            node_id=node_id,
+            downline_size=sum(level_counts),
+            direct_children=len(children[node_id]),
+        )
+        row.level_counts = level_counts
+        stats.append(row)
+    return stats
+
+
+def build_level_counts(stats):
+    """MLMLevelCount rows for the records of ``build_stats``."""
+    return [
+        MLMLevelCount(node_id=row.node_id, depth=depth, members=members)
+        for row in stats for depth, members in enumerate(row.level_counts, start=1)
+    ]
+
+
+def rebuild_stats(batch_size=1000):
+    """Recompute the aggregates of every node from the parent links."""
+    stats = build_stats(MLMTree.objects.values_list('id', 'parent_id').iterator())
+    with transaction.atomic():
+        MLMLevelCount.objects.all().delete()
+        MLMNodeStats.objects.all().delete()
+        MLMNodeStats.objects.bulk_create(stats, batch_size=batch_size)
+        MLMLevelCount.objects.bulk_create(build_level_counts(stats), batch_size=batch_size)
+    return len(stats)
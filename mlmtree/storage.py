@@ -0,0 +1,114 @@
+"""Storage modes for the MLMTree hierarchy.
+
+``nested_set`` (default) keeps MPTT's lft/rght columns up to date on every
+write. ``path`` only appends a materialized path on insert, which costs
+O(depth) instead of renumbering the tree; subtree and upline reads then go
+through the ``path`` column, and lft/rght/tree_id go stale (``MLMTree`` lists
+which MPTT methods still work). Select the mode with ``MLMTREE_STORAGE``.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Q
+
+NESTED_SET = 'nested_set'
+PATH = 'path'
+
+# Every level of a path is the user id in fixed width base 36, so sorting by
+# path gives the same pre-order as lft with siblings ordered by user.
+PATH_STEP = 7
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def storage_mode():
+    return getattr(settings, 'MLMTREE_STORAGE', NESTED_SET)
+
+
+def uses_path_storage():
+    return storage_mode() == PATH
+
+
+def encode_segment(user_id):
+    digits = []
+    while user_id:
+        user_id, remainder = divmod(user_id, 36)
+        digits.append(PATH_DIGITS[remainder])
+    return ''.join(reversed(digits)).rjust(PATH_STEP, '0')
+
+
+def path_user_ids(path):
+    """Return the user ids along ``path``, root first."""
+    return [int(path[i:i + PATH_STEP], 36) for i in range(0, len(path), PATH_STEP)]
+
+
+def path_level(path):
+    return len(path) // PATH_STEP - 1
+
+
+def subtree_filter(node, include_self=True):
+    """Return a Q matching ``node``'s subtree for the active storage mode.
+
+    Both variants are a single range scan of an index that is already in tree
+    order: (tree_id, lft) for nested sets, ``path`` for materialized paths.
+    The path prefix stays a plain LIKE 'prefix%': on PostgreSQL the
+    varchar_pattern_ops index Django adds next to ``db_index`` serves it
+    whatever the database collation, which a hand-made upper bound cannot rely on.
+    """
+    if uses_path_storage():
+        query = Q(path__startswith=node.path)
+    elif include_self:
+        query = Q(tree_id=node.tree_id, lft__gte=node.lft, lft__lt=node.rght)
+    else:
+        return Q(tree_id=node.tree_id, lft__gt=node.lft, lft__lt=node.rght)
+    return query if include_self else query & ~Q(pk=node.pk)
+
+
+def subtree_contains(node, tree_id, lft, path):
+    """In-memory counterpart of ``subtree_filter(node, include_self=False)``."""
+    if uses_path_storage():
+        return path.startswith(node.path) and path != node.path
+    return tree_id == node.tree_id and node.lft < lft < node.rght
+
+
+def tree_ordering():
+    """Return the ordering that lists every node right after its parent."""
+    return ('path',) if uses_path_storage() else ('tree_id', 'lft')
+
+
+def build_paths(rows):
+    """Compute {node_id: path} from (node_id, parent_id, user_id) rows in one pass."""
+    children = defaultdict(list)
+    segments = {}
+    roots = []
+    for node_id, parent_id, user_id in rows:
+        segments[node_id] = encode_segment(user_id)
+        if parent_id is None:
+            roots.append(node_id)
+        else:
+            children[parent_id].append(node_id)
+
+    paths = {}
+    stack = [(node_id, '') for node_id in roots]
+    while stack:
+        node_id, prefix = stack.pop()
+        paths[node_id] = prefix + segments[node_id]
+        stack.extend((child_id, paths[node_id]) for child_id in children[node_id])
+    return paths
+
+
+def nested_set_columns(root, children, columns, left=1, level=0):
+    """Number ``root``'s subtree into ``columns`` as {key: (lft, rght, level)}, return the next free value."""
+    counter = left
+    stack = [(root, level, False)]
+    while stack:
+        key, depth, done = stack.pop()
+        if done:
+            columns[key] = (columns[key][0], counter, depth)
+            counter += 1
+            continue
+        columns[key] = (counter, None, depth)
+        counter += 1
+        stack.append((key, depth, True))
+        for child in reversed(children[key]):
+            stack.append((child, depth + 1, False))
+    return counter
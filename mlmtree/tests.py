@@ -1,3 +1,469 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from cart.models import Order, OrderItem
+from store.models import Product
+from users.models import CustomUser
+from .commissions import _process_chunk, commission_rates, run_commissions
+from .models import Commission, CommissionRun, MemberRank, MLMNodeStats, MLMTree
+from .ranks import recompute_ranks
+from .snapshots import Snapshot, diff_snapshots, take_snapshot
+from .stats import level_counts, rebuild_stats
+from .storage import NESTED_SET, PATH
+
+
+class DownlineStatsTests(TestCase):
+    """Stats kept up on every change must equal a full recount."""
+
+    def figures(self):
+        return {
+            row.node_id: (row.downline_size, row.direct_children, level_counts(row.node_id))
+            for row in MLMNodeStats.objects.all()
+        }
+
+    def assert_matches_rebuild(self):
+        kept = self.figures()
+        rebuild_stats()
+        self.assertEqual(kept, self.figures())
+
+    def test_inserts_moves_and_deletes(self):
+        company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        members = [CustomUser.objects.create_user(f'm{i}@example.com', 'pw') for i in range(9)]
+        for i in range(6):
+            CustomUser.objects.create_user(f'd{i}@example.com', 'pw', parent_sponsor=members[0])
+        self.assertEqual(MLMNodeStats.objects.get(node__user=company).downline_size, 15)
+        self.assert_matches_rebuild()
+
+        node = MLMTree.objects.get(user=members[0])
+        node.parent = MLMTree.objects.get(user=members[4])
+        node.save()
+        self.assert_matches_rebuild()
+
+        MLMTree.objects.get(user=members[3]).delete()
+        self.assert_matches_rebuild()
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PathStorageTests(TestCase):
+    """In path storage mode the MPTT API answers from paths, as the nested set would after a rebuild."""
+
+    def setUp(self):
+        with self.settings(MLMTREE_STORAGE=PATH):
+            company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+            for i in range(14):
+                CustomUser.objects.create_user(f'm{i}@example.com', 'pw')
+            CustomUser.objects.create_user('deep@example.com', 'pw', parent_node=CustomUser.objects.get(email='m7@example.com'))
+        self.company = company
+
+    def answers(self):
+        answers = {}
+        for node in MLMTree.objects.order_by('pk'):
+            answers[node.user.email] = (
+                list(node.get_descendants().values_list('pk', flat=True)),
+                list(node.get_descendants(include_self=True).values_list('pk', flat=True)),
+                list(node.get_ancestors().values_list('pk', flat=True)),
+                list(node.get_ancestors(ascending=True, include_self=True).values_list('pk', flat=True)),
+                list(node.get_children().values_list('pk', flat=True)),
+                list(node.get_siblings().values_list('pk', flat=True)),
+                node.get_descendant_count(),
+                node.get_root().pk,
+                node.is_leaf_node(),
+                node.get_level(),
+            )
+        return answers
+
+    def test_answers_match_the_rebuilt_nested_set(self):
+        with self.settings(MLMTREE_STORAGE=PATH):
+            from_paths = self.answers()
+            deep = MLMTree.objects.get(user__email='deep@example.com')
+            top = MLMTree.objects.get(user=self.company)
+            self.assertTrue(deep.is_descendant_of(top))
+            self.assertTrue(top.is_ancestor_of(deep))
+            self.assertFalse(top.is_descendant_of(deep))
+        call_command('rebuild_mlmtree', '--nested-set', stdout=open(os.devnull, 'w'))
+        with self.settings(MLMTREE_STORAGE=NESTED_SET):
+            self.assertEqual(from_paths, self.answers())
+
+    def test_nested_set_only_methods_refuse(self):
+        with self.settings(MLMTREE_STORAGE=PATH):
+            node = MLMTree.objects.get(user=self.company)
+            with self.assertRaisesMessage(NotImplementedError, "get_next_sibling"):
+                node.get_next_sibling()
+            with self.assertRaises(NotImplementedError):
+                node.move_to(MLMTree.objects.get(user__email='m0@example.com'))
+
+    def test_admin_changelist(self):
+        self.client.force_login(self.company)
+        with self.settings(MLMTREE_STORAGE=PATH):
+            response = self.client.get(reverse('admin:mlmtree_mlmtree_changelist'))
+        self.assertContains(response, 'deep@example.com')
+
+
+class DownlineStatsViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.member = CustomUser.objects.create_user('member@example.com', 'pw')
+        cls.other = CustomUser.objects.create_user('other@example.com', 'pw', parent_sponsor=cls.member)
+        cls.url = reverse('get_downline_stats')
+
+    def test_anonymous_request_is_refused(self):
+        response = self.client.get(self.url, {'root': self.member.pk})
+        self.assertEqual(response.status_code, 403)
+
+    def test_member_only_sees_own_figures(self):
+        self.client.force_login(self.other)
+        response = self.client.get(self.url, {'root': self.member.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['id'], self.other.pk)
+
+    def test_staff_may_pick_the_root(self):
+        self.client.force_login(self.company)
+        response = self.client.get(self.url, {'root': self.member.pk})
+        self.assertEqual(response.json()['id'], self.member.pk)
+        self.assertEqual(response.json()['downline_size'], 1)
+        self.assertEqual(self.client.get(self.url, {'root': 'x'}).status_code, 404)
+
+
+class SearchDownlineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.member = CustomUser.objects.create_user('member@example.com', 'pw', first_name='Mia', last_name='Lund')
+        sponsor = {'parent_sponsor': cls.member}
+        cls.anna = CustomUser.objects.create_user('anna@example.com', 'pw', first_name='Anna', last_name='Berg', **sponsor)
+        cls.annika = CustomUser.objects.create_user('annika@example.com', 'pw', first_name='Annika', last_name='Ström', **sponsor)
+        cls.bo = CustomUser.objects.create_user('bo@example.com', 'pw', first_name='Bo', last_name='Anand', **sponsor)
+        # Same names outside the member's downline
+        CustomUser.objects.create_user('ann@example.com', 'pw', first_name='Ann', last_name='Berg')
+        cls.url = reverse('search_downline')
+
+    def search(self, q, **params):
+        return [hit['id'] for hit in self.client.get(self.url, {'q': q, **params}).json()['results']]
+
+    def assert_searches(self):
+        self.client.force_login(self.member)
+        self.assertEqual(sorted(self.search('an')), sorted([self.anna.pk, self.annika.pk, self.bo.pk]))
+        self.assertEqual(self.search('ANNI'), [self.annika.pk])
+        self.assertEqual(self.search('anna berg'), [self.anna.pk])
+        self.assertEqual(self.search('Bo@EX'), [self.bo.pk])
+        self.assertEqual(self.search(self.annika.unique_id.lower()), [self.annika.pk])
+        self.assertEqual(self.search('nna'), [])
+        self.assertEqual(self.search('mia'), [])
+        # A member cannot widen the search; staff can
+        self.assertNotIn(self.company.pk, self.search('ann', root=self.company.pk))
+        self.client.force_login(self.company)
+        self.assertEqual(len(self.search('berg')), 2)
+        self.assertEqual(self.search('berg', root=self.member.pk), [self.anna.pk])
+
+    def test_prefix_search_by_candidates(self):
+        self.assert_searches()
+
+    def test_prefix_search_by_subtree_walk(self):
+        with mock.patch('mlmtree.views.SEARCH_CANDIDATE_LIMIT', 0):
+            self.assert_searches()
+
+    def test_prefix_search_in_path_storage(self):
+        with self.settings(MLMTREE_STORAGE=PATH), mock.patch('mlmtree.views.SEARCH_CANDIDATE_LIMIT', 0):
+            self.assert_searches()
+
+    def test_anonymous_request_is_refused(self):
+        self.assertEqual(self.client.get(self.url, {'q': 'ann'}).status_code, 403)
+
+
+class TreeViewAccessTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.member = CustomUser.objects.create_user('member@example.com', 'pw')
+        cls.other = CustomUser.objects.create_user('other@example.com', 'pw', parent_sponsor=cls.member)
+        cls.urls = [reverse(name) for name in ('get_mlm_subtree', 'get_tree_layout')]
+
+    def test_anonymous_request_is_refused(self):
+        for url in [*self.urls, reverse('get_mlm_tree')]:
+            self.assertEqual(self.client.get(url, {'root': self.member.pk}).status_code, 403)
+        self.assertEqual(self.client.get(reverse('mlm_tree_view')).status_code, 302)
+
+    def test_member_only_sees_own_downline(self):
+        self.client.force_login(self.member)
+        subtree = self.client.get(self.urls[0]).json()
+        self.assertEqual((subtree['id'], [child['id'] for child in subtree['children']]), (self.member.pk, [self.other.pk]))
+        layout = self.client.get(self.urls[1], {'format': 'json'}).json()
+        self.assertEqual(sorted(layout['ids']), [self.member.pk, self.other.pk])
+        self.assertEqual(self.client.get(self.urls[0], {'root': self.other.pk}).json()['id'], self.other.pk)
+
+        self.client.force_login(self.other)
+        for url in self.urls:
+            self.assertEqual(self.client.get(url, {'root': self.member.pk}).status_code, 404)
+        self.assertEqual(self.client.get(reverse('get_mlm_tree')).status_code, 403)
+
+    def test_staff_may_pick_the_root(self):
+        self.client.force_login(self.company)
+        self.assertEqual(self.client.get(self.urls[0], {'root': self.member.pk}).json()['id'], self.member.pk)
+        layout = self.client.get(self.urls[1], {'format': 'json'}).json()
+        self.assertEqual(len(layout['ids']), 3)
+        self.assertEqual(self.client.get(reverse('get_mlm_tree')).status_code, 200)
+
+
+class ForestJsonTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = CustomUser.objects.create_superuser('company@example.com', 'pw', first_name='Co', last_name='Root')
+        members = [CustomUser.objects.create_user(f'm{i}@example.com', 'pw', first_name=f'M{i}') for i in range(6)]
+        for i in range(5):
+            CustomUser.objects.create_user(f'd{i}@example.com', 'pw', first_name=f'D{i}', parent_sponsor=members[i % 2])
+        # A second tree, started by a member placed nowhere
+        node = MLMTree.objects.get(user=members[5])
+        node.parent = None
+        node.save()
+
+    def serialize_tree(self, node):
+        # The recursive serializer the streamed forest replaced
+        return {
+            "id": node.user.id,
+            "name": f"{node.user.first_name} {node.user.last_name}",
+            "children": [self.serialize_tree(child) for child in node.get_children()],
+        }
+
+    def test_streamed_forest_has_the_nested_shape(self):
+        expected = [self.serialize_tree(node) for node in MLMTree.objects.filter(parent=None).order_by('tree_id')]
+        self.assertEqual(len(expected), 2)
+        self.client.force_login(self.company)
+        for mode in (NESTED_SET, PATH):
+            with self.subTest(mode=mode), self.settings(MLMTREE_STORAGE=mode):
+                # Session, user and one ordered query for the whole forest
+                with self.assertNumQueries(3):
+                    response = self.client.get(reverse('get_mlm_tree'))
+                    body = b''.join(response.streaming_content)
+                self.assertEqual(response['Content-Type'], 'application/json')
+                self.assertEqual(json.loads(body), expected)
+
+
+class ExportGenealogyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+        for i in range(8):
+            CustomUser.objects.create_user(f'm{i}@example.com', 'pw')
+
+    def export(self, path, *args):
+        call_command('export_genealogy', '--output', path, *args, stderr=open(os.devnull, 'w'))
+        with open(path, 'rb') as handle:
+            return handle.read()
+
+    def test_resume_continues_behind_the_last_complete_row(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'genealogy.csv')
+        full = self.export(path)
+        lines = full.splitlines(keepends=True)
+        # Interrupted in the middle of the sixth row; the blocks are smaller than a row
+        with open(path, 'wb') as handle:
+            handle.write(b''.join(lines[:5]) + lines[5][:10])
+        with mock.patch('mlmtree.management.commands.export_genealogy.RESUME_BLOCK_SIZE', 8):
+            self.assertEqual(self.export(path, '--resume'), full)
+
+        with open(path, 'wb') as handle:
+            handle.write(lines[0][:-1])
+        self.assertEqual(self.export(path, '--resume'), full)
+
+
+class GenealogySnapshotTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.members = [CustomUser.objects.create_user(f'm{i}@example.com', 'pw') for i in range(7)]
+        for i in range(6):
+            CustomUser.objects.create_user(f'd{i}@example.com', 'pw', parent_sponsor=cls.members[i % 2])
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def snapshot(self, name):
+        return Snapshot.load(take_snapshot(name, directory=self.directory))
+
+    def test_snapshot_answers_as_the_live_tree(self):
+        snapshot = self.snapshot('2026-09')
+        self.assertIsInstance(snapshot.node_id, np.memmap)
+        with self.assertNumQueries(0):
+            placement = dict(zip(snapshot.node_id.tolist(), snapshot.downline_sizes().tolist()))
+            sponsored = dict(zip(snapshot.node_id.tolist(), snapshot.downline_sizes('sponsor').tolist()))
+            sponsor_depths = dict(zip(snapshot.node_id.tolist(), snapshot.depths('sponsor').tolist()))
+
+        self.assertEqual(placement, dict(MLMNodeStats.objects.values_list('node__user_id', 'downline_size')))
+        for user in CustomUser.objects.all():
+            self.assertEqual(sponsored[user.pk], user.get_sponsor_downline().count())
+            self.assertEqual(sponsor_depths[user.pk], user.get_sponsor_upline().count())
+        self.assertEqual(snapshot.meta['nodes'], CustomUser.objects.count())
+
+    def test_later_changes_show_in_the_diff_only(self):
+        old = self.snapshot('2026-09')
+        frozen = np.array(old.parent)
+
+        moved = MLMTree.objects.get(user=self.members[6])
+        moved.parent = MLMTree.objects.get(user=self.members[3])
+        moved.save()
+        responsored = CustomUser.objects.get(email='d5@example.com')
+        responsored.parent_sponsor = self.members[2]
+        responsored.save()
+        added = CustomUser.objects.create_user('late@example.com', 'pw')
+        removed = CustomUser.objects.get(email='d4@example.com')
+        self.assertFalse(MLMTree.objects.filter(parent__user=removed).exists())
+        removed_id = removed.pk
+        removed.delete()
+
+        np.testing.assert_array_equal(old.parent, frozen)
+        diff = diff_snapshots(old, self.snapshot('2026-10'))
+        self.assertEqual(
+            {key: ids.tolist() for key, ids in diff.items()},
+            {'added': [added.pk], 'removed': [removed_id], 'moved': [self.members[6].pk], 'responsored': [responsored.pk]},
+        )
+        with self.assertRaises(FileExistsError):
+            take_snapshot('2026-10', directory=self.directory)
+
+
+class RecordSaleTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.leader = CustomUser.objects.create_user('leader@example.com', 'pw')
+        cls.seller = CustomUser.objects.create_user('seller@example.com', 'pw', parent_node=cls.leader)
+        Product.objects.bulk_create([Product(name='Kit', slug='kit', price=Decimal('600.00'), stock_quantity=10)])
+        cls.product = Product.objects.get()
+
+    def sell(self, quantity):
+        order = Order.objects.create(user=self.seller, amount_paid=Decimal('600.00') * quantity, shipping_address='x')
+        OrderItem.objects.create(order=order, product=self.product, user=self.seller, quantity=quantity, price=Decimal('600.00'))
+
+    def test_sale_reaches_the_upline_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.sell(2)
+        # Nothing is locked or written while the order is still open.
+        self.assertFalse(MemberRank.objects.exists())
+        for callback in callbacks:
+            callback()
+
+        volumes = dict(MemberRank.objects.values_list('user_id', 'group_volume'))
+        self.assertEqual(volumes, {user.pk: Decimal('1200.00') for user in (self.company, self.leader, self.seller)})
+        seller = MemberRank.objects.get(user=self.seller)
+        self.assertEqual(seller.personal_volume, Decimal('1200.00'))
+        self.assertEqual(MemberRank.objects.get(user=self.leader).active_legs, 1)
+
+    def test_snapshot_close_ignores_later_sales(self):
+        self.sell(1)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshot = Snapshot.load(take_snapshot('2026-09', directory=directory.name))
+        self.sell(2)
+        Order.objects.filter(pk=Order.objects.latest('pk').pk).update(date_ordered=snapshot.taken_at + timedelta(hours=1))
+
+        recompute_ranks(snapshot)
+        self.assertEqual(MemberRank.objects.get(user=self.seller).personal_volume, Decimal('600.00'))
+        recompute_ranks()
+        self.assertEqual(MemberRank.objects.get(user=self.seller).personal_volume, Decimal('1800.00'))
+
+    def test_rolled_back_order_records_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.sell(1)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertFalse(MemberRank.objects.exists())
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TreeAdminQueryTests(TestCase):
+    """The MLMTree changelist costs the same number of queries whatever the number of nodes."""
+
+    def setUp(self):
+        self.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        self.client.force_login(self.company)
+
+    def assert_constant_queries(self, params, expected):
+        url = reverse('admin:mlmtree_mlmtree_changelist')
+        for size in (10, 60):
+            for number in range(CustomUser.objects.count(), size + 1):
+                CustomUser.objects.create_user(f'm{number}@example.com', 'pw')
+            with self.assertNumQueries(expected):
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'm1@example.com')
+
+    def test_tree_changelist(self):
+        self.assert_constant_queries({}, 4)
+
+    def test_tree_changelist_filtered_by_sponsor(self):
+        self.assert_constant_queries({'user__parent_sponsor__id__exact': self.company.pk}, 5)
+
+    def test_tree_changelist_filtered_by_parent(self):
+        parent = MLMTree.objects.get(user=self.company)
+        self.assert_constant_queries({'parent__id__exact': parent.pk}, 6)
+
+
+@override_settings(MLM_COMMISSION_RATES=[1000, 500, 300])
+class CommissionRunTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        leader = CustomUser.objects.create_user('leader@example.com', 'pw')
+        manager = CustomUser.objects.create_user('manager@example.com', 'pw', parent_node=leader)
+        cls.buyer = CustomUser.objects.create_user('buyer@example.com', 'pw', parent_node=manager)
+        for amount in (100, 200, 300, 400, 500):
+            Order.objects.create(user=cls.buyer, amount_paid=Decimal(amount), shipping_address='x')
+        cls.period = timezone.now().strftime('%Y-%m')
+        # 10% + 5% + 3% of 1500 to manager, leader and company
+        cls.expected = (5, Decimal('270.00'), 15)
+
+    def outcome(self):
+        run = CommissionRun.objects.get(period=self.period)
+        return run.orders_processed, run.total_paid, Commission.objects.count()
+
+    def ledger(self):
+        return sorted(Commission.objects.values_list('order_id', 'level', 'beneficiary_id', 'amount'))
+
+    def test_rerun_of_a_finished_period_changes_nothing(self):
+        run_commissions(self.period, chunk_size=2)
+        self.assertEqual(self.outcome(), self.expected)
+        ledger = self.ledger()
+        run_commissions(self.period, chunk_size=2, rerun=True)
+        self.assertEqual(self.outcome(), self.expected)
+        self.assertEqual(self.ledger(), ledger)
+
+    def test_half_finished_run_resumes_without_paying_twice(self):
+        calls = []
+
+        def fail_second_chunk(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise RuntimeError
+            return _process_chunk(*args)
+
+        with mock.patch('mlmtree.commissions._process_chunk', fail_second_chunk), self.assertRaises(RuntimeError):
+            run_commissions(self.period, chunk_size=2)
+        self.assertEqual(CommissionRun.objects.get(period=self.period).orders_processed, 2)
+        run_commissions(self.period, chunk_size=2)
+        self.assertEqual(self.outcome(), self.expected)
+
+    def test_overlapping_run_does_not_report_a_chunk_twice(self):
+        run = CommissionRun.objects.create(period=self.period)
+        stale = CommissionRun.objects.get(pk=run.pk)
+        chunk = list(Order.objects.order_by('id').values_list('id', 'user_id', 'amount_paid'))
+        _process_chunk(run, chunk, commission_rates())
+        # A second process read the same cursor before the first one moved it.
+        _process_chunk(stale, chunk, commission_rates())
+        self.assertEqual(self.outcome(), self.expected)
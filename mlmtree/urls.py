@@ -1,7 +1,12 @@
 from django.urls import path
-from .views import mlm_tree_view, get_mlm_tree
+from .views import mlm_tree_view, get_mlm_tree, get_mlm_subtree, get_downline_stats, search_downline, get_tree_layout, export_downline
 
 urlpatterns = [
     path("tree-view/", mlm_tree_view, name="mlm_tree_view"),  # ✅ Fix: Correct URL path
     path("api/tree/", get_mlm_tree, name="get_mlm_tree"),
+    path("api/subtree/", get_mlm_subtree, name="get_mlm_subtree"),
+    path("api/stats/", get_downline_stats, name="get_downline_stats"),
+    path("api/search/", search_downline, name="search_downline"),
+    path("api/layout/", get_tree_layout, name="get_tree_layout"),
+    path("api/export/", export_downline, name="export_downline"),
 ]
@@ -1,20 +1,343 @@
+import json
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Lower, RowNumber
+from django.db.models.expressions import Window
+from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
-from django.http import JsonResponse
-from .models import MLMTree
+from django.utils.cache import patch_vary_headers
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from .exports import export_rows, stream_csv
+from .layout import cached_layout, decode_layout, tree_version
+from .models import MLMNodeStats, MLMTree
+from .stats import level_counts
+from .storage import path_user_ids, subtree_contains, subtree_filter, tree_ordering, uses_path_storage
+
+User = get_user_model()
+
+# Nodes serialized between two writes to the response stream
+STREAM_CHUNK_NODES = 1000
+
+# Bounds of the lazily expandable subtree API
+SUBTREE_DEFAULT_DEPTH = 2
+SUBTREE_MAX_DEPTH = 5
+SUBTREE_DEFAULT_LIMIT = 20
+SUBTREE_MAX_LIMIT = 100
+
+# Page size of the downline search API
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+# Terms matching at most this many members site-wide are resolved through the user indexes
+SEARCH_CANDIDATE_LIMIT = 2000
 
+@staff_member_required
 def mlm_tree_view(request):
     """Renders the HTML page for MLM tree visualization in Django Admin."""
     return render(request, "admin/mlm_tree_view.html")
 
+def stream_forest(rows):
+    """Yield nested JSON for (level, id, first_name, last_name) rows given in tree order.
+
+    Each node is written as soon as it is read and left open for its children;
+    it is closed once a row at the same or a higher level shows up.
+    """
+    parts = ['[']
+    depth = -1
+    for count, (level, user_id, first_name, last_name) in enumerate(rows, start=1):
+        level = min(level, depth + 1)
+        if level <= depth:
+            parts.append(']}' * (depth - level + 1))
+            parts.append(',')
+        parts.append(f'{{"id": {user_id}, "name": {json.dumps(f"{first_name} {last_name}")}, "children": [')
+        depth = level
+        if count % STREAM_CHUNK_NODES == 0:
+            yield ''.join(parts)
+            parts = []
+    parts.append(']}' * (depth + 1))
+    parts.append(']')
+    yield ''.join(parts)
+
 def get_mlm_tree(request):
-    """Returns the MLM tree as JSON for visualization."""
-    def serialize_tree(node):
-        return {
-            "id": node.user.id,
-            "name": f"{node.user.first_name} {node.user.last_name}",
-            "children": [serialize_tree(child) for child in node.get_children()]
-        }
-
-    root_nodes = MLMTree.objects.filter(parent=None)
-    tree_data = [serialize_tree(node) for node in root_nodes]
-    return JsonResponse(tree_data, safe=False)
+    """Returns the MLM tree as JSON for visualization, streamed from a single ordered query (staff only)."""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "Staff only."}, status=403)
+    rows = (
+        MLMTree.objects
+        .order_by(*tree_ordering())
+        .values_list('level', 'user_id', 'user__first_name', 'user__last_name')
+        .iterator(chunk_size=2000)
+    )
+    return StreamingHttpResponse(stream_forest(rows), content_type='application/json')
+
+def _int_param(request, name, default, maximum=None):
+    try:
+        value = int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        value = default
+    value = max(value, 0)
+    return min(value, maximum) if maximum is not None else value
+
+def _with_child_count(queryset):
+    child_count = (
+        MLMTree.objects.filter(parent=OuterRef('pk'))
+        .order_by().values('parent')
+        .annotate(total=Count('pk')).values('total')
+    )
+    return queryset.annotate(child_count=Subquery(child_count))
+
+def _serialize_node(row):
+    return {
+        "id": row['user_id'],
+        "name": f"{row['user__first_name']} {row['user__last_name']}",
+        "level": row['level'],
+        "child_count": row['child_count'] or 0,
+        "children": [],
+        "next_cursor": None,
+    }
+
+def _children_page(parent_ids, limit, cursor=None, roots=False):
+    """Return up to ``limit + 1`` children per parent, ordered by user, in one indexed query."""
+    queryset = MLMTree.objects.filter(parent__isnull=True) if roots else MLMTree.objects.filter(parent_id__in=parent_ids)
+    if cursor:
+        queryset = queryset.filter(user_id__gt=cursor)
+    queryset = queryset.annotate(
+        rank=Window(RowNumber(), partition_by=[F('parent_id')], order_by=F('user_id').asc())
+    ).filter(rank__lte=limit + 1)
+    return _with_child_count(queryset).order_by('parent_id', 'user_id').values(
+        'id', 'parent_id', 'level', 'user_id', 'user__first_name', 'user__last_name', 'child_count'
+    )
+
+def _visible_root(request, root_user):
+    """The node ``root_user`` names, if the requester may read below it.
+
+    Staff may read any node, or the whole network (None) when no root is given;
+    members only their own node (the default) and nodes in their downline.
+    Raises MLMTree.DoesNotExist or ValueError otherwise.
+    """
+    if request.user.is_staff:
+        return MLMTree.objects.get(user_id=int(root_user)) if root_user else None
+    own = MLMTree.objects.get(user_id=request.user.pk)
+    if not root_user or int(root_user) == own.user_id:
+        return own
+    node = MLMTree.objects.get(user_id=int(root_user))
+    if not subtree_contains(own, node.tree_id, node.lft, node.path):
+        raise MLMTree.DoesNotExist
+    return node
+
+def get_mlm_subtree(request):
+    """Returns a depth-limited slice of the MLM tree for lazy expansion in the viewer.
+
+    ``root`` is a user id (omit it to list the top-level nodes), ``depth`` the number of
+    levels below it, ``limit`` the children shown per node and ``cursor`` the last child
+    user id already shown under the root. Nodes with more children than shown carry a
+    ``next_cursor``; every node carries its ``child_count``. Each level costs one query.
+    Members only see their own downline and start from their own node.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=403)
+    try:
+        root_node = _visible_root(request, request.GET.get('root'))
+    except (MLMTree.DoesNotExist, ValueError):
+        return JsonResponse({"error": "Node not found."}, status=404)
+    depth = _int_param(request, 'depth', SUBTREE_DEFAULT_DEPTH, SUBTREE_MAX_DEPTH)
+    limit = _int_param(request, 'limit', SUBTREE_DEFAULT_LIMIT, SUBTREE_MAX_LIMIT) or SUBTREE_DEFAULT_LIMIT
+    cursor = _int_param(request, 'cursor', 0)
+    root_user = root_node.user_id if root_node else None
+
+    if root_user:
+        row = _with_child_count(MLMTree.objects.filter(pk=root_node.pk)).values(
+            'id', 'parent_id', 'level', 'user_id', 'user__first_name', 'user__last_name', 'child_count'
+        ).first()
+        root = _serialize_node(row)
+        nodes = {row['id']: root}
+    else:
+        root = {"id": None, "name": "Company", "level": -1, "child_count": None, "children": [], "next_cursor": None}
+        nodes = {None: root}
+
+    parents = list(nodes)
+    for level in range(depth):
+        if not parents:
+            break
+        page = _children_page(parents, limit, cursor if level == 0 else None, roots=level == 0 and not root_user)
+        next_parents = []
+        for row in page:
+            parent = nodes[row['parent_id']]
+            if len(parent['children']) == limit:
+                parent['next_cursor'] = parent['children'][-1]['id']
+                continue
+            node = _serialize_node(row)
+            parent['children'].append(node)
+            nodes[row['id']] = node
+            next_parents.append(row['id'])
+        parents = next_parents
+
+    return JsonResponse(root)
+
+def get_tree_layout(request):
+    """Returns precomputed node coordinates for the viewer.
+
+    ``root`` is a user id (omit it for the whole network) and ``depth`` limits the
+    levels below it. The default answer is the compact binary payload described in
+    mlmtree.layout; ``format=json`` returns the same columns as JSON. Members only
+    see their own downline and start from their own node.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=403)
+    try:
+        root = _visible_root(request, request.GET.get('root'))
+    except (MLMTree.DoesNotExist, ValueError):
+        return JsonResponse({"error": "Node not found."}, status=404)
+    depth = _int_param(request, 'depth', 0) or None
+
+    etag = f'"{tree_version()}-{root.user_id if root else ""}-{depth or ""}"'
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponse(status=304)
+
+    payload = cached_layout(root, depth)
+    if request.GET.get('format') == 'json':
+        response = JsonResponse(decode_layout(payload))
+    else:
+        response = HttpResponse(payload, content_type='application/octet-stream')
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+def get_downline_stats(request):
+    """Returns the stored downline aggregates of the current user.
+
+    Staff may pass ``root`` (a user id) to read another member's figures.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=403)
+    user_id = (request.GET.get('root') if request.user.is_staff else None) or request.user.pk
+    try:
+        row = MLMNodeStats.objects.filter(node__user_id=int(user_id)).values(
+            'node_id', 'downline_size', 'direct_children'
+        ).first()
+    except ValueError:
+        row = None
+    if row is None:
+        return JsonResponse({"error": "Node not found."}, status=404)
+    node_id = row.pop('node_id')
+    return JsonResponse({"id": int(user_id), **row, "level_counts": level_counts(node_id)})
+
+def export_downline(request):
+    """Streams a member's downline as CSV.
+
+    Staff may pass ``root`` (a user id, omit it for the whole network); everyone
+    else exports their own downline. ``after`` is the ``member_id`` of the last row
+    already received; the export then continues behind it, without the header.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=403)
+    root_user = request.GET.get('root') if request.user.is_staff else request.user.pk
+    try:
+        root = MLMTree.objects.get(user_id=int(root_user)) if root_user else None
+        after = MLMTree.objects.get(user_id=int(request.GET['after'])) if request.GET.get('after') else None
+    except (MLMTree.DoesNotExist, ValueError):
+        return JsonResponse({"error": "Node not found."}, status=404)
+
+    response = StreamingHttpResponse(
+        stream_csv(export_rows(root, after), header=after is None), content_type='text/csv; charset=utf-8'
+    )
+    name = f"downline-{root.user_id}" if root else "network"
+    response['Content-Disposition'] = f'attachment; filename="{name}.csv"'
+    return response
+
+def _prefix(field, term):
+    """Prefix match as LIKE 'term%'; on PostgreSQL the *_pattern_ops indexes serve it under any collation."""
+    return Q(**{f'{field}__startswith': term})
+
+def _search_matches(term, prefix=''):
+    """Prefix match on name, email or unique_id; "first last" also matches both names."""
+    lowered = term.lower()
+    first, _, rest = lowered.partition(' ')
+    matches = (
+        _prefix('first_name_lower', lowered) | _prefix('last_name_lower', lowered)
+        | _prefix('email_lower', lowered) | _prefix(f'{prefix}unique_id', term.upper())
+    )
+    if rest:
+        matches |= _prefix('first_name_lower', first) & _prefix('last_name_lower', rest.strip())
+    return matches
+
+def _with_search_keys(queryset, prefix=''):
+    # Same expressions as the functional indexes on CustomUser
+    return queryset.annotate(
+        first_name_lower=Lower(f'{prefix}first_name'),
+        last_name_lower=Lower(f'{prefix}last_name'),
+        email_lower=Lower(f'{prefix}email'),
+    )
+
+def search_downline(request):
+    """Searches a member's downline by name, email or unique_id prefix.
+
+    Staff may pass ``root`` (a user id); everyone else searches their own downline.
+    ``q`` is the search text, ``limit`` the page size and ``cursor`` the ``next_cursor``
+    of the previous page. Hits come in tree order with their depth below the root and
+    the placement path from the root down to them.
+
+    A selective term is resolved through the name/email indexes and the few
+    candidates are checked against the subtree; a common term walks the subtree
+    range in tree order and stops as soon as the page is full.
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Authentication required."}, status=403)
+    term = request.GET.get('q', '').strip()
+    if not term:
+        return JsonResponse({"error": "Missing search text."}, status=400)
+    limit = _int_param(request, 'limit', SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT) or SEARCH_DEFAULT_LIMIT
+
+    root_user = request.GET.get('root') if request.user.is_staff else None
+    try:
+        root = MLMTree.objects.get(user_id=int(root_user) if root_user else request.user.pk)
+    except (MLMTree.DoesNotExist, ValueError):
+        return JsonResponse({"error": "Node not found."}, status=404)
+
+    position = 'path' if uses_path_storage() else 'lft'
+    cursor = request.GET.get('cursor')
+    if cursor and position == 'lft':
+        cursor = _int_param(request, 'cursor', 0)
+    fields = ('tree_id', 'lft', 'level', 'path', 'user_id', 'user__first_name', 'user__last_name', 'user__email', 'user__unique_id')
+
+    candidates = list(
+        _with_search_keys(User.objects.all()).filter(_search_matches(term))
+        .values_list('pk', flat=True)[:SEARCH_CANDIDATE_LIMIT + 1]
+    )
+    if len(candidates) <= SEARCH_CANDIDATE_LIMIT:
+        hits = sorted(
+            (row for row in MLMTree.objects.filter(user_id__in=candidates).values(*fields)
+             if subtree_contains(root, row['tree_id'], row['lft'], row['path'])
+             and (not cursor or row[position] > cursor)),
+            key=lambda row: row[position],
+        )[:limit + 1]
+    else:
+        hits = _with_search_keys(
+            MLMTree.objects.filter(subtree_filter(root, include_self=False)), 'user__'
+        ).filter(_search_matches(term, 'user__'))
+        if cursor:
+            hits = hits.filter(**{f'{position}__gt': cursor})
+        hits = list(hits.order_by(position).values(*fields)[:limit + 1])
+
+    next_cursor = hits[limit - 1][position] if len(hits) > limit else None
+    hits = hits[:limit]
+
+    # One query resolves the names along every placement path on the page.
+    start = root.level
+    path_ids = {hit['user_id']: path_user_ids(hit['path'])[start:] for hit in hits}
+    names = {
+        user_id: f"{first_name} {last_name}"
+        for user_id, first_name, last_name in User.objects.filter(
+            pk__in={user_id for ids in path_ids.values() for user_id in ids}
+        ).values_list('pk', 'first_name', 'last_name')
+    }
+
+    results = [{
+        "id": hit['user_id'],
+        "name": f"{hit['user__first_name']} {hit['user__last_name']}",
+        "email": hit['user__email'],
+        "unique_id": hit['user__unique_id'],
+        "depth": hit['level'] - root.level,
+        "path": [{"id": user_id, "name": names.get(user_id, "")} for user_id in path_ids[hit['user_id']]],
+    } for hit in hits]
+    return JsonResponse({"root": root.user_id, "results": results, "next_cursor": next_cursor})
@@ -1,3 +1,94 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.db.models.query import QuerySet
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from cart.models import Order, OrderItem
+from store.models import Product
+from users.models import CustomUser
+
+SHIPPING = {
+    'email': 'member@example.com', 'phone': '1', 'shipping_address1': 'a', 'shipping_address2': '',
+    'city': 'c', 'state': 's', 'zipcode': 'z', 'country': 'IN',
+}
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PaymentExecuteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+        cls.user = CustomUser.objects.create_user('member@example.com', 'pw')
+        Product.objects.bulk_create([
+            Product(name=name, slug=name, price=Decimal('10.00'), stock_quantity=5) for name in ('kit', 'refill', 'mug')
+        ])
+        cls.products = {product.name: product for product in Product.objects.all()}
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        patcher = mock.patch('payment.views.razorpay_client')
+        self.razorpay = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.razorpay.payment.fetch.return_value = {'id': 'pay_1', 'status': 'captured', 'amount': 5000}
+
+    def fill_cart(self, **quantities):
+        session = self.client.session
+        session['session_key'] = {str(self.products[name].pk): quantity for name, quantity in quantities.items()}
+        session['shipping'] = SHIPPING
+        session.save()
+
+    def execute(self):
+        return self.client.get(reverse('payment_execute'), {
+            'razorpay_payment_id': 'pay_1', 'razorpay_order_id': 'order_1', 'razorpay_signature': 'sig',
+        })
+
+    def stock(self):
+        return dict(Product.objects.values_list('name', 'stock_quantity'))
+
+    def test_order_is_written_and_stock_taken(self):
+        self.fill_cart(kit=2, refill=1, mug=3)
+        # Session, one product query for the priced cart, user and order, then per line only
+        # the item and its conditional stock update (all in one savepoint); the emptied
+        # saved cart and the session are written last.
+        with self.assertNumQueries(19):
+            response = self.execute()
+        self.assertRedirects(response, reverse('order_success'), fetch_redirect_response=False)
+        order = Order.objects.get()
+        self.assertEqual(order.amount_paid, Decimal('60.00'))
+        self.assertEqual(OrderItem.objects.filter(order=order).count(), 3)
+        self.assertEqual(self.stock(), {'kit': 3, 'refill': 4, 'mug': 2})
+        self.razorpay.payment.refund.assert_not_called()
+
+    def test_cart_with_problems_is_refused_and_refunded(self):
+        Product.objects.filter(name='mug').update(is_listed=False)
+        self.fill_cart(kit=2, mug=1)
+        response = self.execute()
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stock(), {'kit': 5, 'refill': 5, 'mug': 5})
+        self.razorpay.payment.refund.assert_called_once_with('pay_1', {'amount': 5000})
+
+    def test_stock_sold_meanwhile_rolls_the_order_back(self):
+        self.fill_cart(kit=2, refill=5)
+        sold, real_update = [], QuerySet.update
+
+        def sell_refill_first(queryset, **changes):
+            # Another checkout takes a refill between the snapshot and the first stock update
+            if not sold:
+                sold.append(real_update(Product.objects.filter(name='refill'), stock_quantity=4))
+            return real_update(queryset, **changes)
+
+        with mock.patch('django.db.models.query.QuerySet.update', sell_refill_first):
+            self.execute()
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        self.assertEqual(self.stock()['kit'], 5)
+        self.razorpay.payment.refund.assert_called_once()
+
+    def test_process_payment_refuses_cart_with_problems(self):
+        self.fill_cart(kit=9)
+        response = self.client.get(reverse('process_payment'))
+        self.assertRedirects(response, reverse('cart'), fetch_redirect_response=False)
+        self.razorpay.order.create.assert_not_called()
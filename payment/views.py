@@ -2,6 +2,8 @@
 from django.shortcuts import render, redirect
 from django.contrib import messages
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.views.decorators.csrf import csrf_exempt
 import razorpay
 from razorpay.errors import SignatureVerificationError
@@ -9,18 +11,31 @@ from razorpay.errors import SignatureVerificationError
 from cart.cart import Cart
 from cart.models import Order, OrderItem
 from store.models import Product
-from users.models import ShippingAddress, Profile
+from users.models import ShippingAddress
 
 # Initialize Razorpay client
 from .razorpay import razorpay_client
 
+UNAVAILABLE_MESSAGE = 'Some items in your cart are no longer available in that quantity. Please review your cart.'
+
+
+class OutOfStock(Exception):
+    """A cart line lost its stock between the snapshot and the order."""
+
+
+def refuse_paid_cart(request, payment):
+    """Refund a captured payment whose cart can no longer be fulfilled."""
+    try:
+        razorpay_client.payment.refund(payment['id'], {'amount': payment['amount']})
+    except Exception as e:
+        messages.error(request, f'{UNAVAILABLE_MESSAGE} The refund of your payment failed ({e}), please contact us.')
+    else:
+        messages.error(request, f'{UNAVAILABLE_MESSAGE} Your payment has been refunded.')
+    return redirect('cart')
+
 @csrf_exempt
 def payment(request):
-    cart_instance = Cart(request)
-    cart_items = cart_instance.get_prods()
-    cart_quantities = cart_instance.get_quants()
-    total_quantity = sum(cart_quantities.values())
-    order_total = cart_instance.order_total()
+    snapshot = Cart(request).snapshot()
 
     shipping = ShippingAddress.objects.get(user=request.user)
     
@@ -36,9 +51,10 @@ def payment(request):
     }
 
     context = {
-        'cart_items': cart_items,
-        'order_total': order_total,
-        'total_quantity': total_quantity,
+        'cart_items': snapshot.lines,
+        'order_total': snapshot.total,
+        'total_quantity': snapshot.total_quantity,
+        'cart_snapshot': snapshot,
         'shipping': request.session['shipping'],
         'razorpay_key_id': settings.RAZORPAY_KEY_ID,
         'currency': 'INR'
@@ -47,8 +63,11 @@ def payment(request):
 
 @csrf_exempt
 def process_payment(request):
-    cart_instance = Cart(request)
-    order_total = cart_instance.order_total()
+    snapshot = Cart(request).snapshot()
+    if snapshot.has_problems or not snapshot.lines:
+        messages.error(request, UNAVAILABLE_MESSAGE)
+        return redirect('cart')
+    order_total = snapshot.total
 
     # Create a Razorpay order
     data = {
@@ -97,10 +116,10 @@ def payment_execute(request):
             payment = razorpay_client.payment.fetch(payment_id)
             if payment['status'] == 'captured':
                 # Payment successful
-                cart_instance = Cart(request)
-                cart_items = cart_instance.get_prods()
-                cart_quantities = cart_instance.get_quants()
-                order_total = cart_instance.order_total()
+                snapshot = Cart(request).snapshot()
+                if snapshot.has_problems or not snapshot.lines:
+                    return refuse_paid_cart(request, payment)
+                order_total = snapshot.total
 
                 user = request.user
                 shipping = request.session.get('shipping')
@@ -117,38 +136,41 @@ def payment_execute(request):
                     f"{shipping['country']}"
                 )
 
-                # Create the order
-                order = Order(
-                    user=user, 
-                    full_name=full_name, 
-                    email=email, 
-                    amount_paid=amount_paid, 
-                    shipping_address=shipping_address
-                )
-                order.save()
-
-                # Create OrderItems
-                for item in cart_items:
-                    product = Product.objects.get(id=item.id)
-                    order_item = OrderItem(
-                        order=order,
-                        product=product,
-                        user=user,
-                        quantity=cart_quantities[str(item.id)],  
-                        price=item.sale_price if item.is_sale else item.price
-                    )
-                    order_item.save()
-                    
-                    # Update product stock
-                    product.stock_quantity -= cart_quantities[str(item.id)]
-                    product.save()
+                try:
+                    with transaction.atomic():
+                        # Create the order
+                        order = Order(
+                            user=user,
+                            full_name=full_name,
+                            email=email,
+                            amount_paid=amount_paid,
+                            shipping_address=shipping_address
+                        )
+                        order.save()
+
+                        # Create OrderItems (the snapshot already holds the products and prices)
+                        for item in snapshot.lines:
+                            order_item = OrderItem(
+                                order=order,
+                                product=item,
+                                user=user,
+                                quantity=item.quantity,
+                                price=item.unit_price
+                            )
+                            order_item.save()
+
+                            # Take the stock only if it is still there; a concurrent checkout may have
+                            # sold it since the snapshot, and then the whole order is rolled back.
+                            taken = Product.objects.filter(
+                                pk=item.pk, is_listed=True, stock_quantity__gte=item.quantity
+                            ).update(stock_quantity=F('stock_quantity') - item.quantity)
+                            if not taken:
+                                raise OutOfStock(item.pk)
+                except OutOfStock:
+                    return refuse_paid_cart(request, payment)
 
                 # Clear the cart
-                for key in list(request.session.keys()):
-                    if key == "session_key":
-                        del request.session[key]
-
-                Profile.objects.filter(user__id=request.user.id).update(old_cart="")
+                Cart(request).clear()  # CartMiddleware saves the emptied cart once the response is out
 
                 messages.success(request, 'Payment successful!')
                 return redirect('order_success')
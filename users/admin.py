@@ -1,7 +1,9 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from .admin_filters import AutocompleteFilter, autocomplete_media
 from .forms import CustomUserCreationForm, CustomUserChangeForm
 from .models import CustomUser, Profile, ShippingAddress
+from .registration import register
 
 
 class CustomUserAdmin(UserAdmin):
@@ -13,7 +15,11 @@ class CustomUserAdmin(UserAdmin):
         "first_name", "last_name", "email", "unique_id", "get_parent_sponsor", "get_parent_node", 
         "is_staff", "is_active", "last_login", "date_joined"
     )
-    list_filter = ("email", "is_staff", "is_active", "parent_sponsor")
+    list_filter = ("is_staff", "is_active", ("parent_sponsor", AutocompleteFilter), ("parent_node", AutocompleteFilter))
+    # Sponsor and placement parent are joined in; the exact total is one COUNT less per page.
+    list_select_related = ("parent_sponsor", "parent_node")
+    show_full_result_count = False
+    autocomplete_fields = ("parent_sponsor", "parent_node")
 
     fieldsets = (
         (None, {"fields": ("email", "password")}),
@@ -35,6 +41,10 @@ class CustomUserAdmin(UserAdmin):
     
     readonly_fields = ("id", "unique_id", "last_login", "date_joined",)
 
+    @property
+    def media(self):
+        return super().media + autocomplete_media()
+
     def get_parent_sponsor(self, obj):
         return obj.parent_sponsor.email if obj.parent_sponsor else "Company"
     get_parent_sponsor.admin_order_field = 'parent_sponsor'
@@ -45,19 +55,30 @@ class CustomUserAdmin(UserAdmin):
     get_parent_node.admin_order_field = 'parent_node'
     get_parent_node.short_description = 'Placed Under'
 
+    def get_readonly_fields(self, request, obj=None):
+        # Sponsor and placement are set by registration; editing them here would bypass the
+        # slot claim, the tree node move and the downline stats, so they are shown read-only.
+        if obj is not None:
+            return (*self.readonly_fields, "parent_sponsor", "parent_node")
+        return self.readonly_fields
+
     def save_model(self, request, obj, form, change):
         """Ensure unique_id is generated before saving"""
         if not obj.unique_id:
             obj.unique_id = obj.generate_unique_id()
-        obj.save()
+        if change:
+            obj.save()
+        else:
+            register(obj)
 
 
 admin.site.register(CustomUser, CustomUserAdmin)
 
 
 class ProfileAdmin(admin.ModelAdmin):
-    list_display = ('user', 'get_unique_id', 'get_parent_node', 'phone', 'address1', 'city', 'state', 'zipcode', 'country', 'old_cart')
+    list_display = ('user', 'get_unique_id', 'get_parent_node', 'phone', 'address1', 'city', 'state', 'zipcode', 'country')
     search_fields = ('user__email', 'user__first_name', 'user__last_name', 'user__parent_node__email')
+    list_select_related = ('user__parent_node',)
 
     def get_unique_id(self, obj):
         return obj.user.unique_id
@@ -76,6 +97,7 @@ admin.site.register(Profile, ProfileAdmin)
 class ShippingAddressAdmin(admin.ModelAdmin):
     list_display = ('user', 'phone', 'full_name', 'email', 'address1', 'city', 'state', 'zipcode', 'country')
     search_fields = ('user__email', 'user__first_name', 'user__last_name')
+    list_select_related = ('user',)
 
 
 admin.site.register(ShippingAddress, ShippingAddressAdmin)
@@ -0,0 +1,47 @@
+from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
+
+
+class AutocompleteFilter(admin.FieldListFilter):
+    """List filter for a foreign key that picks the value through the admin autocomplete.
+
+    The built-in related filter renders one link per row of the related table, which
+    is unusable for users; this one only loads the selected object. The related
+    model's admin needs ``search_fields``, and the changelist admin has to include
+    ``autocomplete_media()`` in its media.
+    """
+    template = 'admin/autocomplete_filter.html'
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        self.lookup_kwarg = f'{field_path}__id__exact'
+        self.lookup_kwarg_isnull = f'{field_path}__isnull'
+        super().__init__(field, request, params, model, model_admin, field_path)
+        self.lookup_val = self.used_parameters.get(self.lookup_kwarg)
+        self.lookup_val_isnull = self.used_parameters.get(self.lookup_kwarg_isnull)
+        self.admin_site = model_admin.admin_site
+
+    def expected_parameters(self):
+        return [self.lookup_kwarg, self.lookup_kwarg_isnull]
+
+    def choices(self, changelist):
+        self.query_string = changelist.get_query_string(remove=self.expected_parameters())
+        yield {
+            'selected': self.lookup_val is None and not self.lookup_val_isnull,
+            'query_string': self.query_string,
+            'display': 'All',
+        }
+        yield {
+            'selected': bool(self.lookup_val_isnull),
+            'query_string': changelist.get_query_string({self.lookup_kwarg_isnull: 'True'}, [self.lookup_kwarg]),
+            'display': 'None',
+        }
+
+    def widget(self):
+        """The autocomplete select, showing the currently selected object (one query)."""
+        formfield = self.field.formfield(widget=AutocompleteSelect(self.field, self.admin_site))
+        return formfield.widget.render(self.lookup_kwarg, self.lookup_val, attrs={'id': f'filter_{self.lookup_kwarg}'})
+
+
+def autocomplete_media():
+    """Scripts and styles the autocomplete filters need on the changelist."""
+    return AutocompleteSelect(None, admin.site).media
@@ -0,0 +1,101 @@
+"""JWT authentication that builds the request user from token claims.
+
+Tokens issued by ``ClaimsTokenObtainPairSerializer`` carry the member's email,
+is_staff, unique_id and ``token_version`` next to the user id. For those
+tokens ``ClaimsJWTAuthentication`` returns a ``CustomUser`` holding just the
+claim fields, with every other field deferred: views that only need the claims
+never query the user table, and the first access to any other field loads the
+rest of the row in one query.
+
+Changing a claimed field, the password or is_active bumps the user's
+``token_version`` (see ``CustomUser.save``), which revokes every token issued
+before. The current version is read from the cache, so revocation reaches the
+other processes within TOKEN_VERSION_TIMEOUT unless the cache is shared.
+Tokens without claims (issued before this scheme) are resolved from the
+database as before.
+"""
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+
+from .models import CustomUser
+
+# Token claim -> user field
+USER_CLAIMS = {'email': 'email', 'is_staff': 'is_staff', 'unique_id': 'unique_id'}
+VERSION_CLAIM = 'token_version'
+TOKEN_VERSION_TIMEOUT = 300
+
+
+def _version_key(user_id):
+    return f'users:token_version:{user_id}'
+
+
+def token_version(user_id):
+    """Current token version of ``user_id`` (None for unknown users), cached."""
+    key = _version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = CustomUser.objects.filter(pk=user_id).values_list('token_version', flat=True).first()
+        if version is not None:
+            cache.set(key, version, TOKEN_VERSION_TIMEOUT)
+    return version
+
+
+def forget_token_version(user_id):
+    cache.delete(_version_key(user_id))
+
+
+def token_claims(user):
+    return {
+        **{claim: getattr(user, field) for claim, field in USER_CLAIMS.items()},
+        VERSION_CLAIM: user.token_version,
+    }
+
+
+def claims_user(validated_token):
+    """A CustomUser built from the token; non-claim fields are loaded on first access."""
+    fields = ['id', *USER_CLAIMS.values()]
+    values = [validated_token[api_settings.USER_ID_CLAIM], *(validated_token[claim] for claim in USER_CLAIMS)]
+    user = CustomUser.from_db('default', fields, values)
+    user._from_claims = True
+    return user
+
+
+def _check_version(validated_token, user_id):
+    if validated_token.get(VERSION_CLAIM, 0) != token_version(user_id):
+        raise AuthenticationFailed(_("Token has been revoked."), code='token_revoked')
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        _check_version(validated_token, user_id)
+        if VERSION_CLAIM not in validated_token or any(claim not in validated_token for claim in USER_CLAIMS):
+            return super().get_user(validated_token)
+        # Deactivation bumps the version, so a token that passed the check belongs to an active user.
+        return claims_user(validated_token)
+
+
+class ClaimsTokenObtainPairSerializer(TokenObtainPairSerializer):
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        for claim, value in token_claims(user).items():
+            token[claim] = value
+        return token
+
+
+class ClaimsTokenRefreshSerializer(TokenRefreshSerializer):
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        if user_id:
+            _check_version(refresh, user_id)
+        return super().validate(attrs)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from users.models import CustomUser
+from users.placement import rebuild_placement_slots
+
+
+class Command(BaseCommand):
+    help = "Build the placement open-slot index from the existing CustomUser.parent_node data."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', help="unique_id of a user to rebuild only that user's subtree")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        root = None
+        if options['root']:
+            try:
+                root = CustomUser.objects.get(unique_id=options['root'])
+            except CustomUser.DoesNotExist:
+                raise CommandError(f"No user with unique_id {options['root']}")
+
+        count = rebuild_placement_slots(root=root, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} placement slots."))
@@ -0,0 +1,325 @@
+import csv
+import json
+from collections import defaultdict
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Max, Q
+
+from mlmtree.layout import bump_tree_version
+from mlmtree.models import MLMTree
+from mlmtree.stats import rebuild_stats
+from mlmtree.storage import encode_segment, nested_set_columns
+from users.models import CustomUser, Profile
+from users.placement import MAX_CHILDREN, rebuild_placement_slots
+from users.unique_ids import allocate_unique_numbers, format_unique_id
+
+
+def read_rows(path, fmt):
+    """Yield one dict per member from a CSV or JSONL file."""
+    with open(path, newline='', encoding='utf-8') as handle:
+        if fmt == 'csv':
+            yield from csv.DictReader(handle)
+        else:
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def assign_unique_ids(users):
+    """Give every user without a unique_id a fresh one from a single reserved block."""
+    pending = [user for user in users if not user.unique_id]
+    for user, number in zip(pending, allocate_unique_numbers(len(pending))):
+        user.unique_id = format_unique_id(user.first_name, user.last_name, number)
+
+
+class FanOut:
+    """Placed children per node during an import, so no node gets more than MAX_CHILDREN.
+
+    Children of existing members are read on first use; rows chosen as children
+    but not written yet are held as ``None`` until ``written`` gives their id.
+    """
+
+    def __init__(self):
+        self.kids = {}
+        # Per spillover root, where the breadth-first search stopped: nodes only fill up,
+        # so the next open node is never earlier in that order.
+        self.cursors = {}
+
+    def load(self, node_ids):
+        missing = [node_id for node_id in node_ids if node_id not in self.kids]
+        for node_id in missing:
+            self.kids[node_id] = []
+        if missing:
+            for parent_id, child_id in CustomUser.objects.filter(
+                parent_node_id__in=missing
+            ).order_by('id').values_list('parent_node_id', 'id'):
+                self.kids[parent_id].append(child_id)
+
+    def has_room(self, node_id):
+        self.load([node_id])
+        return len(self.kids[node_id]) < MAX_CHILDREN
+
+    def open_node(self, root):
+        """First node under ``root`` with room, breadth-first like registration spillover.
+
+        None when the next level still holds unwritten rows, the caller retries
+        once they have their ids.
+        """
+        if root not in self.cursors:
+            self.load([root])
+        level, index = self.cursors.get(root, ([root], 0))
+        while level:
+            while index < len(level):
+                if len(self.kids[level[index]]) < MAX_CHILDREN:
+                    self.cursors[root] = (level, index)
+                    return level[index]
+                index += 1
+            below = [kid for node_id in level for kid in self.kids[node_id]]
+            if None in below:
+                self.cursors[root] = (level, index)
+                return None
+            level, index = below, 0
+            self.load(level)
+        self.cursors[root] = (level, index)
+        return None
+
+    def reserve(self, node_id):
+        self.kids[node_id].append(None)
+
+    def written(self, node_id, child_id):
+        kids = self.kids[node_id]
+        kids[kids.index(None)] = child_id
+        self.kids[child_id] = []
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk import a genealogy from CSV/JSONL. Columns: ref, email, first_name, last_name, "
+        "sponsor, placement, unique_id, password (already hashed). sponsor and placement are refs "
+        "of earlier rows or unique_id/email of existing users. Rows without placement spill over "
+        f"below the sponsor breadth-first; a placement that already has {MAX_CHILDREN} children is an error."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="defaults to the file extension")
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        self.batch_size = options['batch_size']
+
+        with transaction.atomic():
+            placement = self.import_users(read_rows(path, fmt))
+            if not placement:
+                self.stdout.write("Nothing to import.")
+                return
+            self.build_tree(placement)
+            rebuild_placement_slots(batch_size=self.batch_size)
+            rebuild_stats(batch_size=self.batch_size)
+            # Bulk writes skip the MLMTree signals, so cached layouts are dropped here.
+            transaction.on_commit(bump_tree_version)
+
+        self.stdout.write(self.style.SUCCESS(f"Imported {len(placement)} members."))
+
+    def import_users(self, rows):
+        """Bulk create users and profiles batch by batch, returning {user_id: placement_user_id}."""
+        self.refs = {}
+        company = CustomUser.objects.filter(is_superuser=True).values_list('id', 'sponsor_path').first()
+        self.company_id = company[0] if company else None
+        self.sponsor_paths = dict([company]) if company else {}
+        self.unusable_password = make_password(None)
+        self.fan_out = FanOut()
+        placement = {}
+
+        batch = []
+        for line, row in enumerate(rows, start=1):
+            batch.append((line, row))
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch, placement)
+                batch = []
+        if batch:
+            self.import_batch(batch, placement)
+        return placement
+
+    def resolve_existing(self, batch):
+        """Map refs that are not rows of this file to existing users, in one query."""
+        wanted = set()
+        for _, row in batch:
+            for key in ('sponsor', 'placement'):
+                ref = (row.get(key) or '').strip()
+                if ref and ref not in self.refs:
+                    wanted.add(ref)
+        if wanted:
+            for user_id, unique_id, email, sponsor_path in CustomUser.objects.filter(
+                Q(unique_id__in=wanted) | Q(email__in=wanted)
+            ).values_list('id', 'unique_id', 'email', 'sponsor_path'):
+                self.refs.setdefault(unique_id, user_id)
+                self.refs.setdefault(email, user_id)
+                self.sponsor_paths[user_id] = sponsor_path
+
+    def import_batch(self, batch, placement):
+        self.resolve_existing(batch)
+
+        emails = [row['email'].strip().lower() for _, row in batch]
+        existing = set(CustomUser.objects.filter(email__in=emails).values_list('email', flat=True))
+        if existing:
+            raise CommandError(f"Emails already registered: {', '.join(sorted(existing)[:10])}")
+
+        # Rows that reference rows of this same batch wait for them, so the batch
+        # is written in dependency generations instead of patching ids afterwards.
+        batch_refs = {}
+        generations = defaultdict(list)
+        for (line, row), email in zip(batch, emails):
+            sponsor_ref = (row.get('sponsor') or '').strip()
+            placement_ref = (row.get('placement') or '').strip() or sponsor_ref
+            generation = 0
+            for ref in (sponsor_ref, placement_ref):
+                if not ref or ref in self.refs:
+                    continue
+                if ref not in batch_refs:
+                    raise CommandError(f"Line {line}: unknown sponsor/placement reference {ref!r}")
+                generation = max(generation, batch_refs[ref] + 1)
+            explicit = bool((row.get('placement') or '').strip())
+            generations[generation].append((line, row, email, sponsor_ref, placement_ref, explicit))
+            batch_refs[(row.get('ref') or '').strip() or email] = generation
+            batch_refs.setdefault(email, generation)
+
+        for generation in sorted(generations):
+            self.insert_rows(generations[generation], placement)
+
+    def place_rows(self, rows):
+        """Choose the placement parent of each row and hold its slot.
+
+        Returns the placed rows with their parent id, and the rows that have to
+        wait until rows placed in this round are written.
+        """
+        placed, waiting = [], []
+        for line, row, email, sponsor_ref, placement_ref, explicit in rows:
+            parent_id = self.refs[placement_ref] if placement_ref else self.company_id
+            if parent_id is not None:
+                if explicit:
+                    if not self.fan_out.has_room(parent_id):
+                        raise CommandError(f"Line {line}: placement {placement_ref!r} already has {MAX_CHILDREN} children")
+                else:
+                    parent_id = self.fan_out.open_node(parent_id)
+                    if parent_id is None:
+                        waiting.append((line, row, email, sponsor_ref, placement_ref, explicit))
+                        continue
+                self.fan_out.reserve(parent_id)
+            placed.append((row, email, sponsor_ref, parent_id))
+        return placed, waiting
+
+    def insert_rows(self, rows, placement):
+        while rows:
+            placed, rows = self.place_rows(rows)
+            self.write_rows(placed, placement)
+
+    def write_rows(self, rows, placement):
+        users = []
+        for row, email, sponsor_ref, parent_id in rows:
+            users.append(CustomUser(
+                email=email,
+                first_name=row.get('first_name') or '',
+                last_name=row.get('last_name') or '',
+                unique_id=(row.get('unique_id') or '').strip() or None,
+                password=row.get('password') or self.unusable_password,
+                parent_sponsor_id=self.refs[sponsor_ref] if sponsor_ref else self.company_id,
+                parent_node_id=parent_id,
+            ))
+
+        assign_unique_ids(users)
+        CustomUser.objects.bulk_create(users, batch_size=self.batch_size)
+        Profile.objects.bulk_create([Profile(user=user) for user in users], batch_size=self.batch_size)
+
+        # Sponsors are always written in an earlier generation, so their paths are known.
+        for user in users:
+            user.sponsor_path = self.sponsor_paths.get(user.parent_sponsor_id, '') + encode_segment(user.pk)
+            self.sponsor_paths[user.pk] = user.sponsor_path
+        CustomUser.objects.bulk_update(users, ['sponsor_path'], batch_size=500)
+
+        for (row, email, _, _), user in zip(rows, users):
+            self.refs[(row.get('ref') or '').strip() or email] = user.pk
+            self.refs.setdefault(email, user.pk)
+            self.refs.setdefault(user.unique_id, user.pk)
+            placement[user.pk] = user.parent_node_id
+            if user.parent_node_id is not None:
+                self.fan_out.written(user.parent_node_id, user.pk)
+
+    def build_tree(self, placement):
+        """Compute MLMTree nested-set columns in memory and bulk write them level by level."""
+        children = defaultdict(list)
+        new_roots, grafts = [], defaultdict(list)
+        for user_id, parent_id in placement.items():
+            if parent_id in placement:
+                children[parent_id].append(user_id)
+            elif parent_id is None:
+                new_roots.append(user_id)
+            else:
+                grafts[parent_id].append(user_id)
+        for kids in children.values():
+            kids.sort()
+
+        columns = {}
+        next_tree_id = (MLMTree.objects.aggregate(Max('tree_id'))['tree_id__max'] or 0) + 1
+        level_nodes = []
+        for offset, root in enumerate(sorted(new_roots)):
+            nested_set_columns(root, children, columns)
+            lft, rght, level = columns[root]
+            level_nodes.append(MLMTree(
+                user_id=root, parent_id=None, tree_id=next_tree_id + offset,
+                lft=lft, rght=rght, level=level, path=encode_segment(root),
+            ))
+
+        # Subtrees placed under existing members go last among that member's children
+        # (new users have the highest ids), so open one gap per parent at its rght.
+        existing = {
+            user_id: (node_id, tree_id, rght, level, path)
+            for node_id, user_id, tree_id, rght, level, path in MLMTree.objects.filter(
+                user_id__in=list(grafts)
+            ).values_list('id', 'user_id', 'tree_id', 'rght', 'level', 'path')
+        }
+        missing = set(grafts) - set(existing)
+        if missing:
+            raise CommandError(f"Placement parents without an MLMTree node: {sorted(missing)[:10]}")
+
+        gaps = defaultdict(list)
+        # Right to left, so a shift never moves a parent that is still to be processed.
+        for parent_user_id in sorted(grafts, key=lambda user_id: existing[user_id][2], reverse=True):
+            node_id, tree_id, rght, level, path = existing[parent_user_id]
+            kids = sorted(grafts[parent_user_id])
+            width = 0
+            for kid in kids:
+                width = nested_set_columns(kid, children, {}, left=width)
+            MLMTree.objects.filter(tree_id=tree_id, lft__gt=rght).update(lft=F('lft') + width)
+            MLMTree.objects.filter(tree_id=tree_id, rght__gte=rght).update(rght=F('rght') + width)
+            for gap in gaps[tree_id]:
+                gap['left'] += width
+            gaps[tree_id].append({'node_id': node_id, 'path': path, 'kids': kids, 'left': rght, 'level': level + 1})
+
+        for tree_id, tree_gaps in gaps.items():
+            for gap in tree_gaps:
+                left = gap['left']
+                for kid in gap['kids']:
+                    left = nested_set_columns(kid, children, columns, left=left, level=gap['level'])
+                    lft, rght, level = columns[kid]
+                    level_nodes.append(MLMTree(
+                        user_id=kid, parent_id=gap['node_id'], tree_id=tree_id,
+                        lft=lft, rght=rght, level=level, path=gap['path'] + encode_segment(kid),
+                    ))
+
+        # Parents are written before their children so every level knows its parent ids.
+        while level_nodes:
+            MLMTree.objects.bulk_create(level_nodes, batch_size=self.batch_size)
+            next_level = []
+            for node in level_nodes:
+                for child_id in children[node.user_id]:
+                    lft, rght, level = columns[child_id]
+                    next_level.append(MLMTree(
+                        user_id=child_id, parent_id=node.pk, tree_id=node.tree_id,
+                        lft=lft, rght=rght, level=level, path=node.path + encode_segment(child_id),
+                    ))
+            level_nodes = next_level
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from users.sponsors import rebuild_sponsor_paths
+
+
+class Command(BaseCommand):
+    help = "Recompute the indexed sponsor (referral) paths from CustomUser.parent_sponsor."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = rebuild_sponsor_paths(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Updated {count} sponsor paths."))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from users.referrals import reset_shared_stats, shared_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the referral code cache hits, misses, evictions and hit rate summed over all processes. "
+        "The totals live in the Django cache, so they only cover other processes with a shared CACHE_BACKEND."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="set the totals back to zero after printing")
+
+    def handle(self, *args, **options):
+        stats = shared_stats()
+        self.stdout.write(
+            f"hits {stats['hits']}  misses {stats['misses']}  evictions {stats['evictions']}  "
+            f"hit rate {stats['hit_rate']:.1%}"
+        )
+        if options['reset']:
+            reset_shared_stats()
+            self.stdout.write(self.style.SUCCESS("Referral cache totals reset."))
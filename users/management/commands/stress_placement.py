@@ -0,0 +1,107 @@
+import multiprocessing
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections, transaction
+from django.db.models import Count
+
+from mlmtree.models import MLMTree
+from users.models import CustomUser, PlacementSlot
+from users.placement import MAX_CHILDREN
+
+
+def register_batch(args):
+    """Worker: sign up ``count`` users under ``sponsor_id``, retrying when the database is busy."""
+    sponsor_id, prefix, count = args
+    connections.close_all()
+    sponsor = CustomUser.objects.get(pk=sponsor_id)
+    retries = 0
+    for i in range(count):
+        while True:
+            try:
+                with transaction.atomic():
+                    CustomUser.objects.create_user(f"{prefix}-{i}@stress.test", None, parent_sponsor=sponsor)
+                break
+            except OperationalError:
+                # SQLite allows one writer at a time; real databases only contend on the slot row.
+                retries += 1
+                time.sleep(random.uniform(0.001, 0.01))
+    return retries
+
+
+class Command(BaseCommand):
+    help = (
+        "Register many users in parallel processes under one sponsor and check that no node ends up "
+        "with more than five children. Writes to the configured database, point it at a scratch copy."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--sponsor', help="unique_id of the sponsor (defaults to the company account)")
+        parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive')
+
+    def handle(self, *args, **options):
+        if options['sponsor']:
+            sponsor = CustomUser.objects.filter(unique_id=options['sponsor']).first()
+        else:
+            sponsor = CustomUser.objects.filter(is_superuser=True).first()
+        if sponsor is None:
+            raise CommandError("Sponsor not found.")
+
+        if options['interactive']:
+            answer = input(f"This adds {options['users']} users to {connections['default'].settings_dict['NAME']}. Type 'yes' to continue: ")
+            if answer != 'yes':
+                raise CommandError("Stress test cancelled.")
+
+        workers = max(options['workers'], 1)
+        run = uuid.uuid4().hex[:8]
+        share, extra = divmod(options['users'], workers)
+        jobs = [(sponsor.pk, f"stress-{run}-{w}", share + (1 if w < extra else 0)) for w in range(workers)]
+
+        # Children must open their own connections.
+        connections.close_all()
+        started = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            retries = sum(pool.map(register_batch, jobs))
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"Registered {options['users']} users with {workers} workers in {elapsed:.1f}s "
+            f"({options['users'] / elapsed:.0f}/s, {retries} busy retries)."
+        )
+
+        problems = self.check_invariants(f"stress-{run}-")
+        for problem in problems:
+            self.stderr.write(problem)
+        if problems:
+            raise CommandError("Placement invariant violated.")
+        self.stdout.write(self.style.SUCCESS("No node has more than five children; index and tree agree."))
+
+    def check_invariants(self, email_prefix):
+        problems = []
+        overfull = (
+            CustomUser.objects.filter(parent_node__isnull=False)
+            .values('parent_node').annotate(total=Count('pk')).filter(total__gt=MAX_CHILDREN)
+        )
+        problems += [f"User {row['parent_node']} has {row['total']} placed children." for row in overfull]
+
+        overfull = (
+            MLMTree.objects.filter(parent__isnull=False)
+            .values('parent').annotate(total=Count('pk')).filter(total__gt=MAX_CHILDREN)
+        )
+        problems += [f"MLM node {row['parent']} has {row['total']} children." for row in overfull]
+
+        unplaced = CustomUser.objects.filter(email__startswith=email_prefix, parent_node__isnull=True).count()
+        if unplaced:
+            problems.append(f"{unplaced} stress users were not placed.")
+
+        actual = dict(
+            CustomUser.objects.filter(parent_node__isnull=False)
+            .values_list('parent_node').annotate(total=Count('pk'))
+        )
+        for node_id, child_count in PlacementSlot.objects.values_list('node_id', 'child_count'):
+            if child_count != actual.get(node_id, 0):
+                problems.append(f"Slot of user {node_id} counts {child_count} children, tree has {actual.get(node_id, 0)}.")
+        return problems
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.18 on 2026-10-18 09:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_customuser_referral_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PlacementSlot',
+            fields=[
+                ('node', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='placement_slot', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('level', models.PositiveIntegerField(default=0)),
+                ('child_count', models.PositiveSmallIntegerField(default=0)),
+                ('open_level', models.PositiveIntegerField(default=0)),
+                ('next_open', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='open_slot_for', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
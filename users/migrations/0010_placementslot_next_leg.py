@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-18 09:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_customuser_sponsor_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='placementslot',
+            name='next_leg',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
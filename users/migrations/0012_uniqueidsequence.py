@@ -0,0 +1,20 @@
+# Generated by Django 4.2.18 on 2026-10-18 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_customuser_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UniqueIdSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('next_value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.18 on 2026-10-18 11:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0013_customuser_token_version'),
+        # Saved carts are copied out of old_cart first
+        ('cart', '0004_savedcart'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='profile',
+            name='old_cart',
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# Downline search matches LOWER(name) LIKE 'term%'. Outside the C collation a
+# PostgreSQL btree only serves LIKE with a text_pattern_ops opclass; the plain
+# Lower() indexes of 0011 stay for equality and ordering. Other backends have no
+# opclasses and keep using 0011 as is.
+PATTERN_INDEXES = (
+    ('user_first_name_pattern_idx', 'first_name'),
+    ('user_last_name_pattern_idx', 'last_name'),
+    ('user_email_pattern_idx', 'email'),
+)
+
+
+def create_pattern_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    table = schema_editor.quote_name(apps.get_model('users', 'CustomUser')._meta.db_table)
+    for name, column in PATTERN_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {schema_editor.quote_name(name)} '
+            f'ON {table} (LOWER({schema_editor.quote_name(column)}) text_pattern_ops)'
+        )
+
+
+def drop_pattern_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _ in PATTERN_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {schema_editor.quote_name(name)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0014_remove_profile_old_cart'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_pattern_indexes, drop_pattern_indexes),
+    ]
@@ -1,10 +1,12 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractBaseUser, PermissionsMixin
 from users.managers import CustomUserManager
-from django.db.models.signals import post_save
+from django.db.models import Value
+from django.db.models.functions import Concat, Lower, Substr
+from django.db.models.signals import post_delete, post_save
 from django.conf import settings
-from django.apps import apps  # ✅ Fix circular import
-import random
+
+from mlmtree.storage import encode_segment, path_user_ids
 
 # Custom User model
 class CustomUser(AbstractBaseUser, PermissionsMixin):
@@ -25,36 +27,127 @@ class CustomUser(AbstractBaseUser, PermissionsMixin):
     parent_node = models.ForeignKey(
         'self', null=True, blank=True, on_delete=models.SET_NULL, related_name='child_nodes'
     )
+    # Materialized path of the referral chain (same encoding as MLMTree.path)
+    sponsor_path = models.CharField(max_length=1024, blank=True, default='', db_index=True, editable=False)
+    # Bumped to revoke every JWT issued so far (see users.authentication)
+    token_version = models.PositiveIntegerField(default=0, editable=False)
+
+    # Fields copied into JWTs, or guarding them; changing one revokes the user's tokens
+    TOKEN_FIELDS = ('email', 'is_staff', 'unique_id', 'is_active', 'password')
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["first_name", "last_name"]
 
     objects = CustomUserManager()
 
+    class Meta:
+        # Case-insensitive prefix search over name and email (genealogy search);
+        # on PostgreSQL migration 0015 adds text_pattern_ops twins for the LIKE.
+        indexes = [
+            models.Index(Lower('first_name'), name='user_first_name_lower_idx'),
+            models.Index(Lower('last_name'), name='user_last_name_lower_idx'),
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+        ]
+
     def __str__(self):
         return self.email
 
     def generate_unique_id(self):
-        """Generate a unique ID in the format: VGS-SS-FL-XXXXXXXXXX"""
-        company_name = "VGS"
-        product_name = "SS"
-        first_initial = self.first_name[0].upper() if self.first_name else 'X'
-        last_initial = self.last_name[0].upper() if self.last_name else 'X'
-        random_number = random.randint(1000000000, 9999999999)
-        unique_id = f"{company_name}-{product_name}-{first_initial}{last_initial}-{random_number}"
-
-        # Ensure uniqueness
-        while CustomUser.objects.filter(unique_id=unique_id).exists():
-            random_number = random.randint(1000000000, 9999999999)
-            unique_id = f"{company_name}-{product_name}-{first_initial}{last_initial}-{random_number}"
-
-        return unique_id
+        """Generate a unique ID in the format: VGS-SS-FL-XXXXXXXXXX (unique by construction, see users.unique_ids)"""
+        from users.unique_ids import format_unique_id, next_unique_number
+        return format_unique_id(self.first_name, self.last_name, next_unique_number())
 
     def save(self, *args, **kwargs):
         """Ensure unique_id is generated before saving"""
         if not self.unique_id:
             self.unique_id = self.generate_unique_id()
+        deferred = self.get_deferred_fields()
+        update_fields = kwargs.get('update_fields')
+
+        changed = {} if self._state.adding else self._changed_token_fields(deferred)
+        # Referral links resolve active users by unique_id, see users.referrals.
+        stale = 'is_active' in changed or 'unique_id' in changed
+        self._stale_referral_code = changed.get('unique_id', self.unique_id) if stale else None
+        revoke = bool(changed)
+        if revoke:
+            self.token_version += 1
+            if update_fields is not None:
+                kwargs['update_fields'] = update_fields = {*update_fields, 'token_version'}
         super().save(*args, **kwargs)
+        if revoke:
+            from users.authentication import forget_token_version
+            transaction.on_commit(lambda: forget_token_version(self.pk))
+        self._snapshot_token_fields()
+
+        sponsor_saved = update_fields is None or 'parent_sponsor' in update_fields or 'parent_sponsor_id' in update_fields
+        if sponsor_saved and 'parent_sponsor_id' not in deferred and (
+            self.parent_sponsor_id != getattr(self, '_saved_sponsor_id', None) or not self.sponsor_path
+        ):
+            self._sync_sponsor_path()
+        self._saved_sponsor_id = self.__dict__.get('parent_sponsor_id')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_sponsor_id = instance.__dict__.get('parent_sponsor_id')
+        instance._snapshot_token_fields()
+        return instance
+
+    def _snapshot_token_fields(self):
+        """Remember the loaded TOKEN_FIELDS values as stored, so save can tell when one changed."""
+        self._saved_token_fields = {name: self.__dict__[name] for name in self.TOKEN_FIELDS if name in self.__dict__}
+
+    def _changed_token_fields(self, deferred):
+        """Return {name: stored value} for the loaded token fields that differ from the stored row.
+
+        Fields assigned without a snapshot (e.g. on a user built from JWT claims)
+        are compared against the database with one query.
+        """
+        saved = getattr(self, '_saved_token_fields', {})
+        loaded = [name for name in self.TOKEN_FIELDS if name not in deferred]
+        unknown = [name for name in loaded if name not in saved]
+        if unknown:
+            saved = {**saved, **(CustomUser.objects.filter(pk=self.pk).values(*unknown).first() or {})}
+        return {name: saved[name] for name in loaded if name in saved and getattr(self, name) != saved[name]}
+
+    def refresh_from_db(self, using=None, fields=None):
+        if fields is not None and getattr(self, '_from_claims', False):
+            # A user built from JWT claims loads its whole row on first use, not one column per attribute.
+            fields = {*fields, *self.get_deferred_fields()}
+            self._from_claims = False
+        super().refresh_from_db(using, fields)
+        self._saved_token_fields = {
+            **getattr(self, '_saved_token_fields', {}),
+            **{name: self.__dict__[name] for name in self.TOKEN_FIELDS if name in self.__dict__ and (fields is None or name in fields)},
+        }
+
+    def _sync_sponsor_path(self):
+        """Recompute the sponsor path after the sponsor changed, carrying the referred downline along."""
+        parent_path = ''
+        if self.parent_sponsor_id:
+            parent_path = CustomUser.objects.filter(pk=self.parent_sponsor_id).values_list('sponsor_path', flat=True).first() or ''
+        old_path = self.sponsor_path
+        new_path = parent_path + encode_segment(self.pk)
+        if new_path == old_path:
+            return
+        if old_path and parent_path.startswith(old_path):
+            raise ValueError("A user cannot be sponsored by someone in their own referral downline.")
+
+        if old_path:
+            CustomUser.objects.filter(sponsor_path__startswith=old_path).update(
+                sponsor_path=Concat(Value(new_path), Substr('sponsor_path', len(old_path) + 1))
+            )
+        else:
+            CustomUser.objects.filter(pk=self.pk).update(sponsor_path=new_path)
+        self.sponsor_path = new_path
+
+    def get_sponsor_downline(self):
+        """Returns everyone this user referred, directly or indirectly, in one indexed query."""
+        return CustomUser.objects.filter(sponsor_path__startswith=self.sponsor_path).exclude(pk=self.pk).order_by('sponsor_path')
+
+    def get_sponsor_upline(self):
+        """Returns the chain of sponsors above this user, top first."""
+        return CustomUser.objects.filter(pk__in=path_user_ids(self.sponsor_path)[:-1]).order_by('sponsor_path')
 
     def get_referral_link(self):
         """Generates the referral link containing the user's unique ID."""
@@ -83,7 +176,6 @@ class Profile(models.Model):
     state = models.CharField(max_length=200, blank=True)
     zipcode = models.CharField(max_length=200, blank=True)
     country = models.CharField(max_length=200, blank=True)
-    old_cart = models.CharField(max_length=255, blank=True)
 
     def __str__(self):
         return self.user.email
@@ -110,43 +202,59 @@ class ShippingAddress(models.Model):
     def __str__(self):
         return f'Shipping Address - {str(self.id)}'
 
+# Placement open-slot index
+class PlacementSlot(models.Model):
+    """Open-slot index for spillover placement.
+
+    ``next_open`` is the first node in breadth-first order under ``node``
+    that still has room for another child, ``open_level`` is its level.
+    """
+    node = models.OneToOneField(CustomUser, on_delete=models.CASCADE, primary_key=True, related_name='placement_slot')
+    level = models.PositiveIntegerField(default=0)
+    child_count = models.PositiveSmallIntegerField(default=0)
+    next_open = models.ForeignKey(
+        CustomUser, null=True, blank=True, on_delete=models.SET_NULL, related_name='open_slot_for'
+    )
+    open_level = models.PositiveIntegerField(default=0)
+    # Round-robin placement: how many members were already sent down one of the legs
+    next_leg = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'Placement Slot - {self.node_id}'
+
+# Block-wise sequence behind unique_id allocation
+class UniqueIdSequence(models.Model):
+    name = models.CharField(max_length=50, primary_key=True)
+    next_value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name} - {self.next_value}'
+
 def create_user_profile(sender, instance, created, **kwargs):
-    """Automatically create user profile, assign parent sponsor & parent node, and insert into MLMTree."""
-    if created:
-        Profile.objects.create(user=instance)
-        MLMTree = apps.get_model('mlmtree', 'MLMTree')
-
-        if instance.is_superuser:
-            instance.parent_sponsor = None
-            instance.parent_node = None
-            instance.save()
-            MLMTree.objects.create(user=instance, parent=None)
-            return
+    """Users saved outside users.registration.register still get their profile, placement and MLMTree node."""
+    if created and not getattr(instance, '_registering', False):
+        from users.registration import complete_registration
+        complete_registration(instance)
+
+post_save.connect(create_user_profile, sender=CustomUser)
+
+def detach_sponsored_users(sender, instance, **kwargs):
+    """Referrals of a deleted user lose their sponsor (SET_NULL), so their subtrees become roots."""
+    if instance.sponsor_path:
+        CustomUser.objects.filter(sponsor_path__startswith=instance.sponsor_path).update(
+            sponsor_path=Substr('sponsor_path', len(instance.sponsor_path) + 1)
+        )
+
+post_delete.connect(detach_sponsored_users, sender=CustomUser)
+def forget_referral_code(sender, instance, **kwargs):
+    """A deactivated, renumbered or deleted user must be resolved afresh by referral links.
+
+    Other saves (last_login, profile edits) leave the cached sponsor in place.
+    """
+    from users.referrals import referral_cache
+    code = instance.unique_id if kwargs.get('signal') is post_delete else getattr(instance, '_stale_referral_code', None)
+    if code:
+        referral_cache.invalidate(code)
 
-        if not instance.parent_sponsor:
-            company_user = CustomUser.objects.filter(is_superuser=True).first()
-            instance.parent_sponsor = company_user
-
-        if not instance.parent_node:
-            sponsor = instance.parent_sponsor
-            if sponsor:
-                children = sponsor.child_nodes.all()
-                if children.count() < 5:
-                    instance.parent_node = sponsor
-                else:
-                    queue = list(children)
-                    while queue:
-                        potential_parent = queue.pop(0)
-                        if potential_parent.child_nodes.count() < 5:
-                            instance.parent_node = potential_parent
-                            break
-                        queue.extend(potential_parent.child_nodes.all())
-
-        instance.save()
-
-        if instance.parent_node and not hasattr(instance.parent_node, 'mlm_tree'):
-            MLMTree.objects.create(user=instance.parent_node, parent=instance.parent_node.parent_node.mlm_tree if instance.parent_node.parent_node else None)
-
-        MLMTree.objects.create(user=instance, parent=instance.parent_node.mlm_tree if instance.parent_node else None)
-
-post_save.connect(create_user_profile, sender=CustomUser)
\ No newline at end of file
+post_save.connect(forget_referral_code, sender=CustomUser)
+post_delete.connect(forget_referral_code, sender=CustomUser)
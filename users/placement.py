@@ -0,0 +1,311 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.module_loading import import_string
+
+from mlmtree.layout import bump_tree_version
+
+from .models import CustomUser, PlacementSlot
+
+# Maximum number of direct children a node can have in the placement tree
+MAX_CHILDREN = 5
+
+# Lost compare-and-swap rounds tolerated before a claim gives up
+CLAIM_ATTEMPTS = 50
+
+
+def _lookup(sponsor):
+    """Return the slot record of ``sponsor`` with its open node joined in."""
+    return (
+        PlacementSlot.objects
+        .select_related('next_open')
+        .filter(node=sponsor)
+        .first()
+    )
+
+
+def _claim_on(node_id):
+    """Compare-and-swap one child slot on ``node_id``; False when the node is full."""
+    return bool(
+        PlacementSlot.objects
+        .filter(node_id=node_id, child_count__lt=MAX_CHILDREN)
+        .update(child_count=F('child_count') + 1)
+    )
+
+
+def claim_open_slot(sponsor):
+    """Reserve a child slot on the first node under ``sponsor`` (breadth-first) that has room.
+
+    The claim is a compare-and-swap on the slot's ``child_count``: the conditional
+    UPDATE only succeeds while the node has fewer than MAX_CHILDREN children, so two
+    signups racing for the last slot cannot both win. The loser moves the stale
+    pointer on and tries the next open node. Returns the claimed node or None.
+
+    The rounds do not sleep, since they run inside the registration transaction.
+    When the children that filled a node are not committed yet the pointer cannot
+    move, the rounds run out and PlacementSlot.DoesNotExist is raised; ``register``
+    waits outside the transaction and starts over.
+    """
+    for attempt in range(CLAIM_ATTEMPTS):
+        slot = _lookup(sponsor)
+        if slot is None or slot.next_open_id is None:
+            # Missing index entry, rebuild it for this subtree only.
+            rebuild_placement_slots(root=sponsor)
+            slot = _lookup(sponsor)
+            if slot is None or slot.next_open_id is None:
+                return None
+
+        target_id = slot.next_open_id
+        if _claim_on(target_id):
+            return slot.next_open
+        _advance(target_id)
+    raise PlacementSlot.DoesNotExist(f"No open placement slot could be claimed under user {sponsor.pk}.")
+
+
+class PlacementStrategy:
+    """Decides where a new member is placed under ``sponsor``.
+
+    ``claim`` returns the chosen parent node (or None) and must have reserved one
+    of its child slots with ``_claim_on`` before returning.
+    """
+
+    def claim(self, sponsor):
+        raise NotImplementedError
+
+
+class BreadthFirstPlacement(PlacementStrategy):
+    """Spillover: the first node with room, level by level under the sponsor."""
+
+    def claim(self, sponsor):
+        return claim_open_slot(sponsor)
+
+
+class LegDescentPlacement(PlacementStrategy):
+    """Fill the sponsor first, then walk down one chosen leg per level until a node has room.
+
+    Every level costs one query over at most MAX_CHILDREN legs; subclasses pick the leg.
+    """
+
+    def pick_leg(self, node_id, leg_ids):
+        raise NotImplementedError
+
+    def legs(self, node_id):
+        return list(PlacementSlot.objects.filter(node__parent_node_id=node_id).order_by('node_id').values_list('node_id', flat=True))
+
+    def claim(self, sponsor):
+        if not PlacementSlot.objects.filter(node=sponsor).exists():
+            rebuild_placement_slots(root=sponsor)
+        node_id = sponsor.pk
+        for attempt in range(CLAIM_ATTEMPTS):
+            while True:
+                if _claim_on(node_id):
+                    return CustomUser.objects.get(pk=node_id)
+                leg_ids = self.legs(node_id)
+                if not leg_ids:
+                    break
+                node_id = self.pick_leg(node_id, leg_ids)
+            # Full, but its children are not committed yet: start over from the sponsor.
+            node_id = sponsor.pk
+        raise PlacementSlot.DoesNotExist(f"No open placement slot could be claimed under user {sponsor.pk}.")
+
+
+class WeakestLegPlacement(LegDescentPlacement):
+    """Send new members down the leg with the smallest downline (ties go to the older leg)."""
+
+    def legs(self, node_id):
+        return list(
+            PlacementSlot.objects.filter(node__parent_node_id=node_id)
+            .values_list('node_id', 'node__mlm_tree__stats__downline_size')
+        )
+
+    def pick_leg(self, node_id, legs):
+        return min(legs, key=lambda leg: (leg[1] or 0, leg[0]))[0]
+
+
+class RoundRobinPlacement(LegDescentPlacement):
+    """Send new members to the legs in turn, using the per-node ``next_leg`` cursor."""
+
+    def pick_leg(self, node_id, leg_ids):
+        for attempt in range(CLAIM_ATTEMPTS):
+            turn = PlacementSlot.objects.filter(node_id=node_id).values_list('next_leg', flat=True).first()
+            if turn is None:
+                raise PlacementSlot.DoesNotExist(f"User {node_id} has no placement slot to take a turn on.")
+            # Compare-and-swap, so concurrent signups take different turns.
+            if PlacementSlot.objects.filter(node_id=node_id, next_leg=turn).update(next_leg=turn + 1):
+                return leg_ids[turn % len(leg_ids)]
+        raise PlacementSlot.DoesNotExist(f"No round-robin turn could be taken on user {node_id}.")
+
+
+PLACEMENT_STRATEGIES = {
+    'breadth_first': BreadthFirstPlacement,
+    'weakest_leg': WeakestLegPlacement,
+    'round_robin': RoundRobinPlacement,
+}
+
+
+def get_placement_strategy(name=None):
+    """Return the strategy named by ``MLM_PLACEMENT_STRATEGY``: a built-in name or a dotted class path."""
+    name = name or getattr(settings, 'MLM_PLACEMENT_STRATEGY', 'breadth_first')
+    strategy = PLACEMENT_STRATEGIES.get(name) or import_string(name)
+    return strategy()
+
+
+def count_placement(node):
+    """Claim a child slot directly on ``node`` (explicit placement skips the search).
+
+    Raises ValueError when ``node`` already has MAX_CHILDREN children.
+    """
+    if _claim_on(node.pk):
+        return
+    if not PlacementSlot.objects.filter(node=node).exists():
+        rebuild_placement_slots(root=node)
+        if _claim_on(node.pk):
+            return
+    raise ValueError(f"User {node.pk} already has {MAX_CHILDREN} children in the placement tree.")
+
+
+def index_new_node(user):
+    """Add a freshly placed user to the index; the parent's slot was claimed by ``claim_open_slot``."""
+    parent = user.parent_node
+    if parent is None:
+        PlacementSlot.objects.create(node=user, next_open=user)
+        return
+
+    parent_slot = PlacementSlot.objects.filter(node=parent).first()
+    if parent_slot is None:
+        rebuild_placement_slots(root=parent)
+        return
+
+    level = parent_slot.level + 1
+    PlacementSlot.objects.create(node=user, level=level, next_open=user, open_level=level)
+    if parent_slot.child_count >= MAX_CHILDREN:
+        _advance(parent.pk)
+
+
+def _advance(full_node_id):
+    """Move every pointer that still targets a node which has just filled up."""
+    stale = {slot.node_id: slot for slot in PlacementSlot.objects.filter(next_open_id=full_node_id)}
+    if not stale:
+        return
+
+    children = defaultdict(list)
+    rows = (
+        PlacementSlot.objects
+        .filter(node__parent_node_id__in=list(stale))
+        .order_by('node_id')
+        .values_list('node_id', 'node__parent_node_id', 'next_open_id', 'open_level')
+    )
+    for node_id, parent_id, next_open_id, open_level in rows:
+        children[parent_id].append((node_id, next_open_id, open_level))
+
+    # Deepest first, so a stale parent sees the already updated values of a stale child.
+    for slot in sorted(stale.values(), key=lambda s: -s.level):
+        best = None
+        for node_id, next_open_id, open_level in children[slot.node_id]:
+            if node_id in stale:
+                next_open_id, open_level = stale[node_id].next_open_id, stale[node_id].open_level
+            if best is None or open_level < best[1]:
+                best = (next_open_id, open_level)
+        if best is not None:
+            slot.next_open_id, slot.open_level = best
+
+    PlacementSlot.objects.bulk_update(stale.values(), ['next_open', 'open_level'])
+
+
+def _root_level(root):
+    """Return the depth of ``root`` in the placement tree."""
+    level, seen = 0, {root.pk}
+    parent_id = root.parent_node_id
+    while parent_id and parent_id not in seen:
+        seen.add(parent_id)
+        level += 1
+        parent_id = CustomUser.objects.filter(pk=parent_id).values_list('parent_node_id', flat=True).first()
+    return level
+
+
+def _subtree_pairs(root, batch_size):
+    """Return (id, parent_node_id) pairs for ``root`` and everyone placed below it."""
+    pairs = [(root.pk, None)]
+    seen = {root.pk}
+    frontier = [root.pk]
+    while frontier:
+        next_frontier = []
+        for start in range(0, len(frontier), batch_size):
+            rows = [
+                row for row in CustomUser.objects
+                .filter(parent_node_id__in=frontier[start:start + batch_size])
+                .values_list('id', 'parent_node_id')
+                if row[0] not in seen
+            ]
+            seen.update(node_id for node_id, _ in rows)
+            next_frontier.extend(node_id for node_id, _ in rows)
+            pairs.extend(rows)
+        frontier = next_frontier
+    return pairs
+
+
+def build_placement_slots(pairs, base_level=0):
+    """Compute slot records from (id, parent_node_id) pairs without touching the database."""
+    ids = {node_id for node_id, _ in pairs}
+    children = defaultdict(list)
+    roots = []
+    for node_id, parent_id in pairs:
+        if parent_id is None or parent_id not in ids:
+            roots.append(node_id)
+        else:
+            children[parent_id].append(node_id)
+
+    levels = {}
+    order = []
+    queue = sorted(roots)
+    for node_id in queue:
+        levels[node_id] = base_level
+    while queue:
+        next_queue = []
+        for node_id in queue:
+            order.append(node_id)
+            kids = children[node_id]
+            kids.sort()
+            for child_id in kids:
+                if child_id not in levels:
+                    levels[child_id] = levels[node_id] + 1
+                    next_queue.append(child_id)
+        queue = next_queue
+
+    slots = {}
+    for node_id in reversed(order):
+        kids = children[node_id]
+        level = levels[node_id]
+        next_open, open_level = node_id, level
+        if len(kids) >= MAX_CHILDREN:
+            best = min((slots[k] for k in kids if k in slots), key=lambda s: s.open_level, default=None)
+            if best is not None:
+                next_open, open_level = best.next_open_id, best.open_level
+        slots[node_id] = PlacementSlot(
+            node_id=node_id, level=level, child_count=len(kids),
+            next_open_id=next_open, open_level=open_level,
+        )
+    return [slots[node_id] for node_id in order]
+
+
+def rebuild_placement_slots(root=None, batch_size=1000):
+    """Rebuild the open-slot index from ``CustomUser.parent_node``, for the whole tree or one subtree."""
+    if root is None:
+        pairs = list(CustomUser.objects.values_list('id', 'parent_node_id'))
+        slots = build_placement_slots(pairs)
+    else:
+        pairs = _subtree_pairs(root, batch_size)
+        slots = build_placement_slots(pairs, base_level=_root_level(root))
+
+    with transaction.atomic():
+        if root is None:
+            PlacementSlot.objects.all().delete()
+        else:
+            ids = [slot.node_id for slot in slots]
+            for start in range(0, len(ids), batch_size):
+                PlacementSlot.objects.filter(node_id__in=ids[start:start + batch_size]).delete()
+        PlacementSlot.objects.bulk_create(slots, batch_size=batch_size)
+        transaction.on_commit(bump_tree_version)
+    return len(slots)
@@ -0,0 +1,124 @@
+"""Referral code (sponsor unique_id) resolution with an in-process LRU cache.
+
+Signup campaigns send the same few hundred codes over and over, so resolved
+sponsors are kept per process, at most REFERRAL_CACHE_SIZE of them and each
+for REFERRAL_CACHE_TTL seconds. Saving or deleting a user evicts their code,
+so deactivated or removed sponsors stop resolving right away in this process
+and within the TTL in the others. Unknown codes are not cached.
+
+Hits, misses and evictions are counted per process and added to totals in
+the shared Django cache, which ``manage.py referral_cache_stats`` reports.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import CustomUser
+
+COUNTERS = ('hits', 'misses', 'evictions')
+
+
+def _shared_key(counter):
+    return f'users:referral_cache:{counter}'
+
+
+def _count_shared(counter):
+    try:
+        cache.incr(_shared_key(counter))
+    except ValueError:
+        if not cache.add(_shared_key(counter), 1, timeout=None):
+            cache.incr(_shared_key(counter))
+
+
+def shared_stats():
+    """Hits, misses, evictions and hit rate summed over every process sharing the cache."""
+    totals = cache.get_many([_shared_key(counter) for counter in COUNTERS])
+    stats = {counter: totals.get(_shared_key(counter), 0) for counter in COUNTERS}
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+
+def reset_shared_stats():
+    cache.delete_many([_shared_key(counter) for counter in COUNTERS])
+
+
+class ReferralCache:
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, code):
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(code)
+                self.hits += 1
+                sponsor = entry[1]
+            else:
+                if entry is not None:
+                    del self._entries[code]
+                self.misses += 1
+                sponsor = None
+        _count_shared('misses' if sponsor is None else 'hits')
+        return sponsor
+
+    def put(self, code, sponsor):
+        with self._lock:
+            self._entries[code] = (time.monotonic() + self.ttl, sponsor)
+            self._entries.move_to_end(code)
+            evicted = 0
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        for _ in range(evicted):
+            _count_shared('evictions')
+
+    def invalidate(self, code):
+        with self._lock:
+            self._entries.pop(code, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Figures of this process's cache."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+referral_cache = ReferralCache(
+    getattr(settings, 'REFERRAL_CACHE_SIZE', 1000), getattr(settings, 'REFERRAL_CACHE_TTL', 300)
+)
+
+
+def resolve_referral(code):
+    """Return the active user whose unique_id is ``code``, or None."""
+    code = (code or '').strip()
+    if not code:
+        return None
+    sponsor = referral_cache.get(code)
+    if sponsor is None:
+        sponsor = CustomUser.objects.filter(unique_id=code, is_active=True).first()
+        if sponsor is None:
+            return None
+        referral_cache.put(code, sponsor)
+    # Callers get their own instance, the cached one is shared between requests.
+    return copy.copy(sponsor)
@@ -0,0 +1,122 @@
+"""Member registration in one transaction.
+
+``register`` places the new member before the user row is written, so the
+INSERT already carries sponsor and placement parent, then adds the profile,
+the placement index entry and the MLM tree node. Either all of it commits or
+none of it does. Every step is timed; the timings are logged and left on the
+user as ``registration_timings`` (milliseconds).
+
+Users saved some other way (``CustomUser.objects.create``, fixtures) are
+completed by the ``create_user_profile`` receiver with the same steps.
+"""
+import logging
+import time
+
+from django.db import transaction
+
+from mlmtree.models import MLMTree
+from .models import CustomUser, PlacementSlot, Profile
+from .placement import count_placement, get_placement_strategy, index_new_node
+
+logger = logging.getLogger(__name__)
+
+# Times a signup whose placement claim lost every round is started over
+REGISTER_ATTEMPTS = 3
+
+
+class StepTimer:
+    """Collects how long each named step took, in milliseconds."""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def step(self, name):
+        now = time.perf_counter()
+        self.timings[name] = round((now - self._last) * 1000, 3)
+        self._last = now
+
+
+def company_account():
+    return CustomUser.objects.filter(is_superuser=True).first()
+
+
+def place(user):
+    """Choose sponsor and placement parent of a new member and claim the parent's slot."""
+    if user.is_superuser:
+        user.parent_sponsor = None
+        user.parent_node = None
+        return
+    if user.parent_sponsor_id is None:
+        user.parent_sponsor = company_account()
+    if user.parent_node_id is None:
+        if user.parent_sponsor_id:
+            user.parent_node = get_placement_strategy().claim(user.parent_sponsor)
+    else:
+        count_placement(user.parent_node)
+
+
+def attach(user, timer):
+    """Add everything that needs the user's primary key: profile, index entry and tree node."""
+    Profile.objects.create(user=user)
+    timer.step('profile')
+    index_new_node(user)
+    timer.step('placement_index')
+
+    parent = None
+    if user.parent_node_id:
+        parent = MLMTree.objects.filter(user_id=user.parent_node_id).first()
+        if parent is None:
+            # Members from before the tree existed get their node on first use.
+            grandparent_id = user.parent_node.parent_node_id
+            grandparent = MLMTree.objects.filter(user_id=grandparent_id).first() if grandparent_id else None
+            parent = MLMTree.objects.create(user=user.parent_node, parent=grandparent)
+    MLMTree.objects.create(user=user, parent=parent)
+    timer.step('tree_node')
+
+
+def register(user):
+    """Save the new, unsaved ``user`` (password already set) with all its MLM records.
+
+    A claim that keeps losing to uncommitted signups rolls the transaction back;
+    the signup waits a little, outside the transaction, and is tried again. Inside
+    a caller's transaction the error is raised straight away.
+    """
+    for attempt in range(1, REGISTER_ATTEMPTS + 1):
+        try:
+            return _register(user)
+        except PlacementSlot.DoesNotExist:
+            if attempt == REGISTER_ATTEMPTS or transaction.get_connection().in_atomic_block:
+                raise
+            logger.warning("Placement for %s is contended, retrying (attempt %s)", user.email, attempt)
+            time.sleep(0.01 * attempt)
+
+
+def _register(user):
+    timer = StepTimer()
+    try:
+        with transaction.atomic():
+            place(user)
+            timer.step('placement')
+            user._registering = True
+            user.save()
+            timer.step('user')
+            attach(user, timer)
+        timer.step('commit')
+    finally:
+        # A failed attempt must not leave the flag behind, or a later save would skip complete_registration.
+        user._registering = False
+    user.registration_timings = timer.timings
+    logger.info("Registered user %s in %.1f ms %s", user.pk, sum(timer.timings.values()), timer.timings)
+    return user
+
+
+def complete_registration(user):
+    """Place and attach a user that was inserted without going through ``register``."""
+    timer = StepTimer()
+    with transaction.atomic():
+        place(user)
+        user.save(update_fields=['parent_sponsor', 'parent_node'])
+        timer.step('placement')
+        attach(user, timer)
+    user.registration_timings = timer.timings
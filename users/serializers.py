@@ -1,5 +1,7 @@
 from rest_framework import serializers
 from .models import CustomUser, Profile
+from .referrals import resolve_referral
+from .registration import register
 from django.contrib.auth.password_validation import validate_password
 
 class CustomUserSerializer(serializers.ModelSerializer):
@@ -38,14 +40,10 @@ class CustomUserCreateSerializer(serializers.ModelSerializer):
         validated_data.pop('password2')
         password = validated_data.pop('password1')
         
-        referred_by = None
-        if referral_code:
-            referred_by = CustomUser.objects.filter(unique_id=referral_code).first()
-            
-        user = CustomUser.objects.create(**validated_data, referred_by=referred_by)
+        referred_by = resolve_referral(referral_code)
+        user = CustomUser(**validated_data, parent_sponsor=referred_by)
         user.set_password(password)
-        user.save()
-        return user
+        return register(user)
 
 class ProfileSerializer(serializers.ModelSerializer):
     """Serializer for the user profile"""
@@ -54,4 +52,4 @@ class ProfileSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Profile
-        fields = ['user', 'image', 'phone', 'address1', 'address2', 'city', 'state', 'zipcode', 'country', 'old_cart', 'unique_id']
+        fields = ['user', 'image', 'phone', 'address1', 'address2', 'city', 'state', 'zipcode', 'country', 'unique_id']
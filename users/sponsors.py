@@ -0,0 +1,16 @@
+from mlmtree.storage import build_paths
+
+from .models import CustomUser
+
+
+def rebuild_sponsor_paths(batch_size=1000):
+    """Recompute every sponsor path from ``CustomUser.parent_sponsor``."""
+    rows = (
+        (user_id, sponsor_id, user_id)
+        for user_id, sponsor_id in CustomUser.objects.values_list('id', 'parent_sponsor_id').iterator(chunk_size=batch_size)
+    )
+    paths = build_paths(rows)
+    current = dict(CustomUser.objects.values_list('id', 'sponsor_path').iterator(chunk_size=batch_size))
+    changed = [CustomUser(id=user_id, sponsor_path=path) for user_id, path in paths.items() if current.get(user_id) != path]
+    CustomUser.objects.bulk_update(changed, ['sponsor_path'], batch_size=500)
+    return len(changed)
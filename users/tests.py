@@ -1,3 +1,366 @@
-from django.test import TestCase
+import csv
+import os
+import tempfile
+from io import StringIO
+from collections import Counter
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+
+from mlmtree.layout import tree_version
+from mlmtree.models import MLMTree
+from mlmtree.storage import encode_segment
+from .authentication import ClaimsJWTAuthentication, ClaimsTokenObtainPairSerializer
+from .models import CustomUser, PlacementSlot, UniqueIdSequence
+from .placement import MAX_CHILDREN, RoundRobinPlacement, claim_open_slot, count_placement
+from .referrals import ReferralCache, referral_cache, resolve_referral, shared_stats
+from .registration import register
+from .unique_ids import SEQUENCE_NAME, next_unique_number, permute, reserve_block
+
+
+@override_settings(UNIQUE_ID_BLOCK_SIZE=10)
+class UniqueIdAllocationTests(TestCase):
+    def test_numbers_are_distinct_across_blocks(self):
+        numbers = [next_unique_number() for _ in range(35)]
+        self.assertEqual(len(set(numbers)), 35)
+
+    def test_block_of_rolled_back_transaction_is_dropped(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                kept = next_unique_number()
+                raise RuntimeError
+        # The reservation rolled back with it, so another process gets that range next.
+        other = {permute(position) for position in reserve_block(10)}
+        self.assertIn(kept, other)
+        self.assertNotIn(next_unique_number(), other)
+
+    def test_signup_after_rolled_back_signup_gets_a_free_id(self):
+        CustomUser.objects.create_superuser('company@example.com', 'pw', unique_id='VGS-SS-CO-COMPANY')
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                CustomUser.objects.create_user('gone@example.com', 'pw')
+                raise RuntimeError
+        taken = {permute(position) for position in reserve_block(10)}
+        user = CustomUser.objects.create_user('kept@example.com', 'pw')
+        self.assertNotIn(int(user.unique_id[-10:]), taken)
+
+    def test_committed_block_keeps_serving(self):
+        first = next_unique_number()
+        start = UniqueIdSequence.objects.get(name=SEQUENCE_NAME).next_value
+        second = next_unique_number()
+        self.assertNotEqual(first, second)
+        self.assertEqual(UniqueIdSequence.objects.get(name=SEQUENCE_NAME).next_value, start)
+
+
+class ImportGenealogyTests(TestCase):
+    def setUp(self):
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+
+    def import_rows(self, rows):
+        handle = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='')
+        with handle:
+            writer = csv.DictWriter(handle, ['ref', 'email', 'first_name', 'last_name', 'sponsor', 'placement'])
+            writer.writeheader()
+            writer.writerows(rows)
+        self.addCleanup(os.unlink, handle.name)
+        call_command('import_genealogy', handle.name, stdout=open(os.devnull, 'w'))
+
+    def test_flat_sponsor_list_spills_over_breadth_first(self):
+        rows = [{'ref': 'lead', 'email': 'lead@example.com'}]
+        rows += [{'ref': f'm{i}', 'email': f'm{i}@example.com', 'sponsor': 'lead'} for i in range(12)]
+        self.import_rows(rows)
+
+        fan_out = Counter(CustomUser.objects.exclude(parent_node=None).values_list('parent_node_id', flat=True))
+        self.assertLessEqual(max(fan_out.values()), MAX_CHILDREN)
+        lead = CustomUser.objects.get(email='lead@example.com')
+        direct = list(CustomUser.objects.filter(parent_node=lead).order_by('id'))
+        self.assertEqual([user.email for user in direct], [f'm{i}@example.com' for i in range(5)])
+        # The next five go under the first leg, the last two under the second.
+        self.assertEqual(CustomUser.objects.filter(parent_node=direct[0]).count(), 5)
+        self.assertEqual(CustomUser.objects.filter(parent_node=direct[1]).count(), 2)
+        self.assertTrue(all(user.parent_sponsor_id == lead.pk for user in CustomUser.objects.filter(email__startswith='m')))
+        self.assertEqual(MLMTree.objects.get(user=direct[1]).get_children().count(), 2)
+
+    def test_explicit_placement_beyond_the_limit_is_rejected(self):
+        rows = [{'ref': 'lead', 'email': 'lead@example.com'}]
+        rows += [{'ref': f'm{i}', 'email': f'm{i}@example.com', 'sponsor': 'lead', 'placement': 'lead'} for i in range(6)]
+        with self.assertRaisesMessage(CommandError, f"already has {MAX_CHILDREN} children"):
+            self.import_rows(rows)
+        self.assertFalse(CustomUser.objects.filter(email='lead@example.com').exists())
+
+    def test_import_starts_a_new_tree_version(self):
+        before = tree_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.import_rows([{'ref': 'lead', 'email': 'lead@example.com'}])
+        self.assertGreater(tree_version(), before)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PlacementTests(TestCase):
+    def setUp(self):
+        self.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+
+    def test_spillover_never_exceeds_the_limit(self):
+        members = [CustomUser.objects.create_user(f'm{i}@example.com', 'pw') for i in range(MAX_CHILDREN + 2)]
+        self.assertEqual([m.parent_node_id for m in members[:MAX_CHILDREN]], [self.company.pk] * MAX_CHILDREN)
+        self.assertEqual(members[MAX_CHILDREN].parent_node_id, members[0].pk)
+        self.assertEqual(PlacementSlot.objects.get(node=self.company).child_count, MAX_CHILDREN)
+
+    def test_explicit_placement_on_a_full_node_is_refused(self):
+        for i in range(MAX_CHILDREN):
+            CustomUser.objects.create_user(f'm{i}@example.com', 'pw', parent_node=self.company)
+        with self.assertRaises(ValueError):
+            count_placement(self.company)
+        with self.assertRaises(ValueError):
+            CustomUser.objects.create_user('extra@example.com', 'pw', parent_node=self.company)
+        self.assertEqual(PlacementSlot.objects.get(node=self.company).child_count, MAX_CHILDREN)
+        self.assertFalse(CustomUser.objects.filter(email='extra@example.com').exists())
+
+    def test_claim_gives_up_without_sleeping(self):
+        # Full, but the children that filled it are not visible: the pointer cannot move on.
+        PlacementSlot.objects.filter(node=self.company).update(child_count=MAX_CHILDREN)
+        with mock.patch('time.sleep') as sleep, self.assertRaises(PlacementSlot.DoesNotExist):
+            claim_open_slot(self.company)
+        # Inside a caller's transaction register does not retry either.
+        with mock.patch('time.sleep') as sleep, self.assertRaises(PlacementSlot.DoesNotExist):
+            CustomUser.objects.create_user('m@example.com', 'pw')
+        sleep.assert_not_called()
+
+    @override_settings(MLM_PLACEMENT_STRATEGY='round_robin')
+    def test_round_robin_takes_the_legs_in_turn(self):
+        legs = [CustomUser.objects.create_user(f'm{i}@example.com', 'pw') for i in range(MAX_CHILDREN)]
+        spilled = [CustomUser.objects.create_user(f's{i}@example.com', 'pw') for i in range(MAX_CHILDREN + 1)]
+        self.assertEqual([user.parent_node_id for user in spilled], [leg.pk for leg in legs] + [legs[0].pk])
+
+    def test_round_robin_turn_without_a_slot_fails_fast(self):
+        PlacementSlot.objects.filter(node=self.company).delete()
+        with self.assertRaisesMessage(PlacementSlot.DoesNotExist, "no placement slot"):
+            RoundRobinPlacement().pick_leg(self.company.pk, [1, 2])
+
+    def test_failed_registration_clears_the_flag(self):
+        user = CustomUser(email='m@example.com', parent_node=self.company)
+        with mock.patch('users.registration.attach', side_effect=RuntimeError), self.assertRaises(RuntimeError):
+            register(user)
+        self.assertFalse(user._registering)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PlacementRetryTests(TransactionTestCase):
+    def test_contended_signup_waits_outside_the_transaction(self):
+        company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        PlacementSlot.objects.filter(node=company).update(child_count=MAX_CHILDREN)
+        waits = []
+
+        def sleep(seconds):
+            waits.append(transaction.get_connection().in_atomic_block)
+            if len(waits) == 1:
+                # The other signups commit meanwhile; the real count frees the slots again.
+                PlacementSlot.objects.filter(node=company).update(child_count=0)
+
+        with mock.patch('time.sleep', sleep):
+            user = CustomUser.objects.create_user('m@example.com', 'pw')
+        self.assertEqual(waits, [False])
+        self.assertEqual(user.parent_node_id, company.pk)
+        self.assertEqual(CustomUser.objects.count(), 2)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TokenRevocationTests(TestCase):
+    def setUp(self):
+        # Cached token versions outlive the rolled back rows of earlier tests.
+        self.addCleanup(cache.clear)
+        cache.clear()
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+        self.user = CustomUser.objects.create_user('member@example.com', 'pw')
+        self.token = str(ClaimsTokenObtainPairSerializer.get_token(self.user).access_token)
+
+    def authenticate(self):
+        backend = ClaimsJWTAuthentication()
+        return backend.get_user(backend.get_validated_token(self.token))
+
+    def assert_revoked(self, user):
+        self.assertEqual(self.authenticate().pk, self.user.pk)
+        user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save()
+        with self.assertRaisesMessage(AuthenticationFailed, "revoked"):
+            self.authenticate()
+
+    def test_deactivating_a_freshly_created_user(self):
+        self.assert_revoked(self.user)
+
+    def test_deactivating_a_refreshed_user(self):
+        self.user.refresh_from_db()
+        self.assert_revoked(self.user)
+
+    def test_deactivating_a_user_built_from_claims(self):
+        self.assert_revoked(self.authenticate())
+
+    def test_unrelated_change_keeps_the_token(self):
+        self.user.first_name = 'Renamed'
+        self.user.save()
+        self.assertEqual(self.authenticate().pk, self.user.pk)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AdminChangelistQueryTests(TestCase):
+    """Changelist pages cost the same number of queries whatever the number of rows."""
+
+    def setUp(self):
+        self.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        self.client.force_login(self.company)
+
+    def assert_constant_queries(self, changelist, params, expected):
+        url = reverse(f'admin:{changelist}_changelist')
+        for size in (10, 60):
+            for number in range(CustomUser.objects.count(), size + 1):
+                CustomUser.objects.create_user(f'm{number}@example.com', 'pw', first_name='M', last_name=str(number))
+            with self.assertNumQueries(expected):
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'm1@example.com')
+
+    def test_user_changelist(self):
+        self.assert_constant_queries('users_customuser', {}, 4)
+
+    def test_user_changelist_filtered_by_sponsor(self):
+        self.assert_constant_queries('users_customuser', {'parent_sponsor__id__exact': self.company.pk}, 5)
+
+    def test_user_changelist_filtered_by_placement(self):
+        self.assert_constant_queries('users_customuser', {'parent_node__id__exact': self.company.pk}, 5)
+
+    def test_profile_changelist(self):
+        self.assert_constant_queries('users_profile', {}, 5)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class UserAdminPlacementTests(TestCase):
+    def test_sponsor_and_placement_are_read_only_on_change(self):
+        company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        member = CustomUser.objects.create_user('member@example.com', 'pw')
+        other = CustomUser.objects.create_user('other@example.com', 'pw')
+        self.client.force_login(company)
+        url = reverse('admin:users_customuser_change', args=[member.pk])
+        response = self.client.get(url)
+        self.assertNotContains(response, 'name="parent_node"')
+        self.assertNotContains(response, 'name="parent_sponsor"')
+
+        form = response.context['adminform'].form
+        data = {name: value for name, value in form.initial.items() if value is not None and name in form.fields}
+        data.update(groups=[], user_permissions=[], parent_node=other.pk, parent_sponsor=other.pk)
+        self.assertEqual(self.client.post(url, data).status_code, 302)
+        member.refresh_from_db()
+        self.assertEqual((member.parent_node_id, member.parent_sponsor_id), (company.pk, company.pk))
+        self.assertEqual(MLMTree.objects.get(user=member).parent.user_id, company.pk)
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SponsorPathTests(TestCase):
+    """sponsor_path must always spell out the parent_sponsor chain."""
+
+    def setUp(self):
+        self.company = CustomUser.objects.create_superuser('company@example.com', 'pw')
+        self.lead = CustomUser.objects.create_user('lead@example.com', 'pw')
+        self.member = CustomUser.objects.create_user('member@example.com', 'pw', parent_sponsor=self.lead)
+        self.referral = CustomUser.objects.create_user('referral@example.com', 'pw', parent_sponsor=self.member)
+        self.other = CustomUser.objects.create_user('other@example.com', 'pw')
+
+    def assert_paths_follow_sponsors(self):
+        sponsors = dict(CustomUser.objects.values_list('pk', 'parent_sponsor_id'))
+        for pk, path in CustomUser.objects.values_list('pk', 'sponsor_path'):
+            chain = []
+            while pk:
+                chain.insert(0, encode_segment(pk))
+                pk = sponsors[pk]
+            self.assertEqual(path, ''.join(chain))
+
+    def emails(self, users):
+        return [user.email for user in users]
+
+    def test_responsoring_carries_the_referred_downline(self):
+        self.assert_paths_follow_sponsors()
+        member = CustomUser.objects.get(pk=self.member.pk)
+        member.parent_sponsor = self.other
+        member.save()
+        self.assert_paths_follow_sponsors()
+        other = CustomUser.objects.get(pk=self.other.pk)
+        self.assertEqual(self.emails(other.get_sponsor_downline()), ['member@example.com', 'referral@example.com'])
+        self.assertEqual(self.emails(CustomUser.objects.get(pk=self.lead.pk).get_sponsor_downline()), [])
+        referral = CustomUser.objects.get(pk=self.referral.pk)
+        self.assertEqual(
+            self.emails(referral.get_sponsor_upline()),
+            ['company@example.com', 'other@example.com', 'member@example.com'],
+        )
+
+    def test_sponsor_from_own_downline_is_refused(self):
+        lead = CustomUser.objects.get(pk=self.lead.pk)
+        lead.parent_sponsor = self.referral
+        with self.assertRaises(ValueError), transaction.atomic():
+            lead.save()
+        self.assert_paths_follow_sponsors()
+
+    def test_deleting_a_sponsor_detaches_the_referred_downline(self):
+        CustomUser.objects.get(pk=self.lead.pk).delete()
+        self.assert_paths_follow_sponsors()
+        member = CustomUser.objects.get(pk=self.member.pk)
+        self.assertEqual(self.emails(member.get_sponsor_upline()), [])
+        self.assertEqual(self.emails(member.get_sponsor_downline()), ['referral@example.com'])
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ReferralCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        referral_cache.clear()
+        self.addCleanup(referral_cache.clear)
+        CustomUser.objects.create_superuser('company@example.com', 'pw')
+        self.sponsor = CustomUser.objects.create_user('sponsor@example.com', 'pw')
+        self.code = self.sponsor.unique_id
+
+    def test_hits_and_misses_are_counted_and_shared(self):
+        resolve_referral(self.code)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_referral(self.code).pk, self.sponsor.pk)
+        self.assertEqual((referral_cache.hits, referral_cache.misses), (1, 1))
+        self.assertEqual(shared_stats()['hit_rate'], 0.5)
+        out = StringIO()
+        call_command('referral_cache_stats', '--reset', stdout=out)
+        self.assertIn('hit rate 50.0%', out.getvalue())
+        self.assertEqual(shared_stats()['hits'], 0)
+
+    def test_evictions_are_counted(self):
+        small = ReferralCache(2, 60)
+        for code in 'abc':
+            small.put(code, self.sponsor)
+        self.assertIsNone(small.get('a'))
+        self.assertEqual(small.stats()['evictions'], 1)
+        self.assertEqual(small.stats()['size'], 2)
+
+    def test_only_deactivation_renumbering_and_delete_evict(self):
+        resolve_referral(self.code)
+        sponsor = CustomUser.objects.get(pk=self.sponsor.pk)
+        sponsor.last_name = 'Renamed'
+        sponsor.save(update_fields=['last_name'])
+        self.assertIsNotNone(referral_cache.get(self.code))
+
+        sponsor.is_active = False
+        sponsor.save()
+        self.assertIsNone(referral_cache.get(self.code))
+        self.assertIsNone(resolve_referral(self.code))
+
+        sponsor.is_active = True
+        sponsor.save()
+        resolve_referral(self.code)
+        sponsor.unique_id = 'VGS-SS-XX-RENUMBERED'
+        sponsor.save()
+        self.assertIsNone(referral_cache.get(self.code))
+
+        resolve_referral(sponsor.unique_id)
+        sponsor.delete()
+        self.assertIsNone(referral_cache.get(sponsor.unique_id))
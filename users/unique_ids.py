@@ -0,0 +1,113 @@
+"""Allocation of member ids (``VGS-SS-FL-##########``) without uniqueness queries.
+
+Numbers come from a database sequence (``UniqueIdSequence``) that processes
+advance a whole block at a time, so most signups do not touch the sequence at
+all. A block reserved inside a transaction only counts once that transaction
+commits: if it rolls back, the sequence goes back too and the block is dropped,
+since another process may now reserve the same range. Each sequence position is turned into the ten digits by a keyed Feistel
+permutation, which never maps two positions to the same number, so ids are
+unique by construction while still looking random.
+
+Ids of this scheme are 0000000000-0999999999; the earlier random ids were always
+1000000000 or higher, so the two never meet. ``UNIQUE_ID_KEY`` fixes the
+permutation and must not change once ids have been handed out.
+"""
+import hashlib
+import os
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import UniqueIdSequence
+
+SEQUENCE_NAME = 'unique_id'
+# Numbers below this bound, written with ten digits
+ID_SPACE = 10 ** 9
+# The permutation works on 30 bits (just above ID_SPACE) and walks until it lands below it.
+HALF_BITS = 15
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 4
+
+# One block per thread, each thread's reservation belongs to its own connection and transaction.
+_blocks = threading.local()
+
+
+def _key():
+    return str(getattr(settings, 'UNIQUE_ID_KEY', 'vgs-ss')).encode()
+
+
+def _round_value(key, round_number, value):
+    digest = hashlib.blake2b(value.to_bytes(2, 'big'), key=key, person=bytes([round_number]) * 16, digest_size=2)
+    return int.from_bytes(digest.digest(), 'big') & HALF_MASK
+
+
+def permute(position):
+    """Map a sequence position below ID_SPACE to a distinct number below ID_SPACE."""
+    key = _key()
+    value = position
+    while True:
+        left, right = value >> HALF_BITS, value & HALF_MASK
+        for round_number in range(ROUNDS):
+            left, right = right, left ^ _round_value(key, round_number, right)
+        value = (left << HALF_BITS) | right
+        # Cycle walking: the 30-bit permutation restricted to ID_SPACE is still a permutation.
+        if value < ID_SPACE:
+            return value
+
+
+def reserve_block(size):
+    """Advance the sequence by ``size`` and return the reserved positions as a range."""
+    UniqueIdSequence.objects.get_or_create(name=SEQUENCE_NAME)
+    while True:
+        start = UniqueIdSequence.objects.filter(name=SEQUENCE_NAME).values_list('next_value', flat=True).get()
+        if start + size > ID_SPACE:
+            raise OverflowError("The unique_id sequence is exhausted.")
+        # Compare-and-swap, so concurrent processes get disjoint blocks.
+        if UniqueIdSequence.objects.filter(name=SEQUENCE_NAME, next_value=start).update(next_value=start + size):
+            return range(start, start + size)
+
+
+def _usable(block):
+    """True while ``block`` can hand out numbers: committed, or reserved by the still open transaction."""
+    if block is None or block['pid'] != os.getpid() or block['next'] >= block['end']:
+        # A forked worker must not hand out the numbers its parent already holds.
+        return False
+    if block['committed']:
+        return True
+    # Rolling back a transaction or savepoint discards the on_commit hooks registered in it.
+    pending = transaction.get_connection().run_on_commit
+    return any(hook is block['confirm'] for _, hook, _ in pending)
+
+
+def _reserve():
+    block_range = reserve_block(getattr(settings, 'UNIQUE_ID_BLOCK_SIZE', 100))
+    block = {'pid': os.getpid(), 'next': block_range.start, 'end': block_range.stop, 'committed': False}
+
+    def confirm():
+        block['committed'] = True
+
+    block['confirm'] = confirm
+    transaction.on_commit(confirm)  # runs at once outside a transaction
+    return block
+
+
+def next_unique_number():
+    """Next number from this thread's block, reserving a new block when it runs out or was rolled back."""
+    block = getattr(_blocks, 'block', None)
+    if not _usable(block):
+        block = _blocks.block = _reserve()
+    position = block['next']
+    block['next'] += 1
+    return permute(position)
+
+
+def allocate_unique_numbers(count):
+    """``count`` numbers at once from a block reserved for them (bulk imports)."""
+    return [permute(position) for position in reserve_block(count)] if count else []
+
+
+def format_unique_id(first_name, last_name, number):
+    first_initial = first_name[0].upper() if first_name else 'X'
+    last_initial = last_name[0].upper() if last_name else 'X'
+    return f"VGS-SS-{first_initial}{last_initial}-{number:010d}"
@@ -9,15 +9,19 @@ from .forms import (
     UpdateInfoForm, ShippingAddressForm
 )
 from .models import CustomUser, Profile, ShippingAddress
-import json
-from cart.cart import Cart
+from .referrals import resolve_referral
+from .registration import register
+from cart.cart import Cart, load_saved_cart, set_cart_count
+from mlmtree.models import MLMNodeStats
+from mlmtree.stats import level_counts
 
 # Register User with Referral System# Register User with Referral System
-def register_user(request):
-    # Check if referral ID is in GET request and store it in session
-    if 'ref' in request.GET:
-        referral_id = request.GET.get('ref')
-        request.session['referral_id'] = referral_id  # Store in session
+def register_user(request, referral_code=None):
+    # Check if referral ID is in GET request (or the URL) and store it in session
+    if 'ref' in request.GET or referral_code:
+        referral_id = request.GET.get('ref') or referral_code
+        if request.session.get('referral_id') != referral_id:
+            request.session['referral_id'] = referral_id  # Store in session (skip the write when unchanged)
         print(f"Referral ID received and stored in session: {referral_id}")
 
     # Retrieve referral ID from session (if available)
@@ -26,19 +30,20 @@ def register_user(request):
 
     parent_sponsor = None
     if referral_id:
-        try:
-            parent_sponsor = CustomUser.objects.get(unique_id=referral_id)
-            print(f"Parent Sponsor Found: {parent_sponsor.email}")  # Debugging
-        except CustomUser.DoesNotExist:
+        parent_sponsor = resolve_referral(referral_id)  # cached, see users.referrals
+        if parent_sponsor is None:
+            # Forget the bad code, otherwise the redirect below would land here again.
+            request.session.pop('referral_id', None)
             messages.error(request, "Invalid referral link.")
             return redirect('register')
+        print(f"Parent Sponsor Found: {parent_sponsor.email}")  # Debugging
 
     if request.method == 'POST':
         form = CustomUserRegistrationForm(request.POST)
         if form.is_valid():
             user = form.save(commit=False)
             user.parent_sponsor = parent_sponsor  # Assign sponsor
-            user.save()
+            register(user)
             print(f"User {user.email} saved with Parent Sponsor: {user.parent_sponsor.email if user.parent_sponsor else 'None'}")  # Debugging
             
             # Clear the referral ID from session after use
@@ -66,13 +71,9 @@ def login_user(request):
             if user is not None:
                 login(request, user)
 
-                # Restore previous cart
-                current_user = Profile.objects.get(user=request.user)
-                saved_cart = current_user.old_cart
-                if saved_cart:
-                    cart = Cart(request)
-                    for key, value in json.loads(saved_cart).items():
-                        cart.db_add(product=key, quantity=value)
+                # Restore previous cart, merged with what was added before logging in
+                if Cart(request).merge(load_saved_cart(request.user)):
+                    messages.warning(request, 'Some items in your cart are no longer available in that quantity, your cart has been updated.')
 
                 messages.success(request, 'Login successful!')
                 return redirect('home')
@@ -85,6 +86,7 @@ def login_user(request):
 # Logout User
 def logout_user(request):
     logout(request)
+    set_cart_count(request, 0)  # logout flushed the session cart
     messages.success(request, 'You have been logged out!')
     return redirect('home')
 
@@ -133,13 +135,17 @@ def update_password(request):
 def user_profile(request):
     if request.user.is_authenticated:
         profile = Profile.objects.get(user=request.user)
+        stats = MLMNodeStats.objects.filter(node__user=request.user).first()
         user_data = {
             'email': request.user.email,
             'first_name': request.user.first_name,
             'last_name': request.user.last_name,
             'unique_id': request.user.unique_id,
             'referral_link': f"{request.scheme}://{request.get_host()}/users/register/?ref={request.user.unique_id}",
-            'parent_sponsor': request.user.parent_sponsor.unique_id if request.user.parent_sponsor else "None"
+            'parent_sponsor': request.user.parent_sponsor.unique_id if request.user.parent_sponsor else "None",
+            'downline_size': stats.downline_size if stats else 0,
+            'direct_children': stats.direct_children if stats else 0,
+            'level_counts': level_counts(stats.node_id) if stats else [],
         }
         return render(request, 'users/user_profile.html', {'user_data': user_data})
     messages.error(request, "You must be logged in to view your profile.")